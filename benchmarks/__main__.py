@@ -0,0 +1,139 @@
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .cases import CASES, POINT_SIZES, RESULT_SIZES, rows
+from .load import print_report, run_load
+
+# Benchmarks for the client and the savgol pipeline (not part of the test suite).
+#
+#     python -m benchmarks run --suite quick --out before.json
+#     python -m benchmarks run --suite quick --out after.json
+#     python -m benchmarks compare before.json after.json
+#     python -m benchmarks load --queries 5000 --queue-time 1 5 --failure-rate 0.01
+#
+# run times every case repeat times (after one untimed warm-up) and then runs it once more under
+# tracemalloc for the peak Python/numpy memory. compare prints the ratio of the median times and
+# exits with status 1 if any case got slower by more than --threshold.
+
+def size_name(size):
+    if isinstance(size, tuple):
+        return '{}x{}y'.format(*size)
+    return '{}pts'.format(size)
+
+def measure(fn, repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+        fn()
+        seconds = []
+        for i in range(repeat):
+            start = time.perf_counter()
+            fn()
+            seconds.append(time.perf_counter() - start)
+        tracemalloc.start()
+        fn()
+        (current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return {'seconds': seconds, 'median': statistics.median(seconds), 'min': min(seconds), 'peak_mb': peak / 2**20}
+
+def run(args):
+    selected = args.cases.split(',') if args.cases else list(CASES)
+    results = {}
+    for name in selected:
+        (setup, kind) = CASES[name]
+        sizes = RESULT_SIZES[args.suite] if kind == 'result' else POINT_SIZES[args.suite]
+        for size in sizes:
+            if kind == 'result' and rows(size) > args.max_rows:
+                print('{:<22} {:>12}  skipped (more than --max-rows)'.format(name, size_name(size)))
+                continue
+            key = '{}[{}]'.format(name, size_name(size))
+            result = measure(setup(size), args.repeat)
+            results[key] = result
+            print('{:<22} {:>12}  {:9.4f} s  {:9.1f} MB'.format(name, size_name(size), result['median'], result['peak_mb']))
+    meta = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'suite': args.suite,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'pyarrow': pa.__version__,
+    }
+    with open(args.out, 'w') as f:
+        json.dump({'meta': meta, 'results': results}, f, indent=1)
+    print('wrote {}'.format(args.out))
+
+def compare(args):
+    with open(args.before) as f:
+        before = json.load(f)['results']
+    with open(args.after) as f:
+        after = json.load(f)['results']
+    slower = []
+    print('{:<36} {:>10} {:>10} {:>7} {:>9}'.format('case', 'before s', 'after s', 'ratio', 'peak MB'))
+    for key in sorted(set(before) & set(after)):
+        ratio = after[key]['median'] / before[key]['median']
+        flag = ''
+        if ratio > 1 + args.threshold:
+            flag = '  slower'
+            slower.append(key)
+        elif ratio < 1 - args.threshold:
+            flag = '  faster'
+        print('{:<36} {:10.4f} {:10.4f} {:7.2f} {:9.1f}{}'.format(key, before[key]['median'], after[key]['median'], ratio, after[key]['peak_mb'], flag))
+    for key in sorted(set(before) ^ set(after)):
+        print('{:<36} only in {}'.format(key, 'before' if key in before else 'after'))
+    return 1 if len(slower) > 0 else 0
+
+def load(args):
+    server_options = {'latency': args.latency, 'queue_time': tuple(args.queue_time), 'failure_rate': args.failure_rate, 'error_rate': args.error_rate}
+    report = run_load(args.queries, args.points, submit_workers=args.submit_workers, read_workers=args.read_workers, poll_initial=args.poll_initial, poll_max=args.poll_max, server_options=server_options)
+    print_report(report)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=1)
+        print('wrote {}'.format(args.out))
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    commands = parser.add_subparsers(dest='command', required=True)
+    p = commands.add_parser('run', help='run the benchmarks and save the results as json')
+    p.add_argument('--suite', choices=sorted(RESULT_SIZES), default='quick')
+    p.add_argument('--cases', help='comma separated case names (default: all of {})'.format(', '.join(CASES)))
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--max-rows', type=int, default=50_000_000, help='skip result sizes with more rows than this')
+    p.add_argument('--out', default='benchmark.json')
+    p = commands.add_parser('compare', help='compare two saved runs')
+    p.add_argument('before')
+    p.add_argument('after')
+    p.add_argument('--threshold', type=float, default=0.1, help='relative change that counts as slower/faster')
+    p = commands.add_parser('load', help='load test the client against a local stand-in server')
+    p.add_argument('--queries', type=int, default=1000)
+    p.add_argument('--points', type=int, default=10, help='points per query (one year of daily data each)')
+    p.add_argument('--submit-workers', type=int, default=32)
+    p.add_argument('--read-workers', type=int, default=8)
+    p.add_argument('--poll-initial', type=float, default=0.5)
+    p.add_argument('--poll-max', type=float, default=5)
+    p.add_argument('--latency', type=float, default=0.01, help='seconds the server adds to every response')
+    p.add_argument('--queue-time', type=float, nargs=2, default=(0.5, 2.0), metavar=('MIN', 'MAX'), help='seconds a query waits on the server')
+    p.add_argument('--failure-rate', type=float, default=0.0, help='fraction of queries that fail')
+    p.add_argument('--error-rate', type=float, default=0.0, help='fraction of responses that are a 503')
+    p.add_argument('--out', help='also save the report as json')
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        return run(args)
+    if args.command == 'load':
+        return load(args)
+    return compare(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
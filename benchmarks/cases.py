@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+
+import pandas as pd
+
+from streambatch.encoding import dumps
+from streambatch.module1 import StreambatchConnection, savgol_qids
+from streambatch.savgol import outlier_mask, prepare, savgol, savgol_update
+
+from .data import make_points, make_raw
+
+# Benchmark cases. Each case has a setup(size) that builds its input (not timed) and returns the
+# function to time. size is (locations, years) for the result cases and a point count for the request cases.
+
+# (locations, years) per suite. Sizes with more rows than --max-rows are skipped
+RESULT_SIZES = {
+    'quick': [(1, 1), (100, 1), (100, 12), (1000, 12)],
+    'full': [(1, 1), (100, 1), (100, 12), (1000, 12), (10000, 12), (100000, 1)],
+}
+POINT_SIZES = {
+    'quick': [1000, 100000],
+    'full': [1000, 100000, 1000000],
+}
+
+def rows(size):
+    (n, years) = size
+    return int(n * round(365.25 * years))
+
+def setup_prepare(size):
+    raw = make_raw(*size)
+    return lambda: prepare(raw)
+
+def setup_outliers(size):
+    m = prepare(make_raw(*size))[0]
+    return lambda: outlier_mask(m, by='point')
+
+def setup_savgol(size):
+    raw = make_raw(*size)
+    return lambda: savgol(raw)
+
+# a month of new data on top of the rest of the history
+def setup_savgol_update(size):
+    raw = make_raw(*size)
+    split = raw['time'].max() - pd.Timedelta(days=30)
+    previous = savgol(raw[raw['time'] <= split])
+    new = raw[raw['time'] > split]
+    return lambda: savgol_update(previous, new)
+
+# get_data() against a mocked server: status always reports Succeeded and the result is read from a
+# local parquet file instead of S3, so the timing covers the read and conversion, not the network
+class LocalResult:
+    def __init__(self, size, smooth=False):
+        self.directory = tempfile.TemporaryDirectory()
+        make_raw(*size).to_parquet(os.path.join(self.directory.name, 'bench.parquet'))
+        self.connection = StreambatchConnection('benchmark')
+        self.connection.READ_URL = self.directory.name
+        self.connection.status = lambda query_id: json.dumps({'status': 'Succeeded'})
+        if smooth and 'bench' not in savgol_qids:
+            savgol_qids.append('bench')
+        elif not smooth and 'bench' in savgol_qids:
+            savgol_qids.remove('bench')
+
+    def __call__(self):
+        return self.connection.get_data('bench')
+
+def setup_get_data(size):
+    return LocalResult(size)
+
+def setup_get_data_savgol(size):
+    return LocalResult(size, smooth=True)
+
+def setup_validate_points(n):
+    points = make_points(n)
+    connection = StreambatchConnection('benchmark')
+    return lambda: connection.validate_point_input(points)
+
+def setup_validate_point_list(n):
+    points = make_points(n).tolist()
+    connection = StreambatchConnection('benchmark')
+    return lambda: connection.validate_point_input(points)
+
+def setup_encode_request(n):
+    request = StreambatchConnection('benchmark').build_ndvi_request(points=make_points(n), start_date='2020-01-01', end_date='2020-12-31')
+    return lambda: dumps(request)
+
+# name -> (setup, kind) where kind says which sizes the case runs at
+CASES = {
+    'prepare': (setup_prepare, 'result'),
+    'outlier_mask': (setup_outliers, 'result'),
+    'savgol': (setup_savgol, 'result'),
+    'savgol_update': (setup_savgol_update, 'result'),
+    'get_data': (setup_get_data, 'result'),
+    'get_data_savgol': (setup_get_data_savgol, 'result'),
+    'validate_points': (setup_validate_points, 'points'),
+    'validate_point_list': (setup_validate_point_list, 'points'),
+    'encode_request': (setup_encode_request, 'points'),
+}
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+# Synthetic data shaped like the server's output, for benchmarking.
+
+# make_raw()
+# sentinel2 + landsat result for n locations over years years: one row per location and day with a
+# seasonal NDVI curve plus noise, ~20% of days with a valid sentinel2 observation, ~10% with landsat,
+# and a few cloud spikes for the outlier test. col is 'point' or 'location'
+def make_raw(n, years=1, col='point', seed=0):
+    rng = np.random.default_rng(seed)
+    days = int(round(365.25 * years))
+    rows = n * days
+    t = pd.date_range('2013-01-01', periods=days, freq='D').to_numpy()
+    day = np.tile(np.arange(days), n)
+    loc = np.repeat(np.arange(n), days)
+    base = 0.5 + 0.3 * np.sin(day / 58.0 + loc)
+    s2 = np.round(base + rng.normal(0, 0.05, rows), 3)
+    s2[rng.random(rows) < 0.03] -= 0.4
+    l8 = np.round(base + rng.normal(0, 0.05, rows), 3)
+    return pd.DataFrame({
+        col: loc,
+        'time': np.tile(t, n),
+        'ndvi.sentinel2': s2,
+        'qa.sentinel2': (rng.random(rows) < 0.2).astype(np.int64),
+        'ndvi.landsat': l8,
+        'qa.landsat': (rng.random(rows) < 0.1).astype(np.int64),
+    })
+
+# make_points()
+# n random (longitude, latitude) pairs as an (n, 2) array
+def make_points(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return np.column_stack([rng.uniform(-180, 180, n), rng.uniform(-90, 90, n)])
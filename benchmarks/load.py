@@ -0,0 +1,133 @@
+import multiprocessing
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from streambatch.module1 import StreambatchConnection
+from streambatch.testing import StandInServer
+
+from .data import make_points
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+# Load test of StreambatchConnection against the local stand-in server (see server.py).
+#
+#     python -m benchmarks load --queries 5000 --points 10 --queue-time 1 5 --failure-rate 0.01
+#
+# The server runs in its own process, so the CPU time and memory reported are the client's. Queries
+# are submitted from submit_workers threads; the connection's poll() then watches all of them and
+# every query that finishes is read on one of read_workers threads. A query's latency runs from the
+# start of its submit to the end of its read.
+
+def serve(pipe, options):
+    server = StandInServer(**options).start()
+    pipe.send((server.url, server.directory))
+    pipe.recv()
+    pipe.send(dict(server.stats))
+    server.stop()
+
+def percentiles(values):
+    if len(values) == 0:
+        return {}
+    values = sorted(values)
+    pick = lambda q: values[min(len(values) - 1, int(q * len(values)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': values[-1], 'mean': statistics.mean(values)}
+
+# run_load()
+# runs the load test and returns a report dict. server_options go to StandInServer
+def run_load(queries=1000, points=10, start_date='2023-01-01', end_date='2023-12-31', submit_workers=32, read_workers=8, poll_initial=0.5, poll_max=5, server_options=None):
+    (parent, child) = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(child, server_options or {}), daemon=True)
+    process.start()
+    (url, directory) = parent.recv()
+    connection = StreambatchConnection('load-test', pool_size=max(submit_workers, read_workers), poll_initial=poll_initial, poll_max=poll_max, quiet=True)
+    connection.REQUEST_URL = url + '/async'
+    connection.STATUS_URL = url + '/check'
+    connection.READ_URL = directory
+    batch = make_points(points).tolist()
+    started = {}
+    submitted = {}
+    finished = {}
+    rows = {}
+    errors = []
+    lock = threading.Lock()
+
+    def submit(i):
+        t = time.perf_counter()
+        try:
+            query_id = connection.request_ndvi(points=batch, start_date=start_date, end_date=end_date)
+        except Exception as e:
+            with lock:
+                errors.append('submit: {}'.format(e))
+            return None
+        with lock:
+            started[query_id] = t
+            submitted[query_id] = time.perf_counter() - t
+        return query_id
+
+    def read(query_id):
+        try:
+            df = connection.get_data(query_id)
+        except Exception as e:
+            with lock:
+                errors.append('read {}: {}'.format(query_id, e))
+            return
+        with lock:
+            finished[query_id] = time.perf_counter() - started[query_id]
+            rows[query_id] = 0 if df is None else len(df)
+
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    with ThreadPoolExecutor(submit_workers) as pool:
+        query_ids = [q for q in pool.map(submit, range(queries)) if q is not None]
+    submit_seconds = time.perf_counter() - wall
+    statuses = {}
+    with ThreadPoolExecutor(read_workers) as pool:
+        try:
+            for (query_id, final_status) in connection.poll(query_ids):
+                statuses[query_id] = final_status
+                if final_status == 'Succeeded':
+                    pool.submit(read, query_id)
+        except Exception as e:
+            errors.append('poll: {}'.format(e))
+    wall = time.perf_counter() - wall
+    cpu = time.process_time() - cpu
+    parent.send('stop')
+    server_stats = parent.recv()
+    process.join()
+    succeeded = [q for q in finished if rows[q] > 0]
+    return {
+        'queries': queries,
+        'submitted': len(query_ids),
+        'succeeded': len(succeeded),
+        'failed': sum(1 for s in statuses.values() if s == 'Failed'),
+        'errors': errors,
+        'seconds': wall,
+        'submit_seconds': submit_seconds,
+        'queries_per_second': len(succeeded) / wall,
+        'rows_per_second': sum(rows.values()) / wall,
+        'submit_latency': percentiles(list(submitted.values())),
+        'latency': percentiles([finished[q] for q in succeeded]),
+        'client_cpu_seconds': cpu,
+        'client_peak_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if resource is not None else None,
+        'http': {k: v for (k, v) in connection.connection_stats().items() if k != 'pools'},
+        'server': server_stats,
+    }
+
+def print_report(report):
+    print('{submitted}/{queries} queries submitted in {submit_seconds:.2f} s; {succeeded} read, {failed} failed, {0} client errors'.format(len(report['errors']), **report))
+    print('wall {seconds:.2f} s, {queries_per_second:.1f} queries/s, {rows_per_second:,.0f} rows/s'.format(**report))
+    for name in ('submit_latency', 'latency'):
+        p = report[name]
+        if p:
+            print('{:<15} p50 {p50:.3f} s  p90 {p90:.3f} s  p99 {p99:.3f} s  max {max:.3f} s'.format(name, **p))
+    peak = report['client_peak_mb']
+    print('client cpu {:.2f} s, peak rss {}'.format(report['client_cpu_seconds'], 'n/a' if peak is None else '{:.0f} MB'.format(peak)))
+    print('http {}'.format(report['http']))
+    print('server {}'.format(report['server']))
+    for error in report['errors'][:5]:
+        print('  ' + error)
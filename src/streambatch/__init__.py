@@ -1,3 +1,19 @@
 __version__ = "0.1.0"
 
-from .module1 import *
\ No newline at end of file
+from .base import *
+
+# the connections and IncrementalStore are imported on first use (PEP 562): StreambatchConnection needs
+# requests and AsyncStreambatchConnection asyncio, which take longer to import than the rest of the
+# package together, and `import streambatch` (or the command line) shouldn't pay for what it doesn't use
+LAZY_NAMES = {'StreambatchConnection': 'module1', 'AsyncStreambatchConnection': 'aio', 'IncrementalStore': 'sync'}
+
+def __getattr__(name):
+    if name not in LAZY_NAMES:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__,name))
+    import importlib
+    value = getattr(importlib.import_module('.' + LAZY_NAMES[name],__name__),name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(list(globals()) + list(LAZY_NAMES))
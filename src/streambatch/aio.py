@@ -0,0 +1,279 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+
+from .base import RESULT_FORMATS, ConnectionBase, ShardSubmitError, is_retryable, savgol_qids, sharded_qids
+from .compact import compact_table
+
+# AsyncStreambatchConnection
+# asyncio version of StreambatchConnection. Validation, request bodies and the savgol handling
+# come from ConnectionBase, as for the blocking connection; submit, status and the parquet read are
+# awaitable so one event loop can keep thousands of queries in flight. iter_data(), save_data() and
+# fetch_many() have no async version: use asyncio.gather() over get_data().
+#
+#     async with AsyncStreambatchConnection(api_key) as connection:
+#         query_ids = await asyncio.gather(*[connection.request_ndvi(points=p) for p in batches])
+#         frames = await asyncio.gather(*[connection.get_data(q) for q in query_ids])
+#
+# Needs aiohttp (pip install streambatch[async]).
+class AsyncStreambatchConnection(ConnectionBase):
+    # takes the arguments of ConnectionBase; max_connections bounds the open HTTP connections and
+    # pool_size the threads of the connection's own executor, which runs the blocking work (parquet reads,
+    # smoothing and fan-out) off the event loop. close() shuts it down
+    def __init__(self,api_key,use_test_api=False,max_connections=100,pool_size=10,max_retries=3,backoff_factor=0.5,backoff_max=30,poll_initial=0.5,poll_factor=1.5,poll_max=30,shard_size=None,cache_dir=None,cache_max_bytes=10 * 2**30,request_cache_path=None,request_cache_ttl=7 * 24 * 3600,coordinate_precision=None,compress_requests=False,instrumentation=None,quiet=False,journal_path=None):
+        super().__init__(api_key,use_test_api=use_test_api,pool_size=pool_size,max_retries=max_retries,backoff_factor=backoff_factor,backoff_max=backoff_max,poll_initial=poll_initial,poll_factor=poll_factor,poll_max=poll_max,shard_size=shard_size,
+                         cache_dir=cache_dir,cache_max_bytes=cache_max_bytes,request_cache_path=request_cache_path,request_cache_ttl=request_cache_ttl,coordinate_precision=coordinate_precision,compress_requests=compress_requests,
+                         instrumentation=instrumentation,quiet=quiet,journal_path=journal_path)
+        self.max_connections = max_connections
+        self.executor = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self,exc_type,exc,tb):
+        await self.close()
+
+    async def open(self):
+        if self.session is None:
+            try:
+                import aiohttp
+            except ImportError:
+                raise ImportError("AsyncStreambatchConnection needs aiohttp: pip install streambatch[async]")
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections),headers={'X-API-Key': self.api_key})
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    # run_blocking()
+    # runs fn(*args) on the connection's executor (at most pool_size threads) and returns its result
+    async def run_blocking(self,fn,*args):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.pool_size)
+        return await asyncio.get_running_loop().run_in_executor(self.executor,fn,*args)
+
+    # send()
+    # same retry rules as StreambatchConnection.send(); returns (status code, body text)
+    async def send(self,method,url,**kwargs):
+        import aiohttp
+        session = await self.open()
+        attempt = 0
+        while True:
+            self.http_stats['requests'] += 1
+            try:
+                async with session.request(method,url,**kwargs) as response:
+                    text = await response.text()
+            except aiohttp.ClientConnectionError:
+                if method != 'GET' or attempt >= self.max_retries:
+                    self.http_stats['failures'] += 1
+                    raise
+                retry_after = None
+            else:
+                if not is_retryable(method,response.status) or attempt >= self.max_retries:
+                    if response.status != 200:
+                        self.http_stats['failures'] += 1
+                    return (response.status,text)
+                retry_after = response.headers.get('Retry-After')
+            delay = self.backoff_delay(attempt,retry_after)
+            self.http_stats['retries'] += 1
+            self.http_stats['retry_wait'] += delay
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def make_request(self,ndvi_request):
+        (body,headers) = self.encode_request(ndvi_request)
+        with self.events.timed('request.submit',bytes=len(body)) as fields:
+            (status_code,text) = await self.send('POST', self.REQUEST_URL, data=body, headers=headers)
+            fields['status_code'] = status_code
+        if status_code != 200:
+            raise ValueError("{}".format(json.dumps(json.loads(text),indent=4)))
+        content = json.loads(text)
+        return (content['id'],content['access_url'])
+
+    # request_ndvi()
+    # as StreambatchConnection.request_ndvi()
+    async def request_ndvi(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None,shard_size=None,dedupe=None):
+        arguments = self.ndvi_arguments(polygons,points,location_ids,sources,dedupe)
+        qid = await self.request_ndvi_(aggregation=aggregation,start_date=start_date,end_date=end_date,query_id=query_id,shard_size=shard_size,**arguments)
+        if arguments['postprocess'] == 'savgol':
+            savgol_qids.append(qid)
+        return qid
+
+    async def request_ndvi_(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None,shard_size=None,postprocess=None,groups=None):
+        started = time.perf_counter()
+        (ndvi_request,shards,query_id) = self.prepare_request(polygons=polygons,points=points,location_ids=location_ids,aggregation=aggregation,start_date=start_date,end_date=end_date,sources=sources,query_id=query_id,shard_size=shard_size,postprocess=postprocess,groups=groups)
+        if query_id is None and len(shards) > 1:
+            query_id = self.register_shards(await self.submit_shards(shards,postprocess,groups))
+            self.remember_request(ndvi_request,query_id,postprocess,groups)
+        elif query_id is None:
+            (query_id,access_url) = await self.make_request(ndvi_request)
+            self.remember_request(ndvi_request,query_id,postprocess,groups)
+        return self.finish_request(query_id,ndvi_request,postprocess,groups,polygons is not None,len(shards),started)
+
+    # submit_shards()
+    # as StreambatchConnection.submit_shards()
+    async def submit_shards(self,shards,postprocess=None,groups=None):
+        async def submit(shard):
+            cached_id = self.lookup_request(shard,postprocess,groups)
+            if cached_id is not None:
+                return cached_id
+            (qid,access_url) = await self.make_request(shard)
+            self.remember_request(shard,qid,postprocess,groups)
+            return qid
+        results = await asyncio.gather(*[submit(shard) for (shard,offset) in shards],return_exceptions=True)
+        submitted = [(qid,offset) for (qid,(shard,offset)) in zip(results,shards) if not isinstance(qid,BaseException)]
+        errors = [(offset,e) for (e,(shard,offset)) in zip(results,shards) if isinstance(e,BaseException)]
+        if len(errors) > 0:
+            raise ShardSubmitError(submitted,errors)
+        return submitted
+
+    async def status(self,query_id):
+        if query_id in sharded_qids:
+            return await self.sharded_status(query_id)
+        (status_code,text) = await self.send('GET', self.STATUS_URL, params={'query_id': query_id})
+        return text
+
+    # the parquet read (download + decode) is blocking, so it runs on the connection's executor
+    async def read_parquet(self,access_url,columns=None,filters=None):
+        return await self.run_blocking(self.load_parquet,access_url,columns,filters)
+
+    async def sharded_status(self,query_id):
+        shard_ids = [qid for (qid,offset) in sharded_qids[query_id]]
+        statuses = [json.loads(s) for s in await asyncio.gather(*[self.status(qid) for qid in shard_ids])]
+        return json.dumps(self.merge_shard_statuses(shard_ids,statuses))
+
+    async def read_table(self,access_url,columns=None,filters=None):
+        return await self.run_blocking(self.load_table,access_url,columns,filters)
+
+    async def read_result(self,query_id,columns=None,locations=None,start=None,end=None,as_arrow=False):
+        read_fn = self.read_table if as_arrow else self.read_parquet
+        async def read(plan):
+            (url,shard_locations,offset) = plan
+            # build_filters may have to read the parquet footer, which blocks
+            filters = await self.run_blocking(self.build_filters,url,shard_locations,start,end)
+            return await read_fn(url,columns,filters)
+        reads = self.plan_reads(query_id,locations)
+        if query_id not in sharded_qids:
+            return await read(reads[0])
+        parts = list(await asyncio.gather(*[read(plan) for plan in reads]))
+        offsets = [offset for (url,shard_locations,offset) in reads]
+        if as_arrow:
+            return self.merge_tables(parts,offsets)
+        return self.merge_shards(parts,offsets)
+
+    async def query_done(self,query_id):
+        status = json.loads(await self.status(query_id))
+        return self.final_status(status) is not None
+
+    # poll()
+    # async version of StreambatchConnection.poll(): every round checks all pending queries concurrently
+    async def poll(self,query_ids,timeout=None):
+        loop = asyncio.get_running_loop()
+        pending = list(dict.fromkeys(query_ids))
+        delays = self.poll_delays()
+        deadline = None if timeout is None else loop.time() + timeout
+        started = time.perf_counter()
+        while len(pending) > 0:
+            responses = await asyncio.gather(*[self.status(q) for q in pending])
+            still_pending = []
+            for (query_id,response) in zip(pending,responses):
+                status = json.loads(response)
+                final_status = self.final_status(status)
+                if final_status is None:
+                    still_pending.append(query_id)
+                else:
+                    self.events.emit('query.finished',query_id=query_id,seconds=time.perf_counter() - started,status=final_status)
+                    self.record_status(query_id,final_status)
+                    if final_status == 'Failed':
+                        self.forget_failed(query_id,status)
+                    yield (query_id,final_status)
+            pending = still_pending
+            if len(pending) > 0:
+                delay = next(delays)
+                if deadline is not None and loop.time() + delay > deadline:
+                    raise TimeoutError("{} queries still running: {}".format(len(pending),pending))
+                await asyncio.sleep(delay)
+
+    async def as_completed(self,query_ids,timeout=None):
+        async for (query_id,final_status) in self.poll(query_ids,timeout):
+            yield query_id
+
+    async def wait_all(self,query_ids,timeout=None):
+        return {query_id: final_status async for (query_id,final_status) in self.poll(query_ids,timeout)}
+
+    # resume()
+    # as StreambatchConnection.resume(), but fetch is required and awaited: save_data() is sync only
+    async def resume(self,fetch,timeout=None):
+        if self.journal is None:
+            raise ValueError("resume() needs a journal: pass journal_path to the connection")
+        pending = [entry['query_id'] for entry in self.journal.entries(status='Submitted')]
+        async for (query_id,final_status) in self.poll(pending,timeout):
+            pass
+        results = {entry['query_id']: 'Failed' for entry in self.journal.entries(status='Failed')}
+        for entry in self.journal.entries(status='Succeeded'):
+            query_id = entry['query_id']
+            if entry['output'] is not None:
+                continue
+            try:
+                output = await fetch(query_id)
+            except Exception as e:
+                self.journal.update(query_id,error='{}: {}'.format(type(e).__name__,e))
+                results[query_id] = e
+                continue
+            if output is not None:
+                self.journal.update(query_id,output=str(output))
+            results[query_id] = output
+        return results
+
+    async def get_data(self,query_id,debug=False,workers=None,columns=None,locations=None,start=None,end=None,result_format='pandas'):
+        if result_format not in RESULT_FORMATS:
+            raise ValueError("result_format must be one of {}".format(RESULT_FORMATS))
+        with self.events.timed('fetch.done',query_id=query_id) as fields:
+            result = None
+            if await self.wait(query_id):
+                # the same steps as StreambatchConnection.get_data(): here download() returns a coroutine,
+                # and process() (smoothing, fan-out) runs on the connection's executor
+                (download,process) = self.result_stages(query_id,debug,workers,columns,locations,start,end,result_format)
+                raw = await download()
+                result = await self.run_blocking(process,raw)
+            fields['rows'] = self.result_rows(result)
+        return result
+
+    async def get_data_(self,query_id,columns=None,locations=None,start=None,end=None,result_format='pandas'):
+        if not await self.wait(query_id):
+            return None
+        return await self.read_finished(query_id,columns,locations,start,end,result_format)
+
+    async def read_finished(self,query_id,columns=None,locations=None,start=None,end=None,result_format='pandas'):
+        if result_format == 'pandas':
+            return await self.read_result(query_id,columns,locations,start,end)
+        table = await self.read_result(query_id,columns,locations,start,end,as_arrow=True)
+        if result_format == 'compact':
+            return compact_table(table).to_pandas()
+        return table
+
+    # wait()
+    # async version of StreambatchConnection.wait(), with the same events
+    async def wait(self,query_id):
+        delays = self.poll_delays()
+        polls = 0
+        started = time.perf_counter()
+        while True:
+            status = json.loads(await self.status(query_id))
+            polls += 1
+            final_status = self.check_wait(query_id,status,polls)
+            if final_status is not None:
+                return self.end_wait(query_id,status,final_status,polls,started)
+            await asyncio.sleep(next(delays))
+
+    async def partial_query(self,query_id):
+        if query_id not in sharded_qids:
+            raise ValueError("{} is not a composite (sharded) query".format(query_id))
+        return self.split_partial(query_id,json.loads(await self.status(query_id)))
@@ -0,0 +1,780 @@
+import math
+import numbers
+import random
+import time
+from datetime import datetime
+
+from .cache import RequestCache, ResultCache
+from .compact import compact_frame, compact_table
+from .dedupe import PointGroups, check_dedupe
+from .encoding import dumps
+from .events import Instruments, PrintInstrumentation
+from .journal import JobJournal
+from .lazy import LazyModule, is_loaded
+from .payload import encode_request
+
+# loaded on first use (see lazy.py)
+fsspec = LazyModule('fsspec')
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+pc = LazyModule('pyarrow.compute')
+pq = LazyModule('pyarrow.parquet')
+
+savgol_qids = [] # list of qids that requested savgol so that I can construct the final dataframe
+sharded_qids = {} # composite query id -> list of (shard query id, index offset) for requests that were split into shards
+deduped_qids = {} # query id -> PointGroups for requests that were sent with duplicate points merged
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504) # transient errors that are worth another try
+POST_RETRY_STATUS_CODES = (429, 503) # the subset that says the request was not accepted, so a POST can't have created a query
+RESULT_FORMATS = ('pandas', 'arrow', 'compact') # what get_data() can return
+JSON_HEADERS = {'Content-Type': 'application/json'}
+LON_LAT_COLUMNS = [('lon', 'lat'), ('lng', 'lat'), ('longitude', 'latitude'), ('x', 'y')] # column names validate_point_input() looks for in tables
+
+# is_retryable()
+# whether a response with status_code is worth sending method again
+def is_retryable(method,status_code):
+    return status_code in (RETRY_STATUS_CODES if method == 'GET' else POST_RETRY_STATUS_CODES)
+
+# ShardSubmitError
+# raised by request_ndvi() when some shards of a split request couldn't be submitted. submitted holds the
+# (query id, offset) of the shards that did go through, errors the (offset, exception) of those that didn't.
+# The submitted shards are also kept in the request cache (if there is one), so sending the same request
+# again only submits the missing shards
+class ShardSubmitError(ValueError):
+    def __init__(self,submitted,errors):
+        self.submitted = submitted
+        self.errors = errors
+        super().__init__("{} of {} shards could not be submitted: {}".format(len(errors),len(errors) + len(submitted),errors[0][1]))
+
+# ConnectionBase
+# what StreambatchConnection and AsyncStreambatchConnection share: configuration, validation and request
+# bodies, the request cache and journal, and everything that turns a status or a downloaded result into
+# what the caller gets. Nothing here does I/O with the API; the subclasses add that, blocking or awaitable.
+class ConnectionBase:
+    # pool_size bounds how many requests and reads of the connection run at the same time.
+    # GETs that fail with one of RETRY_STATUS_CODES (POSTs: POST_RETRY_STATUS_CODES) are retried up to max_retries times,
+    # waiting backoff_factor * 2**attempt seconds (with jitter, capped at backoff_max) in between.
+    # while waiting for queries, status is checked after poll_initial seconds, and each wait after that
+    # is poll_factor times longer than the previous one, up to poll_max seconds.
+    # requests with more than shard_size points/polygons are split into several queries (None: never split).
+    # set cache_dir to keep downloaded results on local disk (at most cache_max_bytes, least recently used go first).
+    # set request_cache_path to a sqlite file to reuse the query id of an identical earlier request instead of resubmitting it
+    # (see RequestCache for when entries go stale)
+    # set coordinate_precision to round coordinates to that many decimals (and drop the polygon vertices that makes redundant)
+    # and compress_requests to gzip request bodies (see payload.py)
+    # instrumentation receives timing and size events (see events.py); quiet=True turns off the console output
+    # set journal_path to a sqlite file to record every submitted query there (see journal.py and resume())
+    def __init__(self,api_key,use_test_api=False,pool_size=10,max_retries=3,backoff_factor=0.5,backoff_max=30,poll_initial=0.5,poll_factor=1.5,poll_max=30,shard_size=None,cache_dir=None,cache_max_bytes=10 * 2**30,request_cache_path=None,request_cache_ttl=7 * 24 * 3600,coordinate_precision=None,compress_requests=False,instrumentation=None,quiet=False,journal_path=None):
+        self.api_key = api_key
+        if instrumentation is None:
+            instrumentation = []
+        elif not isinstance(instrumentation,list):
+            instrumentation = [instrumentation]
+        self.events = Instruments(([] if quiet else [PrintInstrumentation()]) + instrumentation)
+        self.coordinate_precision = coordinate_precision
+        self.compress_requests = compress_requests
+        self.cache = None
+        if cache_dir is not None:
+            self.cache = ResultCache(cache_dir,cache_max_bytes,on_download=lambda url,seconds,size: self.events.emit('fetch.download',url=url,seconds=seconds,bytes=size))
+        self.request_cache = None
+        if request_cache_path is not None:
+            self.request_cache = RequestCache(request_cache_path,request_cache_ttl)
+        self.journal = None
+        self.journaled_groups = set()
+        if journal_path is not None:
+            self.journal = JobJournal(journal_path)
+            self.restore_journal()
+        self.shard_size = shard_size
+        self.pool_size = pool_size
+        self.poll_initial = poll_initial
+        self.poll_factor = poll_factor
+        self.poll_max = poll_max
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.session = None
+        self.http_stats = {'requests': 0, 'retries': 0, 'retry_wait': 0.0, 'failures': 0, 'payload_raw_bytes': 0, 'payload_sent_bytes': 0}
+        self.REQUEST_URL = "https://api.streambatch.io/async"
+        self.STATUS_URL = "https://api.streambatch.io/check"
+        self.READ_URL = "s3://streambatch-data"
+        if use_test_api:
+            self.events.emit('connection.test_api')
+            self.REQUEST_URL = "https://test.streambatch.io/async"
+            self.STATUS_URL = "https://test.streambatch.io/check"
+
+    # backoff_delay()
+    # seconds to wait before retry number attempt (0 based). A Retry-After header from the server wins
+    def backoff_delay(self,attempt,retry_after=None):
+        if retry_after is not None:
+            try:
+                return min(float(retry_after),self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_factor * (2 ** attempt),self.backoff_max)
+        # jitter so that many clients that failed together don't all come back at the same moment
+        return delay * (0.5 + random.random() / 2)
+
+    # connection_stats()
+    # request/retry counters and payload sizes
+    def connection_stats(self):
+        return dict(self.http_stats)
+
+    # encode_request()
+    # request body and headers for ndvi_request, optimized as configured on the connection
+    def encode_request(self,ndvi_request):
+        if self.coordinate_precision is None and not self.compress_requests:
+            return (dumps(ndvi_request),JSON_HEADERS)
+        (body,encoding,report) = encode_request(ndvi_request,self.coordinate_precision,self.compress_requests)
+        self.http_stats['payload_raw_bytes'] += report['raw']
+        self.http_stats['payload_sent_bytes'] += report['sent']
+        self.events.emit('request.payload',raw_bytes=report['raw'],sent_bytes=report['sent'])
+        headers = JSON_HEADERS if encoding is None else dict(JSON_HEADERS,**{'Content-Encoding': encoding})
+        return (body,headers)
+
+    def validate_polygon_input(self,polygons):
+        space = None # this will be set below
+        # a GeoJSON FeatureCollection is turned into the list of its geometries
+        if isinstance(polygons,dict) and polygons.get("type") == "FeatureCollection":
+            polygons = [feature.get("geometry") for feature in polygons.get("features",[])]
+        # polytons must either be a list or a dict. if it is not one of those, raise an error
+        if not isinstance(polygons,dict) and not isinstance(polygons,list):
+            raise ValueError("Polygons must be a list or a dict")
+        # if polygons is a list, it must be a list of dicts. if it is not, raise an error
+        if isinstance(polygons,list):
+            for polygon in polygons:
+                if not isinstance(polygon,dict):
+                    raise ValueError("Polygons must be a list of dicts")
+                # polygon must have two keys: "type" and "coordinates". if it does not, raise an error
+                if "type" not in polygon or "coordinates" not in polygon:
+                    raise ValueError("Each polygon must have a 'type' and 'coordinates' key")
+            space = polygons
+        # if polygons is a dict, it must have, each value must be a dics. if it is not, raise an error
+        if isinstance(polygons,dict):
+            for key,value in polygons.items():
+                if not isinstance(value,dict):
+                    raise ValueError("Polygons must be a dict where the key is an id and value is a polygon")
+                # each value must have two keys: "type" and "coordinates". if it does not, raise an error
+                if "type" not in value or "coordinates" not in value:
+                    raise ValueError("Each polygon must have a 'type' and 'coordinates' key")
+            # space is the iist of values from the dict
+            space = list(polygons.values())
+        return space
+
+    def validate_souces_input(self,sources):
+        # if sources is None, then set it to a list containing one element, ndvi.streambatch
+        if sources is None:
+            sources = ["ndvi.streambatch_v2"]
+        else:
+            # if sources is not None, then it must be a list. if it is not, raise an error
+            if not isinstance(sources,list):
+                raise ValueError("sources must be a list")
+            # if sources is not None, then it must be a list of strings. if it is not, raise an error
+            valid_sources = ["ndvi.streambatch", 'ndvi.streambatch_v2', "ndvi.sentinel2","ndvi.modis","ndvi.landsat"]
+            for s in sources:
+                if not isinstance(s,str):
+                    raise ValueError("sources must be a list of strings")
+                # if sources is not a valid sources, raise an error
+                if s not in valid_sources:
+                    raise ValueError("Unknown source: {}. sources must be one of the following: {}".format(s,valid_sources))
+        return sources
+
+    # validate_point_input()
+    # points can be
+    # - a list of [longitude, latitude] lists
+    # - a list of GeoJSON points or a GeoJSON FeatureCollection of points
+    # - an (N, 2) numpy array of longitude, latitude
+    # - a pandas DataFrame or pyarrow Table with longitude/latitude columns (see LON_LAT_COLUMNS)
+    # Lists come back as lists of [longitude, latitude]; everything else as an (N, 2) float array, which is
+    # sent as is (no per-point python objects). Shape, finiteness and bounds are checked on the whole array at once
+    def validate_point_input(self,points):
+        if isinstance(points,dict) and points.get("type") == "FeatureCollection":
+            points = [feature.get("geometry") for feature in points.get("features",[])]
+        if (is_loaded('pandas') and isinstance(points,pd.DataFrame)) or (is_loaded('pyarrow') and isinstance(points,pa.Table)):
+            points = self.table_points(points)
+        if is_loaded('numpy') and isinstance(points,np.ndarray):
+            self.check_points(points)
+            return np.ascontiguousarray(points,dtype=np.float64)
+        # points must be a list of lists. if it is not, raise an error
+        if not isinstance(points,list):
+            raise ValueError("Points must be a list")
+        if len(points) > 0 and isinstance(points[0],dict):
+            for point in points:
+                if not isinstance(point,dict) or point.get("type") != "Point" or "coordinates" not in point:
+                    raise ValueError("Points must be a list of lists or of GeoJSON points")
+            points = [list(point["coordinates"]) for point in points]
+        # plain python lists are checked without numpy, so that submitting a request never has to import it
+        for (i,point) in enumerate(points):
+            if not isinstance(point,list):
+                raise ValueError("Points must be a list of lists")
+            if len(point) != 2:
+                raise ValueError("Each point must have two values: longitude and latitude")
+            if not all(isinstance(v,numbers.Real) for v in point):
+                raise ValueError("Each point must have two numbers: longitude and latitude")
+            (lon,lat) = point
+            if not (math.isfinite(lon) and math.isfinite(lat)) or abs(lon) > 180 or abs(lat) > 90:
+                raise ValueError("Point {} is not a valid longitude, latitude: {}".format(i,[float(lon),float(lat)]))
+        return points
+
+    # check_points()
+    # shape, finiteness and longitude/latitude bounds of an (N, 2) array of points
+    def check_points(self,array):
+        if array.ndim != 2 or array.shape[1] != 2:
+            raise ValueError("Points must have shape (N, 2): longitude and latitude, got {}".format(array.shape))
+        if not np.issubdtype(array.dtype,np.number):
+            raise ValueError("Points must be numbers")
+        bad = ~np.isfinite(array).all(axis=1)
+        bad |= (np.abs(array[:,0]) > 180) | (np.abs(array[:,1]) > 90)
+        if bad.any():
+            i = int(np.flatnonzero(bad)[0])
+            raise ValueError("Point {} is not a valid longitude, latitude: {}".format(i,array[i].tolist()))
+
+    # table_points()
+    # the longitude/latitude columns of a pandas DataFrame or pyarrow Table as an (N, 2) array
+    def table_points(self,table):
+        names = list(table.columns) if isinstance(table,pd.DataFrame) else table.column_names
+        lower = {str(name).lower(): name for name in names}
+        for (lon,lat) in LON_LAT_COLUMNS:
+            if lon in lower and lat in lower:
+                columns = [lower[lon],lower[lat]]
+                break
+        else:
+            if len(names) != 2:
+                raise ValueError("Can't find the longitude/latitude columns; name them one of {}".format(LON_LAT_COLUMNS))
+            columns = names
+        if isinstance(table,pd.DataFrame):
+            return table[columns].to_numpy(dtype=np.float64)
+        return np.column_stack([table.column(c).to_numpy().astype(np.float64) for c in columns])
+
+    # ndvi_arguments()
+    # the arguments of request_ndvi_() for what was passed to request_ndvi(): ndvi.savgol is requested as
+    # sentinel2 + landsat and smoothed on the client, and dedupe sends only the unique points
+    def ndvi_arguments(self,polygons,points,location_ids,sources,dedupe):
+        if sources is None:
+            sources = ["ndvi.streambatch_v2"]
+        groups = None
+        if dedupe is not None:
+            (points,location_ids,groups) = self.dedupe_points(points,polygons,location_ids,dedupe,sources)
+        if sources == ['ndvi.savgol']:
+            return {'sources': ['ndvi.sentinel2','ndvi.landsat'], 'polygons': polygons, 'points': points, 'location_ids': location_ids, 'postprocess': 'savgol', 'groups': groups}
+        return {'sources': sources, 'polygons': polygons, 'points': points, 'location_ids': location_ids, 'postprocess': None, 'groups': groups}
+
+    # dedupe_points()
+    # the unique points to send (and no location_ids: they are added back by get_data()) plus the PointGroups to fan the result out with
+    def dedupe_points(self,points,polygons,location_ids,dedupe,sources):
+        if polygons is not None or points is None:
+            raise ValueError("dedupe only applies to points")
+        check_dedupe(dedupe,sources)
+        points = np.asarray(self.validate_point_input(points),dtype=np.float64)
+        if location_ids is not None:
+            self.validate_location_ids(location_ids,len(points))
+        groups = PointGroups.build(points,dedupe,location_ids)
+        self.events.emit('request.dedupe',points=groups.points,unique=groups.unique,ratio=groups.ratio)
+        return (points[groups.first],None,groups)
+
+    # prepare_request()
+    # the first half of request_ndvi_(): returns the request body, its shards (see split_request()) and the
+    # query id to use without submitting anything (query_id itself, or that of an identical cached request), or None
+    def prepare_request(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None,shard_size=None,postprocess=None,groups=None):
+        with self.events.timed('request.build',polygons=polygons is not None) as fields:
+            ndvi_request = self.build_ndvi_request(polygons=polygons,points=points,location_ids=location_ids,aggregation=aggregation,start_date=start_date,end_date=end_date,sources=sources)
+            fields['locations'] = len(ndvi_request['space'])
+        shards = self.split_request(ndvi_request,shard_size)
+        if query_id is None:
+            query_id = self.lookup_request(ndvi_request,postprocess,groups)
+        return (ndvi_request,shards,query_id)
+
+    # finish_request()
+    # the end of request_ndvi_(): registers the query and reports it
+    def finish_request(self,query_id,ndvi_request,postprocess,groups,is_polygons,shards,started):
+        self.register_query(query_id,ndvi_request,postprocess,groups)
+        self.report_request(query_id,ndvi_request,is_polygons,shards,time.perf_counter() - started)
+        return query_id
+
+    # build_ndvi_request()
+    # validates the arguments of request_ndvi_() and returns the body that is posted to the API
+    def build_ndvi_request(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None):
+        sources = self.validate_souces_input(sources)
+
+        # you must set either polygons or points but not both
+        if polygons is None and points is None:
+            raise ValueError("You must set either polygons or points")
+        if polygons is not None and points is not None:
+            raise ValueError("You must set either polygons or points but not both")
+
+        space = None # this will be set below 
+        if polygons is not None:
+            space = self.validate_polygon_input(polygons)
+
+        elif points is not None:
+            space = self.validate_point_input(points)
+        else:
+            raise ValueError("You must set either polygons or points")
+
+        # aggregation must be either "mean" or "median". if it is not, raise an error
+        if aggregation not in ["mean","median"]:
+            raise ValueError("Aggregation must be either 'mean' or 'median'")
+        
+        # if start_date is None, then set it to 2013-01-01
+        if start_date is None:
+            start_date = datetime(2013,1,1)
+        else:
+            # if start_date is not None, then it must be a datetime object. if it is not, raise an error
+            if not isinstance(start_date,datetime):
+                # if it is a string, convert it to a datetime object
+                if isinstance(start_date,str):
+                    start_date = datetime.strptime(start_date,"%Y-%m-%d")
+                else:
+                    raise ValueError("start_date must be a a string yyyy-mm-dd or a datetime object")
+        
+        # if end_date is None, then set it to today
+        if end_date is None:
+            end_date = datetime.now()
+        else:
+            if not isinstance(end_date,datetime):
+                # if it is a string, convert it to a datetime object
+                if isinstance(end_date,str):
+                    end_date = datetime.strptime(end_date,"%Y-%m-%d")
+                else:
+                    raise ValueError("end_date must be a datetime object")
+            
+        # if end_date is before start_date, raise an error
+        if end_date < start_date:
+            raise ValueError("end_date must be after start_date")
+
+        t = {'start': start_date.strftime("%Y-%m-%d"), 'end': end_date.strftime("%Y-%m-%d"), 'unit': 'day'}
+        
+        if location_ids is None:
+            ndvi_request = {'variable': sources, 'space': space, 'time': t, 'aggregation': aggregation}
+        else:
+            self.validate_location_ids(location_ids,len(space))
+            ndvi_request = {'variable': sources, 'space': space, 'time': t, 'aggregation': aggregation, 'location_id': location_ids}
+        return ndvi_request
+
+    # validate_location_ids()
+    # location_ids must be a list of count unique strings
+    def validate_location_ids(self,location_ids,count):
+        # location_ids must be a list of strings. if it is not, raise an error
+        if not isinstance(location_ids,list):
+            raise ValueError("location_ids must be a list")
+        for location_id in location_ids:
+            if not isinstance(location_id,str):
+                raise ValueError("location_ids must be a list of strings")
+        # location_ids must be list of the same length as space. if it is not, raise an error
+        if len(location_ids) != count:
+            raise ValueError("location_ids must be a list of the same length as space")
+        # each item in location_ids must be unique. if it is not, raise an error
+        if len(location_ids) != len(set(location_ids)):
+            raise ValueError("location_ids must be a list of unique values")
+
+    # lookup_request()
+    # returns the query id of an identical earlier request from the request cache, or None.
+    # a deduped request only matches one with the same point groups
+    def lookup_request(self,ndvi_request,postprocess=None,groups=None):
+        if self.request_cache is None:
+            return None
+        cached = self.request_cache.get(ndvi_request,postprocess,None if groups is None else groups.digest())
+        if cached is None:
+            return None
+        if 'shards' in cached:
+            sharded_qids[cached['query_id']] = [tuple(shard) for shard in cached['shards']]
+        self.events.emit('request.cached',query_id=cached['query_id'])
+        return cached['query_id']
+
+    def remember_request(self,ndvi_request,query_id,postprocess=None,groups=None):
+        if self.request_cache is None:
+            return
+        dedupe = None if groups is None else groups.digest()
+        if query_id in sharded_qids:
+            self.request_cache.put(ndvi_request,query_id,postprocess,dedupe,shards=sharded_qids[query_id])
+        else:
+            self.request_cache.put(ndvi_request,query_id,postprocess,dedupe)
+
+    # split_request()
+    # splits ndvi_request into requests of at most shard_size locations each.
+    # returns a list of (request, offset) where offset is the index of the shard's first location in the full request
+    def split_request(self,ndvi_request,shard_size=None):
+        if shard_size is None:
+            shard_size = self.shard_size
+        n = len(ndvi_request['space'])
+        if shard_size is None or n <= shard_size:
+            return [(ndvi_request,0)]
+        if shard_size < 1:
+            raise ValueError("shard_size must be at least 1")
+        shards = []
+        for offset in range(0,n,shard_size):
+            shard = dict(ndvi_request,space=ndvi_request['space'][offset:offset+shard_size])
+            if 'location_id' in ndvi_request:
+                shard['location_id'] = ndvi_request['location_id'][offset:offset+shard_size]
+            shards.append((shard,offset))
+        return shards
+
+    # register_shards()
+    # records the shards of a split request and returns the composite query id that stands for all of them
+    def register_shards(self,shards):
+        query_id = "+".join([qid for (qid,offset) in shards])
+        sharded_qids[query_id] = shards
+        return query_id
+
+    # register_query()
+    # remembers what it takes to read the result of a submitted query: in memory, and in the journal if there is one.
+    # the point groups of a query id can't change: get_data() would fan out an earlier request's result wrongly
+    def register_query(self,query_id,ndvi_request,postprocess=None,groups=None):
+        if groups is not None:
+            known = self.point_groups(query_id)
+            if known is not None and known.digest() != groups.digest():
+                raise ValueError("query {} is already registered with different dedupe groups".format(query_id))
+            deduped_qids[query_id] = groups
+        if self.journal is not None:
+            self.journal.record(query_id,ndvi_request,postprocess,sharded_qids.get(query_id),groups)
+
+    # restore_journal()
+    # registers the savgol, shard and dedupe information of every journaled query, so that get_data()
+    # reads queries submitted before a restart the same way as new ones. Dedupe groups are only noted here
+    # and loaded by point_groups() when a result is read, so that starting up doesn't import numpy
+    def restore_journal(self):
+        for entry in self.journal.entries(load_groups=False):
+            query_id = entry['query_id']
+            if entry['postprocess'] == 'savgol' and query_id not in savgol_qids:
+                savgol_qids.append(query_id)
+            if entry['shards'] is not None:
+                sharded_qids[query_id] = entry['shards']
+            if entry['deduped'] and query_id not in deduped_qids:
+                self.journaled_groups.add(query_id)
+
+    # point_groups()
+    # the PointGroups of a deduped query, or None. Those of journaled queries are read from the journal on first use
+    def point_groups(self,query_id):
+        if query_id in self.journaled_groups:
+            self.journaled_groups.discard(query_id)
+            if query_id not in deduped_qids:
+                deduped_qids[query_id] = self.journal.groups(query_id)
+        return deduped_qids.get(query_id)
+
+    # record_status()
+    # notes the final status of a query in the journal
+    def record_status(self,query_id,final_status):
+        if self.journal is not None and final_status is not None:
+            self.journal.update(query_id,status=final_status)
+
+    # report_request()
+    # emits request.done for a submitted (or reused) request; seconds covers validation through submission
+    def report_request(self,query_id,ndvi_request,is_polygons,shards,seconds):
+        self.events.emit('request.done',query_id=query_id,seconds=seconds,locations=len(ndvi_request['space']),polygons=is_polygons,shards=shards,
+                         start=ndvi_request['time']['start'],end=ndvi_request['time']['end'],aggregation=ndvi_request['aggregation'])
+
+    # result_rows()
+    # row count of a get_data() result of any result_format (0 for a failed query)
+    def result_rows(self,result):
+        if result is None:
+            return 0
+        return result.num_rows if isinstance(result,pa.Table) else len(result)
+
+    # result_stages()
+    # how to read a finished query, split in two steps: download() reads what is needed from the server
+    # (columns, locations and dates pushed down where possible) and process(raw) does the work in memory:
+    # savgol smoothing, the fan-out of deduped queries and the conversion to result_format.
+    # get_data() runs them back to back; fetch_many() runs them in separate stages
+    def result_stages(self,query_id,debug,workers,columns,locations,start,end,result_format):
+        groups = self.point_groups(query_id)
+        keep = None
+        read_columns = columns
+        read_format = result_format
+        if groups is not None:
+            # read the unique points as arrow, fan them out, then convert
+            (locations,keep) = groups.selection(locations)
+            read_columns = self.dedupe_columns(columns)
+            read_format = 'arrow'
+        savgol = query_id in savgol_qids
+        def download():
+            if savgol:
+                # smoothing needs the full series of every location and works on pandas; the compact
+                # representation goes through it as is
+                return self.read_finished(query_id,locations=locations,result_format='compact' if read_format == 'compact' else 'pandas')
+            return self.read_finished(query_id,read_columns,locations,start,end,read_format)
+        def process(raw):
+            result = raw
+            if savgol:
+                df = self.postprocess_savgol(raw,debug,workers)
+                result = self.format_frame(self.select(df,read_columns,start,end),read_format)
+            if groups is not None:
+                table = groups.fan_out(result,keep)
+                if columns is not None:
+                    table = table.select(columns)
+                result = self.format_table(table,result_format)
+            return result
+        return (download,process)
+
+    # dedupe_columns()
+    # the columns to read for a deduped query: location_id is added by the fan-out, which needs the point column
+    def dedupe_columns(self,columns):
+        if columns is None:
+            return None
+        columns = [c for c in columns if c != 'location_id']
+        if 'point' not in columns:
+            columns.append('point')
+        return columns
+
+    # format_table()
+    # converts a pyarrow result to result_format
+    def format_table(self,table,result_format):
+        if result_format == 'arrow':
+            return table
+        if result_format == 'compact':
+            return compact_table(table).to_pandas()
+        return table.to_pandas()
+
+    # format_frame()
+    # converts a pandas result to result_format
+    def format_frame(self,df,result_format):
+        if df is None or result_format == 'pandas':
+            return df
+        if result_format == 'compact':
+            return compact_frame(df)
+        return pa.Table.from_pandas(df,preserve_index=False)
+
+    # select()
+    # applies the columns/start/end filters of get_data() to a frame that is already in memory
+    def select(self,df,columns=None,start=None,end=None):
+        if df is None:
+            return None
+        if start is not None:
+            df = df[df['time'] >= pd.Timestamp(start)]
+        if end is not None:
+            df = df[df['time'] <= pd.Timestamp(end)]
+        if columns is not None:
+            df = df[columns]
+        return df.reset_index(drop=True)
+
+    # postprocess_savgol()
+    # turns the raw sentinel2 + landsat result of a savgol query into the smoothed series
+    def postprocess_savgol(self,df,debug=False,workers=None):
+        if df is None:
+            return None
+        from .savgol import savgol
+        with self.events.timed('fetch.savgol') as fields:
+            df = savgol(df,workers=workers)
+            fields['rows'] = len(df)
+            fields['locations'] = df['point' if 'point' in df.columns else 'location'].nunique()
+        if( debug == True ):
+            return df
+        else:
+            # drop columns ndvi.sentinel2 and ndvi.landsat and ndvi.interpolated
+            df = df.drop(columns=['ndvi.sentinel2','ndvi.landsat','ndvi.interpolated'])
+            # rename column ndvi.savgol to ndvi
+            df = df.rename(columns={"ndvi.savgol":"ndvi"})
+            return df
+
+    # load_parquet()
+    # reads the parquet result at access_url into a DataFrame; columns and filters (pyarrow filter tuples)
+    # are pushed down into the read. Blocking: the connections call it through read_parquet()
+    def load_parquet(self,access_url,columns=None,filters=None):
+        with self.events.timed('fetch.read',url=access_url) as fields:
+            path = self.cached_path(access_url,columns is None and filters is None)
+            if path is not None:
+                df = pq.read_table(path,columns=columns,filters=filters,memory_map=True).to_pandas()
+            # storage_options only apply to s3 urls; READ_URL can also be a local directory (e.g. for tests)
+            elif access_url.startswith("s3://"):
+                df = pd.read_parquet(access_url, columns=columns, filters=filters, storage_options={"anon": True})
+            else:
+                df = pd.read_parquet(access_url, columns=columns, filters=filters)
+            fields['rows'] = len(df)
+            fields['bytes'] = int(df.memory_usage(index=False).sum())
+        return df
+
+    # cached_path()
+    # the local copy of access_url in the result cache, or None to read it from the server. A read of the
+    # whole file downloads it into the cache first; a partial one (some columns, row groups or just the
+    # footer) uses the cached copy if there is one and otherwise reads only the byte ranges it needs
+    # from the server, leaving the cache as it is
+    def cached_path(self,access_url,whole):
+        if self.cache is None:
+            return None
+        if whole:
+            return self.cache.fetch(access_url)
+        return self.cache.local(access_url)
+
+    # load_table()
+    # same as load_parquet(), but returns the pyarrow Table without converting it to pandas
+    def load_table(self,access_url,columns=None,filters=None):
+        with self.events.timed('fetch.read',url=access_url) as fields:
+            path = self.cached_path(access_url,columns is None and filters is None)
+            if path is not None:
+                table = pq.read_table(path,columns=columns,filters=filters,memory_map=True)
+            elif access_url.startswith("s3://"):
+                table = pq.read_table(access_url[len("s3://"):],columns=columns,filters=filters,filesystem=fsspec.filesystem("s3",anon=True))
+            else:
+                table = pq.read_table(access_url,columns=columns,filters=filters)
+            fields['rows'] = table.num_rows
+            fields['bytes'] = table.nbytes
+        return table
+
+    # do this step in as a separate function so that I can mock it in the tests
+    # returns the column names of the result, reading only the parquet footer
+    def read_schema(self,access_url):
+        pf = self.open_parquet(access_url,whole=False)
+        try:
+            return pf.schema_arrow.names
+        finally:
+            pf.close(force=True)
+
+    # build_filters()
+    # the pyarrow filters for get_data(locations=..., start=..., end=...) on the result at access_url.
+    # integer locations select by point/location index, strings by location id
+    def build_filters(self,access_url,locations=None,start=None,end=None):
+        filters = []
+        if locations is not None:
+            locations = list(locations)
+            names = self.read_schema(access_url)
+            if all(isinstance(l,str) for l in locations):
+                candidates = ['location_id']
+            elif all(isinstance(l,numbers.Integral) for l in locations):
+                candidates = ['point','location']
+                locations = [int(l) for l in locations]
+            else:
+                raise ValueError("locations must be a list of point/location indices or a list of location ids")
+            col = next((c for c in candidates if c in names),None)
+            if col is None:
+                raise ValueError("The result has no {} column to select locations by".format(" or ".join(candidates)))
+            filters.append((col,'in',locations))
+        if start is not None:
+            filters.append(('time','>=',pd.Timestamp(start)))
+        if end is not None:
+            filters.append(('time','<=',pd.Timestamp(end)))
+        if len(filters) == 0:
+            return None
+        return filters
+
+    # merge_shard_statuses()
+    # the status of a composite query from the parsed statuses of its shards
+    def merge_shard_statuses(self,shard_ids,statuses):
+        finals = [self.final_status(st) for st in statuses]
+        failed = [qid for (qid,final) in zip(shard_ids,finals) if final == 'Failed']
+        if None in finals:
+            return {'status': 'Running', 'failed_shards': failed}
+        if len(failed) > 0:
+            first = statuses[finals.index('Failed')]
+            return dict(first,status='Failed',failed_shards=failed)
+        return {'status': 'Succeeded', 'failed_shards': []}
+
+    # split_partial()
+    # the body of partial_query(), given the parsed status of the composite query
+    def split_partial(self,query_id,status):
+        if status['status'] == 'Running':
+            raise ValueError("query {} is still running".format(query_id))
+        failed_ids = set(status['failed_shards'])
+        shards = sharded_qids[query_id]
+        failed = [(qid,offset) for (qid,offset) in shards if qid in failed_ids]
+        succeeded = [(qid,offset) for (qid,offset) in shards if qid not in failed_ids]
+        if len(succeeded) == 0:
+            return (None,failed)
+        if len(failed) == 0:
+            return (query_id,[])
+        partial_id = "+".join([qid for (qid,offset) in succeeded]) + "+partial"
+        sharded_qids[partial_id] = succeeded
+        if query_id in savgol_qids and partial_id not in savgol_qids:
+            savgol_qids.append(partial_id)
+        groups = self.point_groups(query_id)
+        if groups is not None:
+            deduped_qids[partial_id] = groups
+        return (partial_id,failed)
+
+    # plan_reads()
+    # the parquet files that make up the result of query_id, as a list of (url, locations, offset).
+    # For a composite query, integer locations are translated to each shard's own index, and shards
+    # that hold none of the requested locations are skipped
+    def plan_reads(self,query_id,locations=None):
+        if query_id not in sharded_qids:
+            return [(f'{self.READ_URL}/{query_id}.parquet',locations,0)]
+        shards = sharded_qids[query_id]
+        reads = []
+        for (i,(qid,offset)) in enumerate(shards):
+            shard_locations = locations
+            if locations is not None and all(isinstance(l,numbers.Integral) for l in locations):
+                end = shards[i+1][1] if i + 1 < len(shards) else float('inf')
+                shard_locations = [l - offset for l in locations if offset <= l < end]
+                if len(shard_locations) == 0:
+                    continue
+            reads.append((f'{self.READ_URL}/{qid}.parquet',shard_locations,offset))
+        if len(reads) == 0:
+            # nothing matches; still read one (empty) selection so the result has the right columns
+            (qid,offset) = shards[0]
+            reads.append((f'{self.READ_URL}/{qid}.parquet',[],offset))
+        return reads
+
+    def merge_shards(self,frames,offsets):
+        for (df,offset) in zip(frames,offsets):
+            for col in ['point','location']:
+                if col in df.columns:
+                    df[col] = df[col] + offset
+        return pd.concat(frames,ignore_index=True)
+
+    def merge_tables(self,tables,offsets):
+        tables = [pa.Table.from_batches([self.shift_batch(b,offset) for b in table.to_batches()],schema=table.schema) for (table,offset) in zip(tables,offsets)]
+        return pa.concat_tables(tables)
+
+    # check_wait()
+    # one status check of wait() (shared with the async connection): reports it and returns the final status or None
+    def check_wait(self,query_id,status,polls):
+        final_status = self.final_status(status)
+        self.events.emit('query.poll',query_id=query_id,polls=polls,status=final_status)
+        return final_status
+
+    # end_wait()
+    # the end of wait() (shared with the async connection): reports and records the outcome, returns True if the query succeeded
+    def end_wait(self,query_id,status,final_status,polls,started):
+        self.events.emit('query.wait',query_id=query_id,seconds=time.perf_counter() - started,polls=polls,status=final_status)
+        self.record_status(query_id,final_status)
+        if final_status == 'Failed':
+            self.events.emit('query.failed',query_id=query_id,error=status)
+            self.forget_failed(query_id,status)
+            return False
+        return True
+
+    # do this step in as a separate function so that I can mock it in the tests
+    # returns a pyarrow ParquetFile that reads access_url lazily. whole=False for callers that only read
+    # part of the file (e.g. the footer), which then don't download it into the cache
+    def open_parquet(self,access_url,whole=True):
+        path = self.cached_path(access_url,whole)
+        if path is not None:
+            return pq.ParquetFile(path,memory_map=True)
+        if access_url.startswith("s3://"):
+            return pq.ParquetFile(fsspec.open(access_url,"rb",anon=True).open())
+        return pq.ParquetFile(access_url)
+
+    # shift_batch()
+    # moves the point/location index of a shard's record batch to its position in the full request
+    def shift_batch(self,batch,offset):
+        arrays = list(batch.columns)
+        for col in ['point','location']:
+            i = batch.schema.get_field_index(col)
+            if i >= 0:
+                arrays[i] = pc.add(arrays[i],pa.scalar(offset,type=arrays[i].type))
+        return pa.RecordBatch.from_arrays(arrays,schema=batch.schema)
+
+    # forget_failed()
+    # status is the parsed status of a failed query: don't hand out that query, or the shards of it that
+    # failed, again for the same request
+    def forget_failed(self,query_id,status):
+        if self.request_cache is None:
+            return
+        for qid in [query_id] + status.get('failed_shards',[]):
+            self.request_cache.forget(qid)
+
+    # final_status()
+    # status is the parsed response of status(). returns 'Succeeded' or 'Failed', or None while the query is still running
+    def final_status(self,status):
+        if status['status'] == 'Succeeded':
+            return 'Succeeded'
+        elif status['status'] == 'Failed':
+            return 'Failed'
+        else:
+            return None
+
+    # poll_delays()
+    # the polling schedule: starts fast so that small queries come back quickly, then backs off
+    def poll_delays(self):
+        delay = self.poll_initial
+        while True:
+            yield delay
+            delay = min(delay * self.poll_factor,self.poll_max)
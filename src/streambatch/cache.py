@@ -0,0 +1,221 @@
+from datetime import datetime
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+
+from .encoding import to_json_type
+from .lazy import LazyModule
+
+fsspec = LazyModule('fsspec')
+pq = LazyModule('pyarrow.parquet')
+
+# ResultCache
+# on-disk cache of downloaded query results. A finished query's parquet never changes, so it is
+# stored under its query id and served from local disk from then on. When the files add up to more
+# than max_bytes, the least recently used ones are deleted.
+# on_download(url, seconds, bytes) is called after every download
+class ResultCache:
+    def __init__(self,directory,max_bytes=10 * 2**30,on_download=None):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.on_download = on_download
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(self.directory,exist_ok=True)
+
+    def path(self,key):
+        return os.path.join(self.directory,key)
+
+    # get()
+    # returns the local path of key, or None if it isn't cached
+    def get(self,key):
+        path = self.path(key)
+        with self.lock:
+            if not os.path.exists(path):
+                self.misses += 1
+                return None
+            self.hits += 1
+            # the modification time doubles as the last-used time for the LRU eviction
+            os.utime(path)
+        return path
+
+    # local()
+    # returns the local path of the cached copy of url, or None if it isn't cached (nothing is downloaded)
+    def local(self,url):
+        return self.get(os.path.basename(url))
+
+    # fetch()
+    # returns the local path of the cached copy of url, downloading it first on a miss
+    def fetch(self,url):
+        key = os.path.basename(url)
+        path = self.get(key)
+        if path is not None:
+            return path
+        storage_options = {"anon": True} if url.startswith("s3://") else {}
+        # download into a temp file and rename, so a crash never leaves half a file in the cache
+        (fd,tmp) = tempfile.mkstemp(dir=self.directory,suffix=".part")
+        started = time.perf_counter()
+        try:
+            with fsspec.open(url,"rb",**storage_options) as src, os.fdopen(fd,"wb") as dst:
+                shutil.copyfileobj(src,dst,1 << 20)
+            os.replace(tmp,self.path(key))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        if self.on_download is not None:
+            self.on_download(url,time.perf_counter() - started,os.path.getsize(self.path(key)))
+        self.evict(keep=key)
+        return self.path(key)
+
+    # read()
+    # reads url through the cache. the local file is memory mapped, so arrow reads it without an extra copy
+    def read(self,url,columns=None,filters=None):
+        return pq.read_table(self.fetch(url),columns=columns,filters=filters,memory_map=True)
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".part"):
+                continue
+            try:
+                st = os.stat(self.path(name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime,st.st_size,name))
+        return entries
+
+    # evict()
+    # deletes least recently used files until the cache fits in max_bytes. keep is never deleted
+    def evict(self,keep=None):
+        with self.lock:
+            entries = sorted(self.entries())
+            total = sum([size for (mtime,size,name) in entries])
+            for (mtime,size,name) in entries:
+                if total <= self.max_bytes:
+                    break
+                if name == keep:
+                    continue
+                os.remove(self.path(name))
+                total -= size
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            for (mtime,size,name) in self.entries():
+                os.remove(self.path(name))
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'files': len(entries), 'bytes': sum([size for (mtime,size,name) in entries])}
+
+# RequestCache
+# remembers which query id answered which request, so that sending the same request again returns
+# the existing query instead of making the server redo the work. Requests are keyed by a hash of the
+# normalized request body (after validation and date handling), and the table is kept in a sqlite file.
+# Every get/put is one indexed lookup or insert, and several processes can share the file: each write is
+# its own transaction, so nobody's entries are lost. (A json file from earlier versions is imported on open.)
+#
+# Entries expire after ttl seconds. A request whose end date is today or later is "open ended": the
+# server may still add observations for it, so those entries only live for open_ended_ttl seconds.
+# (end_date=None resolves to today's date, so such entries also stop matching at midnight.)
+REQUEST_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    key TEXT PRIMARY KEY,
+    query_id TEXT NOT NULL,
+    created REAL NOT NULL,
+    expires REAL NOT NULL,
+    extra TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS requests_query_id ON requests (query_id);
+CREATE INDEX IF NOT EXISTS requests_expires ON requests (expires);
+"""
+
+class RequestCache:
+    def __init__(self,path,ttl=7 * 24 * 3600,open_ended_ttl=3600):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.open_ended_ttl = open_ended_ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),exist_ok=True)
+        old = self.read_json()
+        self.db = sqlite3.connect(self.path,check_same_thread=False,isolation_level=None,timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(REQUEST_SCHEMA)
+        if len(old) > 0:
+            self.db.executemany("INSERT OR REPLACE INTO requests VALUES (?,?,?,?,?)",[self.row(k,entry) for (k,entry) in old.items()])
+
+    # read_json()
+    # the entries of a cache file written by earlier versions (a json object), which is removed so that
+    # the sqlite table can take its place; {} for a new or sqlite file
+    def read_json(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path,"rb") as f:
+            if f.read(1) != b"{":
+                return {}
+            f.seek(0)
+            entries = json.load(f)
+        os.remove(self.path)
+        return entries
+
+    def row(self,key,entry):
+        extra = {k: v for (k,v) in entry.items() if k not in ('query_id','created','expires')}
+        return (key,entry['query_id'],entry['created'],entry['expires'],json.dumps(extra))
+
+    def close(self):
+        self.db.close()
+
+    # key()
+    # canonical hash of the request: key order and whitespace don't matter. dedupe is the digest of the
+    # PointGroups of a deduped request (see dedupe.py). Always the standard json module, never orjson:
+    # the two write some floats and non-ASCII text differently, and the key must not depend on which
+    # one is installed
+    def key(self,ndvi_request,postprocess=None,dedupe=None):
+        body = {'request': ndvi_request, 'postprocess': postprocess}
+        if dedupe is not None:
+            body['dedupe'] = dedupe
+        body = json.dumps(body,sort_keys=True,separators=(',',':'),default=to_json_type)
+        return hashlib.sha256(body.encode()).hexdigest()
+
+    def is_open_ended(self,ndvi_request):
+        return ndvi_request['time']['end'] >= datetime.now().strftime("%Y-%m-%d")
+
+    # get()
+    # returns the cached entry for the request (a dict with at least 'query_id'), or None
+    def get(self,ndvi_request,postprocess=None,dedupe=None):
+        key = self.key(ndvi_request,postprocess,dedupe)
+        with self.lock:
+            row = self.db.execute("SELECT query_id, created, expires, extra FROM requests WHERE key = ? AND expires >= ?",(key,time.time())).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return dict(json.loads(row[3]),query_id=row[0],created=row[1],expires=row[2])
+
+    def put(self,ndvi_request,query_id,postprocess=None,dedupe=None,**extra):
+        ttl = self.open_ended_ttl if self.is_open_ended(ndvi_request) else self.ttl
+        entry = dict(extra,query_id=query_id,created=time.time(),expires=time.time() + ttl)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO requests VALUES (?,?,?,?,?)",self.row(self.key(ndvi_request,postprocess,dedupe),entry))
+            self.db.execute("DELETE FROM requests WHERE expires < ?",(time.time(),))
+
+    # forget()
+    # drops every entry that points at query_id (e.g. because that query failed)
+    def forget(self,query_id):
+        with self.lock:
+            self.db.execute("DELETE FROM requests WHERE query_id = ?",(query_id,))
+
+    def stats(self):
+        with self.lock:
+            (entries,) = self.db.execute("SELECT COUNT(*) FROM requests WHERE expires >= ?",(time.time(),)).fetchone()
+        return {'hits': self.hits, 'misses': self.misses, 'entries': entries}
@@ -0,0 +1,76 @@
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pa = LazyModule('pyarrow')
+pc = LazyModule('pyarrow.compute')
+
+# Location chunks of a parquet result, for processing results that don't fit in memory (see
+# StreambatchConnection.save_data()). A chunk is a range of point/location indices holding roughly
+# chunk_rows rows; a location is never split, so every chunk can be smoothed on its own. Reading a chunk
+# only decodes the row groups whose statistics overlap its range, which for a result ordered by location
+# (as the server writes them) is about chunk_rows rows. Memory stays proportional to chunk_rows whatever
+# the size of the file; an unordered file still gives the right answer, just with more decoding.
+
+# id_column()
+# the name of the point/location index column of a parquet schema
+def id_column(names):
+    for col in ['point','location']:
+        if col in names:
+            return col
+    raise ValueError("the result has no point or location column")
+
+# location_counts()
+# number of rows per location index, reading only the index column, one row group at a time
+def location_counts(pf,col):
+    counts = np.zeros(0,dtype=np.int64)
+    for i in range(pf.num_row_groups):
+        ids = pf.read_row_group(i,columns=[col]).column(0).to_numpy(zero_copy_only=False)
+        if len(ids) == 0:
+            continue
+        group = np.bincount(ids.astype(np.int64))
+        if len(group) > len(counts):
+            counts = np.concatenate([counts,np.zeros(len(group) - len(counts),dtype=np.int64)])
+        counts[:len(group)] += group
+    return counts
+
+# location_chunks()
+# [(lo, hi), ...] ranges of location indices with about chunk_rows rows each: a chunk starts at the first
+# location whose rows begin past the next multiple of chunk_rows, so a chunk holds at most chunk_rows rows
+# plus those of its last location. Locations without rows are skipped
+def location_chunks(counts,chunk_rows):
+    present = np.flatnonzero(counts)
+    if len(present) == 0:
+        return []
+    before = np.cumsum(counts[present]) - counts[present]
+    bucket = before // chunk_rows
+    starts = np.flatnonzero(np.concatenate([[True],bucket[1:] != bucket[:-1]]))
+    los = present[starts]
+    his = np.append(present[starts[1:]],present[-1] + 1)
+    return [(int(lo),int(hi)) for (lo,hi) in zip(los,his)]
+
+# row_group_ranges()
+# (min, max) of the index column per row group from the parquet statistics; None where they are missing
+def row_group_ranges(pf,col):
+    ranges = []
+    for g in range(pf.num_row_groups):
+        row_group = pf.metadata.row_group(g)
+        i = [row_group.column(j).path_in_schema for j in range(row_group.num_columns)].index(col)
+        stats = row_group.column(i).statistics
+        if stats is None or not stats.has_min_max:
+            ranges.append(None)
+        else:
+            ranges.append((stats.min,stats.max))
+    return ranges
+
+# read_locations()
+# the rows of locations lo <= index < hi as a pyarrow Table
+def read_locations(pf,col,lo,hi,ranges=None):
+    if ranges is None:
+        ranges = row_group_ranges(pf,col)
+    groups = [g for (g,r) in enumerate(ranges) if r is None or (r[1] >= lo and r[0] < hi)]
+    if len(groups) == 0:
+        return pf.schema_arrow.empty_table()
+    table = pf.read_row_groups(groups)
+    ids = table.column(col)
+    mask = pc.and_(pc.greater_equal(ids,pa.scalar(lo,type=ids.type)),pc.less(ids,pa.scalar(hi,type=ids.type)))
+    return table.filter(mask)
@@ -0,0 +1,161 @@
+import argparse
+import json
+import logging
+import os
+import sys
+
+from .events import LoggingInstrumentation
+from .module1 import StreambatchConnection, savgol_qids
+
+# streambatch command line
+#
+#     streambatch submit --points fields.geojson --start 2020-01-01 > query_id
+#     streambatch status $(cat query_id)
+#     streambatch wait $(cat query_id) --timeout 3600
+#     streambatch fetch $(cat query_id) ndvi.parquet
+#
+# With --journal (or STREAMBATCH_JOURNAL) every submitted query is recorded in a sqlite journal, so fetch
+# knows how to read it (savgol, shards, dedupe) and `streambatch resume OUTPUT_DIR` downloads every
+# finished query that hasn't been fetched yet, e.g. after the machine running a campaign restarted.
+#
+# The API key comes from --api-key or the STREAMBATCH_API_KEY environment variable. Results go to
+# stdout (query ids, statuses) so the commands compose in shell scripts and cron jobs; -v logs the
+# connection's events to stderr. submit and status never import numpy, pandas, pyarrow or scipy, so they
+# start fast; fetch loads them when it reads the result.
+
+# read_json()
+# the contents of a json/GeoJSON file ('-' reads stdin)
+def read_json(path):
+    if path == '-':
+        return json.load(sys.stdin)
+    with open(path) as f:
+        return json.load(f)
+
+# connect()
+def connect(args):
+    api_key = args.api_key or os.environ.get('STREAMBATCH_API_KEY')
+    if not api_key:
+        raise ValueError("no API key: pass --api-key or set STREAMBATCH_API_KEY")
+    instrumentation = None
+    if args.verbose:
+        logging.basicConfig(stream=sys.stderr,level=logging.INFO,format="%(message)s")
+        instrumentation = LoggingInstrumentation()
+    journal_path = args.journal or os.environ.get('STREAMBATCH_JOURNAL')
+    return StreambatchConnection(api_key,use_test_api=args.test_api,quiet=True,instrumentation=instrumentation,journal_path=journal_path)
+
+def submit(connection,args):
+    query_id = connection.request_ndvi(points=read_json(args.points) if args.points else None,
+                                       polygons=read_json(args.polygons) if args.polygons else None,
+                                       location_ids=read_json(args.location_ids) if args.location_ids else None,
+                                       aggregation=args.aggregation,start_date=args.start,end_date=args.end,sources=args.sources)
+    print(query_id)
+    return 0
+
+def status(connection,args):
+    failed = False
+    for query_id in args.query_ids:
+        final_status = connection.final_status(json.loads(connection.status(query_id)))
+        failed = failed or final_status == 'Failed'
+        print("{} {}".format(query_id,final_status or 'Running'))
+    return 1 if failed else 0
+
+def wait(connection,args):
+    try:
+        statuses = connection.wait_all(args.query_ids,timeout=args.timeout)
+    except TimeoutError as e:
+        print("error: {}".format(e),file=sys.stderr)
+        return 3
+    for query_id in args.query_ids:
+        print("{} {}".format(query_id,statuses[query_id]))
+    return 1 if 'Failed' in statuses.values() else 0
+
+# fetch()
+# writes the result as parquet, or csv if the output name ends in .csv
+def fetch(connection,args):
+    import pyarrow.csv
+    import pyarrow.parquet
+    if args.savgol:
+        savgol_qids.append(args.query_id)
+    table = connection.get_data(args.query_id,columns=args.columns,start=args.start,end=args.end,result_format='arrow')
+    if table is None:
+        print("error: query {} failed".format(args.query_id),file=sys.stderr)
+        return 1
+    if args.output.endswith('.csv'):
+        pyarrow.csv.write_csv(table,args.output)
+    else:
+        pyarrow.parquet.write_table(table,args.output)
+    print("{} rows -> {}".format(table.num_rows,args.output),file=sys.stderr)
+    return 0
+
+# resume()
+# fetches every journaled query that succeeded and has no output yet into OUTPUT_DIR/<query id>/
+# (OUTPUT_DIR/sharded-<hash>/ for a query that was split into shards; the printed path says which)
+def resume(connection,args):
+    if connection.journal is None:
+        raise ValueError("resume needs a journal: pass --journal or set STREAMBATCH_JOURNAL")
+    try:
+        results = connection.resume(args.output_dir,timeout=args.timeout)
+    except TimeoutError as e:
+        print("error: {}".format(e),file=sys.stderr)
+        return 3
+    failed = False
+    for (query_id,output) in results.items():
+        if isinstance(output,Exception):
+            print("{} error: {}: {}".format(query_id,type(output).__name__,output))
+            failed = True
+        else:
+            print("{} {}".format(query_id,output))
+            failed = failed or output == 'Failed'
+    return 1 if failed else 0
+
+COMMANDS = {'submit': submit, 'status': status, 'wait': wait, 'fetch': fetch, 'resume': resume}
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='streambatch',description="Request and download NDVI time series from the Streambatch API.")
+    parser.add_argument('--api-key',help="API key (default: $STREAMBATCH_API_KEY)")
+    parser.add_argument('--test-api',action='store_true',help="use the test API")
+    parser.add_argument('-v','--verbose',action='store_true',help="log request and fetch events to stderr")
+    parser.add_argument('--journal',metavar='FILE',help="sqlite job journal to record queries in (default: $STREAMBATCH_JOURNAL)")
+    commands = parser.add_subparsers(dest='command',required=True)
+
+    p = commands.add_parser('submit',help="submit a request and print its query id")
+    space = p.add_mutually_exclusive_group(required=True)
+    space.add_argument('--points',metavar='FILE',help="json list of [lon, lat] or a GeoJSON FeatureCollection of Points ('-' for stdin)")
+    space.add_argument('--polygons',metavar='FILE',help="json list of GeoJSON Polygons or a FeatureCollection ('-' for stdin)")
+    p.add_argument('--location-ids',metavar='FILE',help="json list of ids, one per location")
+    p.add_argument('--start',help="start date, YYYY-MM-DD")
+    p.add_argument('--end',help="end date, YYYY-MM-DD")
+    p.add_argument('--sources',nargs='+',help="e.g. ndvi.sentinel2 ndvi.landsat")
+    p.add_argument('--aggregation',default='median',help="for polygons: median or mean")
+
+    p = commands.add_parser('status',help="print the status of queries (exit status 1 if one failed)")
+    p.add_argument('query_ids',nargs='+',metavar='QUERY_ID')
+
+    p = commands.add_parser('wait',help="wait until queries have finished (exit status 1 if one failed)")
+    p.add_argument('query_ids',nargs='+',metavar='QUERY_ID')
+    p.add_argument('--timeout',type=float,help="give up after this many seconds (exit status 3)")
+
+    p = commands.add_parser('fetch',help="wait for a query and write its result to a parquet or csv file")
+    p.add_argument('query_id',metavar='QUERY_ID')
+    p.add_argument('output',metavar='OUTPUT')
+    p.add_argument('--columns',nargs='+')
+    p.add_argument('--start',help="first day to keep, YYYY-MM-DD")
+    p.add_argument('--end',help="last day to keep, YYYY-MM-DD")
+    p.add_argument('--savgol',action='store_true',help="the query was submitted with --sources ndvi.savgol: apply the smoothing")
+
+    p = commands.add_parser('resume',help="wait for the journaled queries and save the unfetched results (exit status 1 if a query failed or couldn't be saved)")
+    p.add_argument('output_dir',metavar='OUTPUT_DIR')
+    p.add_argument('--timeout',type=float,help="give up after this many seconds (exit status 3)")
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    try:
+        connection = connect(args)
+        return COMMANDS[args.command](connection,args)
+    except ValueError as e:
+        print("error: {}".format(e),file=sys.stderr)
+        return 2
+
+if __name__ == '__main__':
+    sys.exit(main())
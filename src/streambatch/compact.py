@@ -0,0 +1,61 @@
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+pc = LazyModule('pyarrow.compute')
+
+# Compact result representation used by get_data(result_format='compact'):
+# - ndvi columns as float32 (NDVI doesn't need more than 7 significant digits)
+# - integer columns (point/location indices, qa flags) in the narrowest integer type that holds them
+# - string columns (location ids) dictionary encoded, which pandas turns into categoricals
+
+INT_TYPES = ['int8', 'int16', 'int32', 'int64']
+
+def is_ndvi(name):
+    return name.startswith('ndvi')
+
+# narrow_int_type()
+# smallest (numpy, arrow) integer type that holds every value between lo and hi
+def narrow_int_type(lo,hi):
+    for name in INT_TYPES:
+        np_type = np.dtype(name).type
+        info = np.iinfo(np_type)
+        if lo >= info.min and hi <= info.max:
+            break
+    return (np_type,pa.from_numpy_dtype(np_type))
+
+# compact_table()
+# converts a pyarrow Table to the compact representation
+def compact_table(table):
+    arrays = []
+    fields = []
+    for (field,column) in zip(table.schema,table.columns):
+        if pa.types.is_floating(field.type) and is_ndvi(field.name):
+            column = column.cast(pa.float32())
+        elif pa.types.is_integer(field.type) and len(column) > column.null_count:
+            bounds = pc.min_max(column)
+            (np_type,pa_type) = narrow_int_type(bounds['min'].as_py(),bounds['max'].as_py())
+            column = column.cast(pa_type)
+        elif pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            column = column.dictionary_encode()
+        arrays.append(column)
+        fields.append(pa.field(field.name,column.type))
+    return pa.Table.from_arrays(arrays,schema=pa.schema(fields))
+
+# compact_frame()
+# converts a pandas DataFrame to the compact representation (e.g. the output of savgol())
+def compact_frame(df):
+    df = df.copy()
+    for col in df.columns:
+        dtype = df[col].dtype
+        if isinstance(dtype,pd.CategoricalDtype):
+            continue
+        if pd.api.types.is_float_dtype(dtype) and is_ndvi(col):
+            df[col] = df[col].astype(np.float32)
+        elif pd.api.types.is_integer_dtype(dtype) and len(df) > 0:
+            (np_type,pa_type) = narrow_int_type(df[col].min(),df[col].max())
+            df[col] = df[col].astype(np_type)
+        elif pd.api.types.is_object_dtype(dtype) or pd.api.types.is_string_dtype(dtype):
+            df[col] = df[col].astype('category')
+    return df
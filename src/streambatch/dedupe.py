@@ -0,0 +1,169 @@
+import hashlib
+import json
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pa = LazyModule('pyarrow')
+
+# Point deduplication (request_ndvi(dedupe=...))
+# Points that fall into the same pixel get the same time series, so only one of them needs to be
+# requested. 'exact' merges points with identical coordinates; 'pixel' merges points that fall into the
+# same 10 m pixel of the Sentinel-2 grid, which is the UTM grid of the point's zone with pixel edges on
+# multiples of 10 m. The first point of every group is sent as is, so its series is exactly the one the
+# server would have returned for it, and get_data() copies it to the other points of the group.
+# Zone exceptions (Norway, Svalbard) and the polar UPS grids aren't modelled: near those a pixel can be
+# split in two groups, which only costs a duplicate, never a wrong series.
+# The 10 m grid is only the pixel grid of Sentinel-2. Landsat (30 m), MODIS (250 m, sinusoidal) and the
+# blended products sample on other grids, where two points in the same 10 m cell can still fall into
+# different pixels, so 'pixel' is only allowed when every source is in PIXEL_SOURCES.
+
+DEDUPE_MODES = ('exact', 'pixel')
+PIXEL_SOURCES = ('ndvi.sentinel2',)
+
+# check_dedupe()
+# raises ValueError unless dedupe is a valid mode for these sources
+def check_dedupe(dedupe,sources):
+    if dedupe not in DEDUPE_MODES:
+        raise ValueError("dedupe must be one of {}".format(DEDUPE_MODES))
+    if dedupe == 'pixel' and any(source not in PIXEL_SOURCES for source in sources):
+        raise ValueError("dedupe='pixel' groups points on the 10 m Sentinel-2 grid, so it needs sources={}; use dedupe='exact' for {}".format(list(PIXEL_SOURCES),sources))
+
+# WGS84 and the UTM constants
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+UTM_K0 = 0.9996
+UTM_FALSE_EASTING = 500000.0
+UTM_FALSE_NORTHING_SOUTH = 10000000.0
+
+# utm()
+# (zone, easting, northing) of an (N, 2) array of longitude, latitude; northing is in the southern
+# hemisphere's frame for latitudes below 0. Krüger's series to third order (Karney 2011), which is
+# accurate to well under a millimeter inside a zone
+def utm(points):
+    lon = points[:,0]
+    lat = points[:,1]
+    zone = np.clip(np.floor((lon + 180) / 6).astype(np.int64) + 1,1,60)
+    n = WGS84_F / (2 - WGS84_F)
+    big_a = WGS84_A / (1 + n) * (1 + n**2 / 4 + n**4 / 64)
+    alpha = [n / 2 - 2 * n**2 / 3 + 5 * n**3 / 16, 13 * n**2 / 48 - 3 * n**3 / 5, 61 * n**3 / 240]
+    phi = np.radians(lat)
+    dlam = np.radians(lon - (zone * 6 - 183))
+    e = 2 * np.sqrt(n) / (1 + n)
+    t = np.sinh(np.arctanh(np.sin(phi)) - e * np.arctanh(e * np.sin(phi)))
+    xi = np.arctan2(t,np.cos(dlam))
+    eta = np.arctanh(np.sin(dlam) / np.sqrt(1 + t**2))
+    easting = eta.copy()
+    northing = xi.copy()
+    for (j,a) in enumerate(alpha,1):
+        easting += a * np.cos(2 * j * xi) * np.sinh(2 * j * eta)
+        northing += a * np.sin(2 * j * xi) * np.cosh(2 * j * eta)
+    easting = UTM_FALSE_EASTING + UTM_K0 * big_a * easting
+    northing = UTM_K0 * big_a * northing + np.where(lat < 0,UTM_FALSE_NORTHING_SOUTH,0.0)
+    return (zone,easting,northing)
+
+# pixel_keys()
+# one integer row per point that is equal for points in the same pixel_size pixel
+def pixel_keys(points,pixel_size=10):
+    (zone,easting,northing) = utm(points)
+    south = (points[:,1] < 0).astype(np.int64)
+    return np.column_stack([zone,south,np.floor(easting / pixel_size).astype(np.int64),np.floor(northing / pixel_size).astype(np.int64)])
+
+# PointGroups
+# which requested (unique) point every original point maps to. inverse[i] is the unique index of
+# original point i, first[u] the original point that was sent for unique point u
+class PointGroups:
+    def __init__(self,inverse,first,location_ids=None):
+        self.inverse = inverse
+        self.first = first
+        self.location_ids = location_ids
+        # the same as an array, which fan_out() indexes for every batch
+        self.location_id_array = None if location_ids is None else np.asarray(location_ids,dtype=object)
+        # originals grouped by unique point, CSR style: members[offsets[u]:offsets[u+1]]
+        self.members = np.argsort(inverse,kind='stable')
+        self.offsets = np.concatenate([[0],np.cumsum(np.bincount(inverse,minlength=len(first)))])
+
+    @classmethod
+    def build(cls,points,mode='pixel',location_ids=None,pixel_size=10):
+        if mode not in DEDUPE_MODES:
+            raise ValueError("dedupe must be one of {}".format(DEDUPE_MODES))
+        keys = points if mode == 'exact' else pixel_keys(points,pixel_size)
+        (_,first,inverse) = np.unique(keys,axis=0,return_index=True,return_inverse=True)
+        # number the unique points in order of first appearance, so the request keeps the caller's order
+        order = np.argsort(first,kind='stable')
+        rank = np.empty(len(order),dtype=np.int64)
+        rank[order] = np.arange(len(order))
+        return cls(rank[inverse.reshape(-1)],first[order],location_ids)
+
+    # digest()
+    # hash of the mapping (and location ids): two requests with the same unique points but a different
+    # mapping get different digests, so they never share a request cache entry
+    def digest(self):
+        h = hashlib.sha256()
+        h.update(np.ascontiguousarray(self.inverse,dtype=np.int64).tobytes())
+        h.update(np.ascontiguousarray(self.first,dtype=np.int64).tobytes())
+        h.update(json.dumps(None if self.location_ids is None else list(self.location_ids),default=str).encode())
+        return h.hexdigest()
+
+    @property
+    def points(self):
+        return len(self.inverse)
+
+    @property
+    def unique(self):
+        return len(self.first)
+
+    @property
+    def ratio(self):
+        return self.points / max(self.unique,1)
+
+    # selection()
+    # for get_data(locations=...): (unique points to read, mask of the original points to return).
+    # locations are original point indices or location ids
+    def selection(self,locations):
+        if locations is None:
+            return (None,None)
+        locations = list(locations)
+        if len(locations) > 0 and all(isinstance(l,str) for l in locations):
+            if self.location_ids is None:
+                raise ValueError("this query has no location_ids")
+            index = {location_id: i for (i,location_id) in enumerate(self.location_ids)}
+            locations = [index[l] for l in locations if l in index]
+        originals = np.asarray(locations,dtype=np.int64)
+        originals = originals[(originals >= 0) & (originals < self.points)]
+        keep = np.zeros(self.points,dtype=bool)
+        keep[originals] = True
+        return (np.unique(self.inverse[originals]).tolist(),keep)
+
+    # fan_out()
+    # expands a result of the unique points (pyarrow Table or RecordBatch with a point column) to the
+    # original points: every row is repeated for each point of its group, the point column is set to the
+    # original index and location_id is added if the request had location ids. With sort, rows are ordered
+    # by original point (stable, so the time order within a point is kept)
+    def fan_out(self,data,keep=None,sort=True):
+        unique = data.column('point').to_numpy(zero_copy_only=False).astype(np.int64)
+        counts = self.offsets[unique + 1] - self.offsets[unique]
+        rows = np.repeat(np.arange(len(unique)),counts)
+        within = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts,counts)
+        originals = self.members[np.repeat(self.offsets[unique],counts) + within]
+        if keep is not None:
+            rows = rows[keep[originals]]
+            originals = originals[keep[originals]]
+        if sort:
+            order = np.argsort(originals,kind='stable')
+            rows = rows[order]
+            originals = originals[order]
+        data = data.take(pa.array(rows))
+        arrays = []
+        names = []
+        for (name,column) in zip(data.schema.names,data.columns):
+            if name == 'point':
+                arrays.append(pa.array(originals,type=column.type))
+                names.append(name)
+                if self.location_id_array is not None:
+                    arrays.append(pa.array(self.location_id_array[originals],type=pa.string()))
+                    names.append('location_id')
+            else:
+                arrays.append(column)
+                names.append(name)
+        return type(data).from_arrays(arrays,names=names)
@@ -0,0 +1,34 @@
+import json
+import sys
+
+# orjson is optional: it writes numpy arrays directly and is many times faster than json for
+# requests with a lot of points. Without it the standard json module is used
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# to_json_type()
+# json fallback for the numpy values a request can hold (point arrays, numpy scalars)
+def to_json_type(obj):
+    # without numpy loaded obj can't be a numpy value, and checking shouldn't import it
+    np = sys.modules.get('numpy')
+    if np is not None and isinstance(obj,np.ndarray):
+        return obj.tolist()
+    if np is not None and isinstance(obj,np.generic):
+        return obj.item()
+    raise TypeError("Object of type {} is not JSON serializable".format(type(obj).__name__))
+
+# dumps()
+# compact json encoding of a request body, as bytes
+def dumps(obj,sort_keys=False):
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        try:
+            return orjson.dumps(obj,option=option)
+        except TypeError:
+            # e.g. non-contiguous or object arrays, which orjson refuses; the fallback handles them
+            pass
+    return json.dumps(obj,sort_keys=sort_keys,separators=(',',':'),default=to_json_type).encode()
@@ -0,0 +1,133 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Instrumentation
+# The connection reports what it is doing as events: a name and a dict of fields. Handlers receive every
+# event through handle(event, fields); pass them to the connection with instrumentation=..., either as an
+# Instrumentation object, a plain function f(event, fields) or a list of those. The console output of the
+# connection is itself a handler (PrintInstrumentation), which quiet=True leaves out.
+#
+# Events and their fields (seconds are wall clock time of that phase):
+#   connection.test_api    -
+#   request.build          seconds, locations, polygons (True/False)
+#   request.cached         query_id
+#   request.dedupe         points, unique, ratio                      (request_ndvi(dedupe=...): points per unique point)
+#   request.payload        raw_bytes, sent_bytes                      (coordinate_precision/compress_requests)
+#   request.submit         seconds, bytes, status_code                (one per HTTP request, i.e. per shard)
+#   request.done           query_id, seconds, locations, polygons, shards, start, end, aggregation
+#   query.poll             query_id, polls, status                    (every status check while waiting)
+#   query.wait             query_id, seconds, polls, status           (get_data/wait: time spent waiting for the server)
+#   query.finished         query_id, seconds, status                  (wait_all/as_completed and the async connection)
+#   query.failed           query_id, error                            (error is the status reported by the server)
+#   fetch.download         url, seconds, bytes                        (result cache misses)
+#   fetch.read             url, seconds, rows, bytes                  (download + parquet decode; bytes in memory)
+#   fetch.savgol           seconds, rows, locations
+#   fetch.done             query_id, seconds, rows
+#   fetch.stage            query_id, stage, seconds                   (fetch_many: stage is 'download' or 'process')
+class Instrumentation:
+    def handle(self,event,fields):
+        pass
+
+# PrintInstrumentation
+# the console output the connection has always had (query details, a dot per status check, errors)
+class PrintInstrumentation(Instrumentation):
+    def handle(self,event,fields):
+        if event == 'connection.test_api':
+            print("Using test API")
+        elif event == 'request.payload':
+            print("Request payload: {:,} bytes -> {:,} bytes".format(fields['raw_bytes'],fields['sent_bytes']))
+        elif event == 'request.dedupe':
+            print("Unique locations: {:,} of {:,} points ({:.1f}x fewer)".format(fields['unique'],fields['points'],fields['ratio']))
+        elif event == 'request.cached':
+            print("Reusing query {} from the request cache".format(fields['query_id']))
+        elif event == 'request.done':
+            print("Query ID: {}".format(fields['query_id']))
+            print("Number of {}: {}".format("polygons" if fields['polygons'] else "points",fields['locations']))
+            print("Start date: {}".format(fields['start']))
+            print("End date: {}".format(fields['end']))
+            print("Aggregation: {}".format(fields['aggregation']))
+            if fields['shards'] > 1:
+                print("Number of shards: {}".format(fields['shards']))
+        elif event == 'query.poll':
+            if fields['status'] is None:
+                print(".",end="",flush=True)
+        elif event == 'query.wait':
+            print("")
+        elif event == 'query.failed':
+            print("Error: {}".format(fields['error'])) # !!! need to parse the error message
+
+# LoggingInstrumentation
+# writes every event to a logger (default: the 'streambatch' logger) as "event key=value ...".
+# the event name and fields are also attached to the record as record.event and record.fields,
+# for log handlers that ship structured data to a metrics system
+class LoggingInstrumentation(Instrumentation):
+    def __init__(self,logger=None,level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger('streambatch')
+        self.level = level
+
+    def handle(self,event,fields):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        text = " ".join("{}={}".format(k,round(v,4) if isinstance(v,float) else v) for (k,v) in fields.items())
+        self.logger.log(self.level,"%s %s",event,text,extra={'event': event, 'fields': fields})
+
+# MetricsInstrumentation
+# keeps running totals per event: how often it happened and the sum of its numeric fields
+# (seconds, bytes, rows, polls, ...). summary() returns {event: {'count': n, 'seconds': total, ...}}
+class MetricsInstrumentation(Instrumentation):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {}
+
+    def handle(self,event,fields):
+        with self.lock:
+            totals = self.totals.setdefault(event,{'count': 0})
+            totals['count'] += 1
+            for (k,v) in fields.items():
+                if isinstance(v,(int,float)) and not isinstance(v,bool):
+                    totals[k] = totals.get(k,0) + v
+
+    def summary(self):
+        with self.lock:
+            return {event: dict(totals) for (event,totals) in self.totals.items()}
+
+    def reset(self):
+        with self.lock:
+            self.totals = {}
+
+# CallbackInstrumentation
+# calls fn(event, fields) for every event
+class CallbackInstrumentation(Instrumentation):
+    def __init__(self,fn):
+        self.fn = fn
+
+    def handle(self,event,fields):
+        self.fn(event,fields)
+
+# Instruments
+# the handlers of one connection. emit() sends an event to all of them; timed() measures a block
+# and emits the event when it ends, with the block's fields (which the block can still add to)
+class Instruments:
+    def __init__(self,handlers=None):
+        self.handlers = []
+        for handler in handlers or []:
+            self.add(handler)
+
+    def add(self,handler):
+        if not isinstance(handler,Instrumentation):
+            handler = CallbackInstrumentation(handler)
+        self.handlers.append(handler)
+        return handler
+
+    def emit(self,event,**fields):
+        for handler in self.handlers:
+            handler.handle(event,fields)
+
+    @contextmanager
+    def timed(self,event,**fields):
+        start = time.perf_counter()
+        yield fields
+        fields['seconds'] = time.perf_counter() - start
+        self.emit(event,**fields)
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+
+# JobJournal
+# durable record of the queries a connection submits (pass journal_path to the connection), kept in a
+# sqlite file. For every query it holds the request parameters (everything but the locations themselves),
+# the client side post-processing ('savgol' or none), the shards and dedupe groups needed to read the
+# result, the last known status and where the result was saved. A new connection on the same journal
+# knows how to read all of these queries again, and resume() picks up the ones that weren't finished.
+#
+# status is 'Submitted' until the query is seen to finish, then 'Succeeded' or 'Failed'.
+# name is the directory name resume() saves the result under: the query id, or for a composite (sharded)
+# query, whose id joins all shard ids and can be longer than a file name may be, a hash of it.
+# output is the path save_data() wrote the result to, or None. error is why the last attempt to fetch
+# the result failed (resume() records it and moves on to the next query); a new output clears it.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS queries (
+    query_id TEXT PRIMARY KEY,
+    submitted REAL NOT NULL,
+    updated REAL NOT NULL,
+    request TEXT NOT NULL,
+    locations INTEGER NOT NULL,
+    postprocess TEXT,
+    shards TEXT,
+    dedupe_inverse BLOB,
+    dedupe_first BLOB,
+    location_ids TEXT,
+    status TEXT NOT NULL,
+    output TEXT,
+    error TEXT,
+    name TEXT
+)
+"""
+
+# columns added after the first release, with their types, so that older journals can be opened
+ADDED_COLUMNS = [('error','TEXT'),('name','TEXT')]
+
+# output_name()
+# a short directory name for the result of query_id that is the same on every run
+def output_name(query_id):
+    if '+' not in query_id:
+        return query_id
+    return 'sharded-' + hashlib.sha256(query_id.encode()).hexdigest()[:24]
+
+class JobJournal:
+    def __init__(self,path):
+        self.path = os.path.expanduser(path)
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory,exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(self.path,check_same_thread=False,isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(queries)").fetchall()]
+        for (name,kind) in ADDED_COLUMNS:
+            if name not in columns:
+                self.db.execute("ALTER TABLE queries ADD COLUMN {} {}".format(name,kind))
+
+    def close(self):
+        self.db.close()
+
+    # record()
+    # adds a submitted query. A query that is already in the journal (e.g. reused from the request cache) keeps its entry
+    def record(self,query_id,ndvi_request,postprocess=None,shards=None,groups=None):
+        request = {k: v for (k,v) in ndvi_request.items() if k not in ('space','location_id')}
+        locations = len(ndvi_request['space']) if groups is None else groups.points
+        row = (query_id,time.time(),time.time(),json.dumps(request),locations,postprocess,
+               None if shards is None else json.dumps([list(shard) for shard in shards]),
+               None if groups is None else np.ascontiguousarray(groups.inverse,dtype=np.int64).tobytes(),
+               None if groups is None else np.ascontiguousarray(groups.first,dtype=np.int64).tobytes(),
+               None if groups is None or groups.location_ids is None else json.dumps(list(groups.location_ids)),
+               'Submitted',None,None,output_name(query_id))
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO queries VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?)",row)
+
+    # update()
+    # sets the status, output and/or error of a query (None leaves it as is); unknown query ids are ignored
+    def update(self,query_id,status=None,output=None,error=None):
+        with self.lock:
+            self.db.execute("UPDATE queries SET status = COALESCE(?1,status), output = COALESCE(?2,output), "
+                            "error = CASE WHEN ?2 IS NOT NULL THEN NULL ELSE COALESCE(?3,error) END, updated = ?4 WHERE query_id = ?5",
+                            (status,output,error,time.time(),query_id))
+
+    # entries()
+    # the journaled queries (optionally only those with the given status) in submission order, as dicts.
+    # shards is a list of (query id, offset) tuples and groups a PointGroups, or None. deduped says whether
+    # the query has groups; with load_groups=False they are left out (groups is None), which doesn't need numpy
+    def entries(self,status=None,load_groups=True):
+        sql = "SELECT query_id, submitted, updated, request, locations, postprocess, shards, dedupe_inverse, dedupe_first, location_ids, status, output, error, name FROM queries"
+        args = ()
+        if status is not None:
+            sql += " WHERE status = ?"
+            args = (status,)
+        with self.lock:
+            rows = self.db.execute(sql + " ORDER BY submitted, rowid",args).fetchall()
+        entries = []
+        for (query_id,submitted,updated,request,locations,postprocess,shards,inverse,first,location_ids,status_,output,error,name) in rows:
+            entries.append({
+                'query_id': query_id, 'submitted': submitted, 'updated': updated, 'request': json.loads(request), 'locations': locations,
+                'postprocess': postprocess, 'shards': None if shards is None else [tuple(shard) for shard in json.loads(shards)],
+                'groups': self.point_groups(inverse,first,location_ids) if load_groups else None, 'deduped': inverse is not None,
+                'status': status_, 'output': output, 'error': error, 'name': output_name(query_id) if name is None else name,
+            })
+        return entries
+
+    # groups()
+    # the PointGroups of a journaled query, or None if it wasn't deduped (or isn't in the journal)
+    def groups(self,query_id):
+        with self.lock:
+            row = self.db.execute("SELECT dedupe_inverse, dedupe_first, location_ids FROM queries WHERE query_id = ?",(query_id,)).fetchone()
+        if row is None:
+            return None
+        return self.point_groups(*row)
+
+    # point_groups()
+    # a PointGroups from the dedupe columns of a row, or None
+    def point_groups(self,inverse,first,location_ids):
+        if inverse is None:
+            return None
+        from .dedupe import PointGroups
+        return PointGroups(np.frombuffer(inverse,dtype=np.int64),np.frombuffer(first,dtype=np.int64),None if location_ids is None else json.loads(location_ids))
+
+    # summary()
+    # number of queries per status
+    def summary(self):
+        with self.lock:
+            return dict(self.db.execute("SELECT status, COUNT(*) FROM queries GROUP BY status").fetchall())
@@ -0,0 +1,31 @@
+import importlib
+import sys
+
+# Lazy imports
+# pandas, pyarrow, scipy and s3fs/fsspec take most of a second to import, and submitting a request or
+# checking a status needs none of them. Modules refer to them through a LazyModule, which imports the
+# real module the first time one of its attributes is used:
+#
+#     pd = LazyModule('pandas')
+#     ...
+#     pd.DataFrame(...)   # pandas is imported here
+class LazyModule:
+    def __init__(self,name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self,attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return getattr(module,attr)
+
+    def __repr__(self):
+        return "<lazy module '{}'>".format(self.__dict__['_name'])
+
+# is_loaded()
+# True if module name has been imported (by anyone). An object can only be a DataFrame or a pyarrow
+# Table if pandas/pyarrow are loaded, so type checks use this to avoid importing them just to say no
+def is_loaded(name):
+    return name in sys.modules
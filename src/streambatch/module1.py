@@ -1,242 +1,502 @@
-from datetime import datetime
 import json
-import pandas as pd
+import os
+import queue
 import requests
+import shutil
+import threading
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
 import time
 
-from .savgol import savgol
-
-savgol_qids = [] # list of qids that requested savgol so that I can construct the final dataframe
-
-class StreambatchConnection:
-    def __init__(self,api_key,use_test_api=False):
-        self.api_key = api_key
-        self.REQUEST_URL = "https://api.streambatch.io/async"
-        self.STATUS_URL = "https://api.streambatch.io/check"
-        self.READ_URL = "s3://streambatch-data"
-        if use_test_api:
-            print("Using test API")
-            self.REQUEST_URL = "https://test.streambatch.io/async"
-            self.STATUS_URL = "https://test.streambatch.io/check"
-    
+# the registries and constants live in base.py (shared with aio.py); they are imported here so that
+# from streambatch.module1 import ... keeps working
+from .base import (ConnectionBase, JSON_HEADERS, LON_LAT_COLUMNS, POST_RETRY_STATUS_CODES, RESULT_FORMATS, RETRY_STATUS_CODES, ShardSubmitError,
+                   deduped_qids, is_retryable, savgol_qids, sharded_qids)
+from .chunked import id_column, location_chunks, location_counts, read_locations, row_group_ranges
+from .compact import compact_table
+from .lazy import LazyModule
+
+# loaded on first use (see lazy.py)
+ds = LazyModule('pyarrow.dataset')
+pa = LazyModule('pyarrow')
+pq = LazyModule('pyarrow.parquet')
+
+# StreambatchConnection
+# the blocking connection: a pooled requests.Session for the API, and threads where calls run in parallel.
+# Validation, request bodies and result handling come from ConnectionBase (see base.py)
+class StreambatchConnection(ConnectionBase):
+    # takes the arguments of ConnectionBase
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self.adapter = None
+        self.session = self.new_session(self.pool_size)
+
+    # new_session()
+    # the pooled keep-alive requests.Session that every API call goes through
+    def new_session(self,pool_size):
+        session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_size,pool_maxsize=pool_size)
+        session.mount("https://",self.adapter)
+        session.mount("http://",self.adapter)
+        return session
+
+    # send()
+    # every call to the API goes through here: one pooled keep-alive session, with retries for transient errors.
+    # a POST that fails with a connection error, 500, 502 or 504 may still have created a query on the server, so
+    # it is only retried on 429 and 503 (the server turned it away); resending it could submit the work twice
+    def send(self,method,url,headers=None,**kwargs):
+        headers = dict(headers or {},**{'X-API-Key': self.api_key})
+        attempt = 0
+        while True:
+            self.http_stats['requests'] += 1
+            try:
+                response = self.session.request(method,url,headers=headers,**kwargs)
+            except requests.ConnectionError:
+                if method != 'GET' or attempt >= self.max_retries:
+                    self.http_stats['failures'] += 1
+                    raise
+                retry_after = None
+            else:
+                if not is_retryable(method,response.status_code) or attempt >= self.max_retries:
+                    if response.status_code != 200:
+                        self.http_stats['failures'] += 1
+                    return response
+                retry_after = response.headers.get('Retry-After')
+            delay = self.backoff_delay(attempt,retry_after)
+            self.http_stats['retries'] += 1
+            self.http_stats['retry_wait'] += delay
+            time.sleep(delay)
+            attempt += 1
+
+    # connection_stats()
+    # request/retry counters plus, for every host, how many connections the pool opened and how many requests they served
+    def connection_stats(self):
+        pools = {}
+        for key in self.adapter.poolmanager.pools.keys():
+            pool = self.adapter.poolmanager.pools[key]
+            pools['{}://{}:{}'.format(key.key_scheme,key.key_host,key.key_port)] = {'connections': pool.num_connections, 'requests': pool.num_requests}
+        return dict(super().connection_stats(),pools=pools)
+
+    def close(self):
+        self.session.close()
+
     def make_request(self,ndvi_request):
-        response =  requests.post(self.REQUEST_URL, json=ndvi_request, headers={'X-API-Key': self.api_key})
+        (body,headers) = self.encode_request(ndvi_request)
+        with self.events.timed('request.submit',bytes=len(body)) as fields:
+            response = self.send('POST', self.REQUEST_URL, data=body, headers=headers)
+            fields['status_code'] = response.status_code
         if response.status_code != 200:
             raise ValueError("{}".format(json.dumps(json.loads(response.text),indent=4)))
         query_id = json.loads(response.content)['id']
         access_url = json.loads(response.content)['access_url']
         return (query_id,access_url)
-    
-    def validate_polygon_input(self,polygons):
-        space = None # this will be set below
-        # polytons must either be a list or a dict. if it is not one of those, raise an error
-        if not isinstance(polygons,dict) and not isinstance(polygons,list):
-            raise ValueError("Polygons must be a list or a dict")
-        # if polygons is a list, it must be a list of dicts. if it is not, raise an error
-        if isinstance(polygons,list):
-            for polygon in polygons:
-                if not isinstance(polygon,dict):
-                    raise ValueError("Polygons must be a list of dicts")
-                # polygon must have two keys: "type" and "coordinates". if it does not, raise an error
-                if "type" not in polygon or "coordinates" not in polygon:
-                    raise ValueError("Each polygon must have a 'type' and 'coordinates' key")
-            space = polygons
-        # if polygons is a dict, it must have, each value must be a dics. if it is not, raise an error
-        if isinstance(polygons,dict):
-            for key,value in polygons.items():
-                if not isinstance(value,dict):
-                    raise ValueError("Polygons must be a dict where the key is an id and value is a polygon")
-                # each value must have two keys: "type" and "coordinates". if it does not, raise an error
-                if "type" not in value or "coordinates" not in value:
-                    raise ValueError("Each polygon must have a 'type' and 'coordinates' key")
-            # space is the iist of values from the dict
-            space = list(polygons.values())
-        return space
-
-    def validate_souces_input(self,sources):
-        # if sources is None, then set it to a list containing one element, ndvi.streambatch
-        if sources is None:
-            sources = ["ndvi.streambatch_v2"]
-        else:
-            # if sources is not None, then it must be a list. if it is not, raise an error
-            if not isinstance(sources,list):
-                raise ValueError("sources must be a list")
-            # if sources is not None, then it must be a list of strings. if it is not, raise an error
-            valid_sources = ["ndvi.streambatch", 'ndvi.streambatch_v2', "ndvi.sentinel2","ndvi.modis","ndvi.landsat"]
-            for s in sources:
-                if not isinstance(s,str):
-                    raise ValueError("sources must be a list of strings")
-                # if sources is not a valid sources, raise an error
-                if s not in valid_sources:
-                    raise ValueError("Unknown source: {}. sources must be one of the following: {}".format(s,valid_sources))
-        return sources
-    
-    def validate_point_input(self,points):
-        # points must be a list of lists. if it is not, raise an error
-        # !!! also should take dict of points
-        # and geojson points = [{"type":"Point","coordinates":[0,0]}]
-        if not isinstance(points,list):
-            raise ValueError("Points must be a list")
-        for point in points:
-            if not isinstance(point,list):
-                raise ValueError("Points must be a list of lists")
-            if len(point) != 2:
-                raise ValueError("Each point must have two values: longitude and latitude")
-        return points
-
-    
+
     # request_ndvi()
     # set query_id to a previous query id to skip the request completely. used for debugging and testing
-    def request_ndvi(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None):
-        if sources is None:
-            sources = ["ndvi.streambatch_v2"]
-        if sources == ['ndvi.savgol']:
-            qid = self.request_ndvi_(sources=['ndvi.sentinel2','ndvi.landsat'],polygons=polygons,location_ids=location_ids,points=points,aggregation=aggregation,start_date=start_date,end_date=end_date,query_id=query_id)
+    # set shard_size to override the connection's shard_size for this request
+    # set dedupe to 'pixel' to request each 10 m pixel only once (sources=['ndvi.sentinel2'] only), or 'exact' for
+    # identical coordinates; get_data() copies every series back to all of its points, so the result looks the same as without dedupe
+    def request_ndvi(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None,shard_size=None,dedupe=None):
+        arguments = self.ndvi_arguments(polygons,points,location_ids,sources,dedupe)
+        qid = self.request_ndvi_(aggregation=aggregation,start_date=start_date,end_date=end_date,query_id=query_id,shard_size=shard_size,**arguments)
+        if arguments['postprocess'] == 'savgol':
             savgol_qids.append(qid)
-            return qid
-        else:
-            return self.request_ndvi_(sources=sources,polygons=polygons,points=points,location_ids=location_ids,aggregation=aggregation,start_date=start_date,end_date=end_date,query_id=query_id)
-    
-    def request_ndvi_(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None):
-        
-        sources = self.validate_souces_input(sources)
-
-        # you must set either polygons or points but not both
-        if polygons is None and points is None:
-            raise ValueError("You must set either polygons or points")
-        if polygons is not None and points is not None:
-            raise ValueError("You must set either polygons or points but not both")
-
-        space = None # this will be set below 
-        if polygons is not None:
-            space = self.validate_polygon_input(polygons)
-
-        elif points is not None:
-            space = self.validate_point_input(points)
-        else:
-            raise ValueError("You must set either polygons or points")
-
-        # aggregation must be either "mean" or "median". if it is not, raise an error
-        if aggregation not in ["mean","median"]:
-            raise ValueError("Aggregation must be either 'mean' or 'median'")
-        
-        # if start_date is None, then set it to 2013-01-01
-        if start_date is None:
-            start_date = datetime(2013,1,1)
-        else:
-            # if start_date is not None, then it must be a datetime object. if it is not, raise an error
-            if not isinstance(start_date,datetime):
-                # if it is a string, convert it to a datetime object
-                if isinstance(start_date,str):
-                    start_date = datetime.strptime(start_date,"%Y-%m-%d")
-                else:
-                    raise ValueError("start_date must be a a string yyyy-mm-dd or a datetime object")
-        
-        # if end_date is None, then set it to today
-        if end_date is None:
-            end_date = datetime.now()
-        else:
-            if not isinstance(end_date,datetime):
-                # if it is a string, convert it to a datetime object
-                if isinstance(end_date,str):
-                    end_date = datetime.strptime(end_date,"%Y-%m-%d")
-                else:
-                    raise ValueError("end_date must be a datetime object")
-            
-        # if end_date is before start_date, raise an error
-        if end_date < start_date:
-            raise ValueError("end_date must be after start_date")
-
-        t = {'start': start_date.strftime("%Y-%m-%d"), 'end': end_date.strftime("%Y-%m-%d"), 'unit': 'day'}
-        
-        if location_ids is None:
-            ndvi_request = {'variable': sources, 'space': space, 'time': t, 'aggregation': aggregation}
-        else:
-            # location_ids must be a list of strings. if it is not, raise an error
-            if not isinstance(location_ids,list):
-                raise ValueError("location_ids must be a list")
-            for location_id in location_ids:
-                if not isinstance(location_id,str):
-                    raise ValueError("location_ids must be a list of strings")
-            # location_ids must be list of the same length as space. if it is not, raise an error
-            if len(location_ids) != len(space):
-                raise ValueError("location_ids must be a list of the same length as space")
-            # each item in location_ids must be unique. if it is not, raise an error
-            if len(location_ids) != len(set(location_ids)):
-                raise ValueError("location_ids must be a list of unique values")
-            ndvi_request = {'variable': sources, 'space': space, 'time': t, 'aggregation': aggregation, 'location_id': location_ids}
-        
-        if query_id is None:
+        return qid
+
+    # postprocess names the client side processing the result will get (e.g. 'savgol'); it is part of the request cache key
+    # groups are the PointGroups of a deduped request
+    def request_ndvi_(self,*,polygons=None,points=None,location_ids=None,aggregation="median",start_date=None,end_date=None,sources=None,query_id=None,shard_size=None,postprocess=None,groups=None):
+        started = time.perf_counter()
+        (ndvi_request,shards,query_id) = self.prepare_request(polygons=polygons,points=points,location_ids=location_ids,aggregation=aggregation,start_date=start_date,end_date=end_date,sources=sources,query_id=query_id,shard_size=shard_size,postprocess=postprocess,groups=groups)
+        if query_id is None and len(shards) > 1:
+            query_id = self.register_shards(self.submit_shards(shards,postprocess,groups))
+            self.remember_request(ndvi_request,query_id,postprocess,groups)
+        elif query_id is None:
             (query_id,access_url) = self.make_request(ndvi_request)
+            self.remember_request(ndvi_request,query_id,postprocess,groups)
+        return self.finish_request(query_id,ndvi_request,postprocess,groups,polygons is not None,len(shards),started)
+
+    # submit_shards()
+    # submits the shards of a split request concurrently over the connection pool and returns their
+    # (query id, offset). Every shard is looked up in and remembered to the request cache on its own, so a
+    # shard that went through is never lost when another one fails (see ShardSubmitError)
+    def submit_shards(self,shards,postprocess=None,groups=None):
+        def submit(shard):
+            cached_id = self.lookup_request(shard,postprocess,groups)
+            if cached_id is not None:
+                return cached_id
+            (qid,access_url) = self.make_request(shard)
+            self.remember_request(shard,qid,postprocess,groups)
+            return qid
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            futures = [pool.submit(submit,shard) for (shard,offset) in shards]
+        submitted = []
+        errors = []
+        for (future,(shard,offset)) in zip(futures,shards):
+            try:
+                submitted.append((future.result(),offset))
+            except Exception as e:
+                errors.append((offset,e))
+        if len(errors) > 0:
+            raise ShardSubmitError(submitted,errors)
+        return submitted
+
+    # resume()
+    # continues the journaled work after a restart, without resubmitting anything: waits for the queries that
+    # hadn't finished, then fetches every succeeded query that has no output yet, either with save_data()
+    # into output_dir/<name> or by calling fetch(query_id), which returns where it put the result. name is the
+    # query id, or a hash of it for composite queries (see journal.output_name()).
+    # A complete output_dir/<name> left by a save that crashed before it was journaled counts as done.
+    # An error fetching one query doesn't stop the others: it is recorded in the journal (and retried by
+    # the next resume()) and returned in place of the output.
+    # returns {query_id: output path (or what fetch returned), 'Failed' for failed queries, or the exception}
+    def resume(self,output_dir=None,fetch=None,timeout=None,chunk_rows=1_000_000):
+        if self.journal is None:
+            raise ValueError("resume() needs a journal: pass journal_path to the connection")
+        pending = [entry['query_id'] for entry in self.journal.entries(status='Submitted')]
+        for (query_id,final_status) in self.poll(pending,timeout):
+            pass
+        results = {entry['query_id']: 'Failed' for entry in self.journal.entries(status='Failed')}
+        if output_dir is None and fetch is None:
+            return results
+        for entry in self.journal.entries(status='Succeeded'):
+            query_id = entry['query_id']
+            if entry['output'] is not None:
+                continue
+            try:
+                results[query_id] = self.resume_query(query_id,entry['name'],output_dir,fetch,chunk_rows)
+            except Exception as e:
+                self.journal.update(query_id,error='{}: {}'.format(type(e).__name__,e))
+                results[query_id] = e
+        return results
+
+    # resume_query()
+    # fetches one query for resume() and returns its output. name is the journal's directory name for it
+    def resume_query(self,query_id,name,output_dir,fetch,chunk_rows):
+        if fetch is not None:
+            output = fetch(query_id)
+            if output is not None:
+                self.journal.update(query_id,output=str(output))
+            return output
+        output = os.path.join(output_dir,name)
+        # save_data() only ever moves a finished directory into place, so a non-empty one is complete
+        if os.path.isdir(output) and len(os.listdir(output)) > 0:
+            self.journal.update(query_id,output=os.path.abspath(output))
         else:
-            # query_id = query_id
-            access_url = f's3://streambatch-data/{query_id}.parquet'
-        print("Query ID: {}".format(query_id))
-        if polygons is not None:
-            print("Number of polygons: {}".format(len(space)))
-        elif points is not None:
-            print("Number of points: {}".format(len(space)))
-        print("Start date: {}".format(start_date.strftime("%Y-%m-%d")))
-        print("End date: {}".format(end_date.strftime("%Y-%m-%d")))
-        print("Aggregation: {}".format(aggregation))
-
-
-        return query_id
-    
-    def get_data(self,query_id,debug=False):
-        if query_id in savgol_qids:
-            df = self.get_data_(query_id)
-            df = savgol(df)
-            if( debug == True ):
-                return df
-            else:
-                # drop columns ndvi.sentinel2 and ndvi.landsat and ndvi.interpolated
-                df = df.drop(columns=['ndvi.sentinel2','ndvi.landsat','ndvi.interpolated'])
-                # rename column ndvi.savgol to ndvi
-                df = df.rename(columns={"ndvi.savgol":"ndvi"})
-                return df
-        else:
-            return self.get_data_(query_id)
-    
-    
+            self.save_data(query_id,output,chunk_rows)
+        return output
+
+    # get_data()
+    # set workers > 1 to run the savgol post-processing on that many processes
+    # only the given columns, locations (point/location indices or location ids) and dates between start and end
+    # are read; these are pushed down into the parquet read, so the rest is never downloaded (with cache_dir this
+    # holds until the result is cached: selective reads skip the cache, a full read downloads the whole file into it).
+    # For savgol queries only locations can be pushed down (smoothing needs the full series),
+    # columns and dates are applied to the smoothed result.
+    # result_format is 'pandas' (default), 'arrow' for a pyarrow Table straight from the parquet read,
+    # or 'compact' for a pandas frame with float32 ndvi, narrow integers and categorical location ids
+    def get_data(self,query_id,debug=False,workers=None,columns=None,locations=None,start=None,end=None,result_format='pandas'):
+        if result_format not in RESULT_FORMATS:
+            raise ValueError("result_format must be one of {}".format(RESULT_FORMATS))
+        with self.events.timed('fetch.done',query_id=query_id) as fields:
+            result = self.fetch_data(query_id,debug,workers,columns,locations,start,end,result_format)
+            fields['rows'] = self.result_rows(result)
+        return result
+
+    # fetch_data()
+    # the body of get_data(), which wraps it to report fetch.done
+    def fetch_data(self,query_id,debug,workers,columns,locations,start,end,result_format):
+        if not self.wait(query_id):
+            return None
+        (download,process) = self.result_stages(query_id,debug,workers,columns,locations,start,end,result_format)
+        return process(download())
+
     # do this step in as a separate function so that I can mock it in the tests
     def status(self,query_id):
-        status_response = requests.get('{}?query_id={}'.format(self.STATUS_URL, query_id), headers={'X-API-Key': self.api_key})
+        if query_id in sharded_qids:
+            return self.sharded_status(query_id)
+        status_response = self.send('GET', '{}?query_id={}'.format(self.STATUS_URL, query_id))
         return status_response.text
-    
+
     # do this step in as a separate function so that I can mock it in the tests
-    def read_parquet(self,access_url):
-        df = pd.read_parquet(access_url, storage_options={"anon": True})
-        return df
-
-    def get_data_(self,query_id):
-        final_status = None
-        access_url = f'{self.READ_URL}/{query_id}.parquet'
-        while final_status is None:
-            status = json.loads(self.status(query_id))
-            if status['status'] == 'Succeeded':
-                final_status = 'Succeeded'
-            elif status['status'] == 'Failed':
-                final_status = 'Failed'
-            else:
-                print(".",end="",flush=True)
-                time.sleep(5)
-        print("")
-        if final_status == 'Failed':
-            print("Error: {}".format(status)) # !!! need to parse the error message
+    # see load_parquet()
+    def read_parquet(self,access_url,columns=None,filters=None):
+        return self.load_parquet(access_url,columns,filters)
+
+    # read_table()
+    # same as read_parquet(), but returns the pyarrow Table without converting it to pandas
+    def read_table(self,access_url,columns=None,filters=None):
+        return self.load_table(access_url,columns,filters)
+
+    # sharded_status()
+    # status of a composite query: Failed as soon as one shard failed, Succeeded once all shards succeeded
+    # a composite query is Running until every shard has finished, then Succeeded, or Failed if any shard
+    # failed; failed_shards lists the shards that failed so far (see partial_query())
+    def sharded_status(self,query_id):
+        shard_ids = [qid for (qid,offset) in sharded_qids[query_id]]
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            statuses = [json.loads(s) for s in pool.map(self.status,shard_ids)]
+        return json.dumps(self.merge_shard_statuses(shard_ids,statuses))
+
+    # partial_query()
+    # for a finished composite query some of whose shards failed: returns (query id, failed) where query id
+    # stands for the shards that succeeded (None if none did) and failed lists the (query id, offset) of the
+    # others. get_data() reads the partial query like any other; its points keep their index in the full
+    # request, so the rows of the failed shards are simply missing. Resubmit those with request_ndvi().
+    def partial_query(self,query_id):
+        if query_id not in sharded_qids:
+            raise ValueError("{} is not a composite (sharded) query".format(query_id))
+        return self.split_partial(query_id,json.loads(self.status(query_id)))
+
+    # read_result()
+    # reads the result of a finished query. The shards of a composite query are downloaded in parallel,
+    # their point/location index is shifted back to the position in the full request, and they are concatenated
+    # with as_arrow=True the result is a pyarrow Table instead of a DataFrame
+    def read_result(self,query_id,columns=None,locations=None,start=None,end=None,as_arrow=False):
+        reads = self.plan_reads(query_id,locations)
+        read_fn = self.read_table if as_arrow else self.read_parquet
+        def read(plan):
+            (url,shard_locations,offset) = plan
+            return read_fn(url,columns=columns,filters=self.build_filters(url,shard_locations,start,end))
+        if query_id not in sharded_qids:
+            return read(reads[0])
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            parts = list(pool.map(read,reads))
+        offsets = [offset for (url,shard_locations,offset) in reads]
+        if as_arrow:
+            return self.merge_tables(parts,offsets)
+        return self.merge_shards(parts,offsets)
+
+    def get_data_(self,query_id,columns=None,locations=None,start=None,end=None,result_format='pandas'):
+        if not self.wait(query_id):
             return None
-        else:
-            df = self.read_parquet(access_url)
+        return self.read_finished(query_id,columns,locations,start,end,result_format)
+
+    # read_finished()
+    # reads the stored result of a query that has succeeded, in result_format
+    def read_finished(self,query_id,columns=None,locations=None,start=None,end=None,result_format='pandas'):
+        if result_format == 'pandas':
+            df = self.read_result(query_id,columns,locations,start,end)
             # !!! need to add the polygon id to the dataframe
             return df
+        else:
+            table = self.read_result(query_id,columns,locations,start,end,as_arrow=True)
+            if result_format == 'compact':
+                return compact_table(table).to_pandas()
+            return table
+
+    # wait()
+    # blocks until the query has finished. returns True if it succeeded
+    def wait(self,query_id):
+        delays = self.poll_delays()
+        polls = 0
+        started = time.perf_counter()
+        while True:
+            status = json.loads(self.status(query_id))
+            polls += 1
+            final_status = self.check_wait(query_id,status,polls)
+            if final_status is not None:
+                return self.end_wait(query_id,status,final_status,polls,started)
+            time.sleep(next(delays))
+
+    # iter_data()
+    # like get_data(), but streams the result instead of loading it in one piece: yields one DataFrame
+    # (or pyarrow RecordBatch with as_arrow=True) of at most batch_size rows at a time, reading the
+    # parquet row group by row group. Memory use depends on batch_size, not on the size of the result.
+    # For deduped queries a batch also holds the copies of its rows, so it can be larger than batch_size.
+    def iter_data(self,query_id,batch_size=65536,as_arrow=False):
+        if query_id in savgol_qids:
+            raise ValueError("iter_data() can't smooth on the fly; use get_data() for ndvi.savgol queries")
+        if not self.wait(query_id):
+            return
+        yield from self.iter_batches(query_id,batch_size,as_arrow)
+
+    # iter_batches()
+    # the batches of iter_data() for a query that has finished
+    def iter_batches(self,query_id,batch_size,as_arrow):
+        groups = self.point_groups(query_id)
+        if query_id in sharded_qids:
+            shards = sharded_qids[query_id]
+        else:
+            shards = [(query_id,0)]
+        for (qid,offset) in shards:
+            pf = self.open_parquet(f'{self.READ_URL}/{qid}.parquet')
+            try:
+                for batch in pf.iter_batches(batch_size=batch_size):
+                    if offset != 0:
+                        batch = self.shift_batch(batch,offset)
+                    if groups is not None:
+                        # rows stay in file order, each one followed by its copies
+                        batch = groups.fan_out(batch,sort=False)
+                    if as_arrow:
+                        yield batch
+                    else:
+                        yield batch.to_pandas()
+            finally:
+                pf.close(force=True)
+
+    # save_data()
+    # writes the result of a query to a directory of parquet files, a chunk at a time, and returns a
+    # pyarrow Dataset over them (a lazy handle: nothing is loaded until it is scanned or filtered).
+    # ndvi.savgol queries are read, smoothed and written chunk_rows input rows (whole locations) at a
+    # time, so memory use depends on chunk_rows, not on the number of locations. Other queries are
+    # copied across in batches of chunk_rows rows. debug and workers are as for get_data()
+    # The files are written to path + '.partial' and moved to path when all of them are written, so an
+    # interrupted save never leaves a half written result at path; a leftover .partial is started over
+    def save_data(self,query_id,path,chunk_rows=1_000_000,debug=False,workers=None):
+        if os.path.isdir(path) and len(os.listdir(path)) > 0:
+            raise ValueError("{} is not empty".format(path))
+        if not self.wait(query_id):
+            return None
+        partial = path + '.partial'
+        if os.path.isdir(partial):
+            shutil.rmtree(partial)
+        os.makedirs(partial)
+        with self.events.timed('fetch.done',query_id=query_id) as fields:
+            parts = self.savgol_chunks(query_id,chunk_rows,debug,workers) if query_id in savgol_qids else self.iter_batches(query_id,chunk_rows,True)
+            rows = 0
+            files = 0
+            for part in parts:
+                if part.num_rows == 0:
+                    continue
+                pq.write_table(pa.Table.from_batches([part]) if isinstance(part,pa.RecordBatch) else part,os.path.join(partial,'part-{:05d}.parquet'.format(files)))
+                rows += part.num_rows
+                files += 1
+            fields['rows'] = rows
+        if os.path.isdir(path):
+            os.rmdir(path)
+        os.replace(partial,path)
+        if self.journal is not None:
+            self.journal.update(query_id,output=os.path.abspath(path))
+        return ds.dataset(path,format='parquet')
+
+    # savgol_chunks()
+    # the smoothed result of a savgol query as pyarrow Tables, one per chunk of locations (see chunked.py)
+    def savgol_chunks(self,query_id,chunk_rows,debug=False,workers=None):
+        groups = self.point_groups(query_id)
+        for (qid,offset) in sharded_qids.get(query_id,[(query_id,0)]):
+            pf = self.open_parquet(f'{self.READ_URL}/{qid}.parquet')
+            try:
+                col = id_column(pf.schema_arrow.names)
+                ranges = row_group_ranges(pf,col)
+                for (lo,hi) in location_chunks(location_counts(pf,col),chunk_rows):
+                    df = read_locations(pf,col,lo,hi,ranges).to_pandas()
+                    df[col] = df[col] + offset
+                    table = pa.Table.from_pandas(self.postprocess_savgol(df,debug,workers),preserve_index=False)
+                    yield table if groups is None else groups.fan_out(table)
+            finally:
+                pf.close(force=True)
 
     def query_done(self,query_id):
         status = json.loads(self.status(query_id))
-        if status['status'] == 'Succeeded':
-            return True
-        elif status['status'] == 'Failed':
-            return True
-        else:
-            return False
-    
+        return self.final_status(status) is not None
+
+    # poll()
+    # checks all query_ids on one shared schedule and yields (query_id, final status) as each one finishes.
+    # the status calls of one round run in parallel over the connection pool
+    def poll(self,query_ids,timeout=None):
+        pending = list(dict.fromkeys(query_ids))
+        delays = self.poll_delays()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.pool_size) as pool:
+            while len(pending) > 0:
+                responses = list(pool.map(self.status,pending))
+                still_pending = []
+                for (query_id,response) in zip(pending,responses):
+                    status = json.loads(response)
+                    final_status = self.final_status(status)
+                    if final_status is None:
+                        still_pending.append(query_id)
+                    else:
+                        self.events.emit('query.finished',query_id=query_id,seconds=time.perf_counter() - started,status=final_status)
+                        self.record_status(query_id,final_status)
+                        if final_status == 'Failed':
+                            self.forget_failed(query_id,status)
+                        yield (query_id,final_status)
+                pending = still_pending
+                if len(pending) > 0:
+                    delay = next(delays)
+                    if deadline is not None and time.monotonic() + delay > deadline:
+                        raise TimeoutError("{} queries still running: {}".format(len(pending),pending))
+                    time.sleep(delay)
+
+    # as_completed()
+    # yields each query id as soon as it has succeeded or failed
+    def as_completed(self,query_ids,timeout=None):
+        for (query_id,final_status) in self.poll(query_ids,timeout):
+            yield query_id
+
+    # wait_all()
+    # blocks until every query has finished. returns a dict of query id -> 'Succeeded' or 'Failed'
+    def wait_all(self,query_ids,timeout=None):
+        return dict(self.poll(query_ids,timeout))
+
+    # fetch_many()
+    # fetches many queries as a pipeline and yields (query_id, result) in the order the results are ready
+    # (result is None for a failed query). The queries are polled together (see poll()); as each one
+    # succeeds its result is downloaded by one of download_workers threads and then processed (smoothed,
+    # fanned out, converted) by one of process_workers threads. So while one result is being smoothed the
+    # next ones are downloading and the rest are still polled, and a batch takes about as long as its
+    # slowest stage instead of the sum of all of them. At most max_pending results are downloaded or held
+    # ahead of the caller: polling waits for the caller to catch up, which bounds memory use.
+    # The other arguments are as for get_data(); an error in any stage is raised here.
+    def fetch_many(self,query_ids,debug=False,workers=None,columns=None,locations=None,start=None,end=None,result_format='pandas',timeout=None,download_workers=4,process_workers=2,max_pending=8):
+        if result_format not in RESULT_FORMATS:
+            raise ValueError("result_format must be one of {}".format(RESULT_FORMATS))
+        query_ids = list(dict.fromkeys(query_ids))
+        results = queue.Queue()
+        slots = threading.Semaphore(max(max_pending,1))
+        stop = threading.Event()
+        download_pool = ThreadPoolExecutor(max_workers=download_workers)
+        process_pool = ThreadPoolExecutor(max_workers=process_workers)
+
+        def process_stage(query_id,process,raw,started):
+            try:
+                with self.events.timed('fetch.stage',query_id=query_id,stage='process'):
+                    result = process(raw)
+                self.events.emit('fetch.done',query_id=query_id,seconds=time.perf_counter() - started,rows=self.result_rows(result))
+                results.put((query_id,result,None,True))
+            except BaseException as e:
+                results.put((query_id,None,e,True))
+
+        def download_stage(query_id,started):
+            try:
+                (download,process) = self.result_stages(query_id,debug,workers,columns,locations,start,end,result_format)
+                with self.events.timed('fetch.stage',query_id=query_id,stage='download'):
+                    raw = download()
+                if not stop.is_set():
+                    process_pool.submit(process_stage,query_id,process,raw,started)
+            except BaseException as e:
+                results.put((query_id,None,e,True))
+
+        def poll_stage():
+            try:
+                for (query_id,final_status) in self.poll(query_ids,timeout):
+                    if final_status == 'Failed':
+                        results.put((query_id,None,None,False))
+                        continue
+                    # backpressure: wait until fewer than max_pending results are in flight
+                    while not slots.acquire(timeout=0.1):
+                        if stop.is_set():
+                            return
+                    if stop.is_set():
+                        return
+                    download_pool.submit(download_stage,query_id,time.perf_counter())
+            except BaseException as e:
+                results.put((None,None,e,False))
 
+        poller = threading.Thread(target=poll_stage,daemon=True)
+        poller.start()
+        try:
+            for _ in query_ids:
+                (query_id,result,error,held) = results.get()
+                if error is not None:
+                    raise error
+                if held:
+                    slots.release()
+                yield (query_id,result)
+        finally:
+            stop.set()
+            download_pool.shutdown(wait=False)
+            process_pool.shutdown(wait=False)
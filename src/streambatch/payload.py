@@ -0,0 +1,168 @@
+import gzip
+import numbers
+
+from .encoding import dumps
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+
+# Request payload optimizer (opt-in, see coordinate_precision and compress_requests on the connection)
+# - coordinates are rounded to precision decimals (6 decimals is about 0.1 m, far below the 10 m pixels)
+# - ring vertices that become redundant are dropped: repeats of the previous vertex, and vertices in the
+#   middle of a straight run. Both tests are exact on the rounded grid and neither moves the rounded
+#   boundary. A ring that would end up with fewer than 3 corners is sent unchanged
+# - rounding itself moves vertices, and a vertex that moves past a nearby edge makes the polygon cross
+#   itself (or a hole cross its shell). Every rounded geometry is checked for that, exactly on the integer
+#   grid, and a geometry that is no longer simple is sent with its original coordinates
+# - Points, MultiPoints, LineStrings and the like are only rounded; the ring steps above apply to (Multi)Polygons
+# - the json body is gzipped
+
+# is_position()
+# True for a GeoJSON position ([longitude, latitude])
+def is_position(value):
+    return isinstance(value,(list,tuple)) and len(value) >= 2 and isinstance(value[0],numbers.Number)
+
+# simplify_ring()
+# ring is a closed GeoJSON ring (first vertex == last vertex). returns the ring rounded to precision
+# decimals without redundant vertices
+def simplify_ring(ring,precision):
+    scale = 10 ** precision
+    # integer grid coordinates, so the collinearity test below is exact
+    grid = np.round(np.asarray(ring,dtype=np.float64)[:,:2] * scale).astype(np.int64)
+    if len(grid) > 1 and (grid[0] == grid[-1]).all():
+        grid = grid[:-1]
+    # repeats of the previous vertex (cyclically, so the first vertex is compared with the last)
+    grid = grid[(grid != np.roll(grid,1,axis=0)).any(axis=1)]
+    if len(grid) >= 3:
+        incoming = grid - np.roll(grid,1,axis=0)
+        outgoing = np.roll(grid,-1,axis=0) - grid
+        cross = incoming[:,0] * outgoing[:,1] - incoming[:,1] * outgoing[:,0]
+        dot = (incoming * outgoing).sum(axis=1)
+        # straight through: same direction in and out. a vertex where the ring turns back (a spike) is kept
+        grid = grid[(cross != 0) | (dot <= 0)]
+    if len(grid) < 3:
+        return [list(position) for position in ring]
+    coords = np.round(grid / scale,precision)
+    return np.vstack([coords,coords[:1]]).tolist()
+
+# simplify_coordinates()
+# applies simplify_ring() to every ring of a Polygon/MultiPolygon coordinate array (any nesting depth)
+def simplify_coordinates(coordinates,precision):
+    if len(coordinates) > 0 and is_position(coordinates[0]):
+        if len(coordinates) >= 4:
+            return simplify_ring(coordinates,precision)
+        return np.round(np.asarray(coordinates,dtype=np.float64),precision).tolist()
+    return [simplify_coordinates(c,precision) for c in coordinates]
+
+# rings()
+# the rings of a Polygon/MultiPolygon coordinate array, as lists of positions without the closing one
+def rings(coordinates):
+    if len(coordinates) > 0 and is_position(coordinates[0]):
+        return [coordinates[:-1]] if len(coordinates) >= 4 else []
+    return [ring for c in coordinates for ring in rings(c)]
+
+# orientation()
+# sign of the turn a -> b -> c: 1 left, -1 right, 0 collinear
+def orientation(a,b,c):
+    cross = (b[0] - a[0]) * (c[1] - a[1]) - (b[1] - a[1]) * (c[0] - a[0])
+    return (cross > 0) - (cross < 0)
+
+# within()
+# for collinear a, b, c: True if c lies on the segment a-b
+def within(a,b,c):
+    return min(a[0],b[0]) <= c[0] <= max(a[0],b[0]) and min(a[1],b[1]) <= c[1] <= max(a[1],b[1])
+
+# segments_meet()
+# True if the closed segments a-b and c-d have a point in common
+def segments_meet(a,b,c,d):
+    (o1,o2,o3,o4) = (orientation(a,b,c),orientation(a,b,d),orientation(c,d,a),orientation(c,d,b))
+    if o1 != o2 and o3 != o4:
+        return True
+    return (o1 == 0 and within(a,b,c)) or (o2 == 0 and within(a,b,d)) or (o3 == 0 and within(c,d,a)) or (o4 == 0 and within(c,d,b))
+
+# is_simple()
+# True if no two edges of the rings (lists of grid positions) meet, other than consecutive edges of a
+# ring at their shared vertex. Only edges whose bounding boxes overlap are compared; the test uses
+# python integers, so it is exact at any precision
+def is_simple(ring_list):
+    edges = []
+    for (r,ring) in enumerate(ring_list):
+        n = len(ring)
+        for i in range(n):
+            (a,b) = (tuple(ring[i]),tuple(ring[(i + 1) % n]))
+            edges.append((min(a[0],b[0]),max(a[0],b[0]),min(a[1],b[1]),max(a[1],b[1]),r,i,n,a,b))
+    edges.sort(key=lambda edge: edge[0])
+    for (k,(x0,x1,y0,y1,r,i,n,a,b)) in enumerate(edges):
+        for (u0,u1,v0,v1,r2,j,n2,c,d) in edges[k + 1:]:
+            if u0 > x1:
+                break
+            if v0 > y1 or v1 < y0:
+                continue
+            step = (j - i) % n if r == r2 else None
+            if step == 1 or step == n - 1:
+                # consecutive edges share a vertex; they only overlap if the ring doubles back on itself there
+                (p,v,q) = (a,b,d) if step == 1 else (c,d,b)
+                if orientation(p,v,q) == 0 and (v[0] - p[0]) * (q[0] - v[0]) + (v[1] - p[1]) * (q[1] - v[1]) < 0:
+                    return False
+            elif segments_meet(a,b,c,d):
+                return False
+    return True
+
+# simplify_geometry()
+# the coordinates of a Polygon/MultiPolygon rounded by simplify_coordinates(), or the original coordinates
+# if the rounded geometry isn't simple
+def simplify_geometry(coordinates,precision):
+    simplified = simplify_coordinates(coordinates,precision)
+    scale = 10 ** precision
+    grid = [[(int(round(x * scale)),int(round(y * scale))) for (x,y,*_) in ring] for ring in rings(simplified)]
+    if not is_simple(grid):
+        return coordinates
+    return simplified
+
+# round_coordinates()
+# a GeoJSON coordinate array of any nesting depth (a Point's position, a MultiPoint's list of them, ...)
+# with every number rounded to precision decimals
+def round_coordinates(coordinates,precision):
+    if is_position(coordinates):
+        return [round(float(v),precision) for v in coordinates]
+    return [round_coordinates(c,precision) for c in coordinates]
+
+# quantize_geometry()
+# a GeoJSON geometry rounded to precision decimals: Polygons and MultiPolygons go through simplify_geometry(),
+# other geometries only have their coordinates rounded
+def quantize_geometry(geometry,precision):
+    kind = geometry.get('type')
+    if kind == 'GeometryCollection':
+        return dict(geometry,geometries=[quantize_geometry(g,precision) for g in geometry['geometries']])
+    if kind in ('Polygon','MultiPolygon'):
+        return dict(geometry,coordinates=simplify_geometry(geometry['coordinates'],precision))
+    return dict(geometry,coordinates=round_coordinates(geometry['coordinates'],precision))
+
+# quantize_space()
+# the space of a request with every coordinate rounded to precision decimals
+def quantize_space(space,precision):
+    if isinstance(space,np.ndarray):
+        return np.round(space,precision)
+    out = []
+    for item in space:
+        if isinstance(item,dict):
+            out.append(quantize_geometry(item,precision))
+        else:
+            out.append(np.round(np.asarray(item,dtype=np.float64),precision).tolist())
+    return out
+
+# encode_request()
+# the body to send for ndvi_request, plus its content encoding (None or 'gzip') and a size report:
+# raw is the plain json size, json the size after quantizing and sent what goes over the wire
+def encode_request(ndvi_request,precision=None,compress=False):
+    body = dumps(ndvi_request)
+    report = {'raw': len(body)}
+    if precision is not None:
+        body = dumps(dict(ndvi_request,space=quantize_space(ndvi_request['space'],precision)))
+    report['json'] = len(body)
+    encoding = None
+    if compress:
+        body = gzip.compress(body,compresslevel=6)
+        encoding = 'gzip'
+    report['sent'] = len(body)
+    return (body,encoding,report)
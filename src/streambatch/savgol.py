@@ -1,6 +1,9 @@
+import os
 import pandas as pd
 import numpy as np
-from scipy.signal import savgol_filter
+from concurrent.futures import ProcessPoolExecutor
+from scipy.ndimage import convolve1d
+from scipy.signal import savgol_coeffs, savgol_filter
 
 #
 # Find outliers
@@ -20,34 +23,62 @@ def find_outliers(m2):
     m2['rolling std'] = rolling_std
     m2['zscore'] = (m2['ndvi'] - rolling_mean) / rolling_std
     m2['delta'] = m2['ndvi'] - m2['rolling mean']
-    m2['outlier'] = (m2['delta'].abs() > 0.08) & (m2['zscore'].abs() > 1.5)
+    # the decision itself comes from outlier_mask(), so that it agrees with remove_outliers()
+    m2['outlier'] = outlier_mask(m2)
     return m2
 
 # remove_outliers()
 # m is a dataframe with columns time and ndvi
-# returns a dataframe with outliers removed
-def remove_outliers(m):
-    m1 = m.copy()
-    m1 = find_outliers(m1)
-    m2 = m1[m1['outlier']==False]
-    # print(f"removed {m1.shape[0] - m2.shape[0]} outliers")
-    m2 = m2.drop(columns=['rolling mean', 'rolling std', 'zscore', 'delta', 'outlier'])
-    return m2
+# returns a dataframe with outliers removed (see outlier_mask() for by and the thresholds)
+def remove_outliers(m,by=None,zscore=1.5,delta=0.08):
+    return m[~outlier_mask(m,by,zscore=zscore,delta=delta)]
 
+# outlier_mask()
+# the test of find_outliers() as a boolean numpy array (True for outliers), without touching m.
+# if by is set (e.g. 'point' or 'location'), m may hold many locations sorted by (by, time) and
+# no window reaches from one location into the next. Like the rolling window in find_outliers(),
+# the window/2 observations at either end of a location are never outliers
+def outlier_mask(m,by=None,window=7,zscore=1.5,delta=0.08):
+    if window % 2 == 0:
+        raise ValueError("window must be odd")
+    values = m['ndvi'].to_numpy(dtype=float)
+    n = len(values)
+    mask = np.zeros(n, dtype=bool)
+    if n < window:
+        return mask
+    half = window // 2
+    # every window is summed on its own (not as a running sum), so a window's result doesn't depend
+    # on what came before it. windows are added up as shifted slices, which is much faster than
+    # reducing a (n, window) view along its short axis
+    count = n - window + 1
+    total = values[:count].copy()
+    for k in range(1, window):
+        total += values[k:k + count]
+    mean = total / window
+    squares = np.zeros(count)
+    for k in range(window):
+        d = values[k:k + count] - mean
+        squares += d * d
+    std = np.sqrt(squares / (window - 1))
+    center = values[half:n - half]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        flags = (np.abs(center - mean) > delta) & (np.abs((center - mean) / std) > zscore)
+    if by is not None:
+        # groups are contiguous, so a window lies inside one group when its first and last row do
+        keys = m[by].to_numpy()
+        flags &= keys[:n - window + 1] == keys[window - 1:]
+    mask[half:n - half] = flags
+    return mask
 
-# handle_duplicates()
-# sometimes we end up with observations from s2 and l8 on the same day.
-# when this happens, we need reduce to one observation per day
-# !!! a better solution is the choose the "better" observation based on before and after
-def handle_duplicates(m):
-    # find successive rows with the same time
-    # if there are two rows with the same time, keep the first one
-    m1 = m.copy()
-    m1['duplicate'] = m1['time'].eq(m1['time'].shift(-1))
-    m2 = m1[m1['duplicate']==False]
-    # print(f"removed {m1.shape[0] - m2.shape[0]} duplicates")
-    m2 = m2.drop(columns=['duplicate'])
-    return m2
+
+# same-day rules for prepare(): what ndvi to use when sentinel2 and landsat both have an observation on the
+# same day. Each takes the sentinel2 and landsat values of those days (numpy arrays) and returns the values to use.
+# Pass one of these names or your own function as same_day (with workers > 1 it has to be picklable)
+SAME_DAY_RULES = {
+    'landsat': lambda s2, l8: l8,
+    'sentinel2': lambda s2, l8: s2,
+    'mean': lambda s2, l8: (s2 + l8) / 2,
+}
 
 # prepare()
 # m is a dataframe with columns time, ndvi.sentinel2, ndvi.landsat, qa.sentinel2, qa.landsat
@@ -55,118 +86,376 @@ def handle_duplicates(m):
 # We convert this into a sparse dataframe with columns time, ndvi
 # where there is only an entry if we have a valid ndvi value for that date from at least one source
 # we return (m, s2, l8), where m is the sparse dataframe, s2 is the original sentinel2 data, l8 is the original landsat data
-def prepare(df):
+# same_day picks the ndvi of days with both a sentinel2 and a landsat observation (see SAME_DAY_RULES);
+# by default landsat is used.
+# Everything is worked out on numpy arrays over the sorted rows; the three frames are each built with one take
+def prepare(df,same_day='landsat'):
     # is this points or polygons?
     sort_col = 'point'
     if df.columns[0] != 'point':
         sort_col = 'location'
-    df = df.sort_values(by=[sort_col, 'time'])
-    # slice off all rows where qa.sentinel2 == 1
-    s2 = df[df['qa.sentinel2'] == 1].copy()
-    # remove columns ndvi.landsat, qa.landsat, qa.sentinel2
-    s2 = s2.drop(columns=['ndvi.landsat', 'qa.landsat', 'qa.sentinel2'])
-    # rename ndvi.sentinel2 to ndvi
-    s2 = s2.rename(columns={'ndvi.sentinel2': 'ndvi'})
-    # remove any row where ndvi is the same as the previous row
-    s2 = s2[s2['ndvi'] != s2['ndvi'].shift(1)]
-
-    # slice off all rows where qa.landsat8 == 1
-    l8 = df[df['qa.landsat'] == 1].copy()
-    # remove columns ndvi.sentinel2, qa.landsat, qa.sentinel2
-    l8 = l8.drop(columns=['ndvi.sentinel2', 'qa.landsat', 'qa.sentinel2'])
-    # rename ndvi.landsat to ndvi
-    l8 = l8.rename(columns={'ndvi.landsat': 'ndvi'})
-    # remove any row where ndvi is the same as the previous row
-    l8 = l8[l8['ndvi'] != l8['ndvi'].shift(1)]
-
-    # concat s2 and l8
-    m = pd.concat([s2, l8])
-    # sort by lat, time
-    m = m.sort_values(by=[sort_col, 'time'])
-    m = handle_duplicates(m)
-    # reset index
-    m = m.reset_index(drop=True)
-    # in s2, rename column ndvi to ndvi.sentinel2
-    s2 = s2.rename(columns={'ndvi': 'ndvi.sentinel2'})
-    # in l8, rename column ndvi to ndvi.landsat
-    l8 = l8.rename(columns={'ndvi': 'ndvi.landsat'})
-    return (m, s2, l8)
+    if isinstance(same_day, str):
+        if same_day not in SAME_DAY_RULES:
+            raise ValueError("Unknown same_day rule: {}. same_day must be a function or one of {}".format(same_day, list(SAME_DAY_RULES)))
+        rule = SAME_DAY_RULES[same_day]
+    else:
+        rule = same_day
+    keys = df[sort_col].to_numpy()
+    times = df['time'].to_numpy()
+    # server results are already sorted by location, time; only sort when they aren't
+    if len(df) > 1 and not ((keys[1:] > keys[:-1]) | ((keys[1:] == keys[:-1]) & (times[1:] > times[:-1]))).all():
+        order = np.lexsort((times, keys))
+        df = df.iloc[order]
+        keys = keys[order]
 
+    # valid observations of each sensor, minus the ones that repeat the previous value of that sensor
+    # (a repeat is the same image seen again, not a new observation)
+    rows = {}
+    for sensor in ['sentinel2', 'landsat']:
+        idx = np.flatnonzero(df['qa.' + sensor].to_numpy() == 1)
+        values = df['ndvi.' + sensor].to_numpy()[idx]
+        fresh = np.ones(len(idx), dtype=bool)
+        fresh[1:] = (values[1:] != values[:-1]) | (keys[idx[1:]] != keys[idx[:-1]])
+        rows[sensor] = idx[fresh]
 
-def savgol_(m,s2,l8,window_length=20,polyorder=2):
-    m = remove_outliers(m)
-    min_date = m["time"].min()
-    max_date = m["time"].max()
-    date_range = pd.date_range(min_date, max_date, freq='D')
+    # the sparse table: one row per day with an observation from either sensor
+    has_s2 = np.zeros(len(df), dtype=bool)
+    has_s2[rows['sentinel2']] = True
+    has_l8 = np.zeros(len(df), dtype=bool)
+    has_l8[rows['landsat']] = True
+    obs = np.flatnonzero(has_s2 | has_l8)
+    ndvi_s2 = df['ndvi.sentinel2'].to_numpy()[obs]
+    ndvi_l8 = df['ndvi.landsat'].to_numpy()[obs]
+    both = has_s2[obs] & has_l8[obs]
+    ndvi = np.where(has_l8[obs], ndvi_l8, ndvi_s2)
+    ndvi[both] = rule(ndvi_s2[both], ndvi_l8[both])
 
-    # Create a new DataFrame 'm1' with a column 'time' that contains all dates in the range
-    m1 = pd.DataFrame({"time": date_range})
+    drop = ['qa.sentinel2', 'qa.landsat']
+    s2_cols = [i for (i, c) in enumerate(df.columns) if c not in drop + ['ndvi.landsat']]
+    l8_cols = [i for (i, c) in enumerate(df.columns) if c not in drop + ['ndvi.sentinel2']]
+    m = df.iloc[obs, s2_cols].rename(columns={'ndvi.sentinel2': 'ndvi'}).reset_index(drop=True)
+    m['ndvi'] = ndvi
+    s2 = df.iloc[rows['sentinel2'], s2_cols]
+    l8 = df.iloc[rows['landsat'], l8_cols]
+    return (m, s2, l8)
 
-    # Populate it with NDVI values where we have them and NaN where we don't
-    m1 = pd.merge(m1, m, on="time", how="left")
 
-    # Interpolate missing values in the 'ndvi' column
-    m1["ndvi"] = m1["ndvi"].interpolate()
+# group_bounds()
+# keys is an array of point/location ids sorted so that each id forms one contiguous run
+# returns (starts, ends) with the row index where each run starts and ends (exclusive)
+def group_bounds(keys):
+    n = len(keys)
+    if n == 0:
+        return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    change = np.flatnonzero(keys[1:] != keys[:-1]) + 1
+    starts = np.concatenate([[0], change])
+    ends = np.concatenate([change, [n]])
+    return (starts, ends)
 
-    m1 = m1.ffill() # forward fill the other columns like lat, lon, point, location, etc
+# interpolate_groups()
+# linear interpolation of the NaNs in values, never reaching across a group boundary.
+# matches pandas Series.interpolate(): leading NaNs stay NaN, trailing NaNs take the last valid value
+def interpolate_groups(values, starts, ends):
+    n = len(values)
+    lengths = ends - starts
+    group_start = np.repeat(starts, lengths)
+    group_end = np.repeat(ends, lengths)
+    idx = np.arange(n)
+    valid = ~np.isnan(values)
+    prev = np.maximum.accumulate(np.where(valid, idx, -1))
+    nxt = np.minimum.accumulate(np.where(valid, idx, n)[::-1])[::-1]
+    has_prev = prev >= group_start
+    has_next = nxt < group_end
+    out = values.copy()
+    inner = ~valid & has_prev & has_next
+    p = prev[inner]
+    q = nxt[inner]
+    # same arithmetic as np.interp so the result is identical to the per-location version
+    slope = (values[q] - values[p]) / (q - p)
+    out[inner] = slope * (idx[inner] - p) + values[p]
+    tail = ~valid & has_prev & ~has_next
+    out[tail] = values[prev[tail]]
+    return out
 
-    # if there is a column called "point" or "location" coerce it to int
-    if "point" in m1.columns:
-        m1["point"] = m1["point"].astype(int)
-    if "location" in m1.columns:
-        m1["location"] = m1["location"].astype(int)
+# savgol_filter_groups()
+# applies scipy's savgol_filter (mode='interp') to every group of the flat array x at once.
+# the interior of every group is a plain convolution, so it is done in one pass over x;
+# only the window_length // 2 values at each end need scipy's polynomial edge fit
+def savgol_filter_groups(x, starts, ends, window_length, polyorder):
+    lengths = ends - starts
+    if len(lengths) > 0 and lengths.min() < window_length:
+        raise ValueError("Each location needs at least window_length={} days of data to apply the savgol filter".format(window_length))
+    coeffs = savgol_coeffs(window_length, polyorder)
+    y = convolve1d(x, coeffs, mode="constant")
+    if len(lengths) == 0:
+        return y
+    halflen = window_length // 2
+    offsets = np.arange(window_length)
+    for (window_starts, sl) in [(starts, slice(0, halflen)), (ends - window_length, slice(window_length - halflen, window_length))]:
+        edges = x[window_starts[:, None] + offsets]
+        fitted = np.full(edges.shape, np.nan)
+        # polyfit does not handle NaNs, so any window with a NaN gets NaN edge values
+        ok = ~np.isnan(edges).any(axis=1)
+        if ok.any():
+            fitted[ok] = savgol_filter(edges[ok], window_length, polyorder, axis=1)
+        y[window_starts[:, None] + offsets[sl]] = fitted[:, sl]
+    return y
 
+# savgol_batch()
+# the smoothing engine behind savgol(). m, s2 and l8 are the output of prepare() and may
+# contain any number of points/locations (sort_col names the id column).
+# Instead of building a daily frame per location, one dense (location x day) grid is built for all
+# locations at once: each observation is repeated for itself and the days up to the next observation
+# (which is exactly what the per-location merge + ffill did), the ndvi gaps are interpolated,
+# and the savgol filter is applied to the whole grid.
+def savgol_batch(m,s2,l8,sort_col,window_length=20,polyorder=2,outlier_zscore=1.5,outlier_delta=0.08):
+    m = remove_outliers(m,by=sort_col,zscore=outlier_zscore,delta=outlier_delta)
+    m = m.reset_index(drop=True)
+    if len(m) == 0:
+        raise ValueError("There are no observations to smooth")
+    keys = m[sort_col].to_numpy()
+    (starts, ends) = group_bounds(keys)
+
+    # number of days each observation covers: itself plus the gap up to the next one
+    times = m['time'].to_numpy()
+    days = (times - times[0]) // np.timedelta64(1, 'D')
+    span = np.ones(len(m), dtype=np.int64)
+    span[:-1] = days[1:] - days[:-1]
+    span[ends - 1] = 1
+    rep = np.repeat(np.arange(len(m)), span)
+    obs_pos = np.cumsum(span) - span
+    offset = np.arange(len(rep)) - np.repeat(obs_pos, span)
+    dense_starts = obs_pos[starts]
+    dense_ends = np.append(dense_starts[1:], len(rep))
+
+    # dense grid: forward fill every column from the observation, then fix up time and ndvi
+    m1 = m.iloc[rep].reset_index(drop=True)
+    m1['time'] = times[rep] + offset.astype('timedelta64[D]')
+    ndvi = np.full(len(rep), np.nan)
+    ndvi[obs_pos] = m['ndvi'].to_numpy(dtype=float)
+    ndvi = interpolate_groups(ndvi, dense_starts, dense_ends)
 
     # Fill missing values with NaN, so the filter doesn't treat them as zeros
     # !!! there shouldnt be any missing values at this point. not sure I need this
-    m1["ndvi"] = m1["ndvi"].replace(0, np.nan)
+    ndvi[ndvi == 0] = np.nan
+    m1['ndvi'] = ndvi
+    m1['ndvi.savgol'] = savgol_filter_groups(ndvi, dense_starts, dense_ends, window_length, polyorder)
 
-    # Apply the savgol_filter to smooth the "ndvi" column
-    m1["ndvi.savgol"] = savgol_filter(m1["ndvi"], window_length, polyorder)
-
-    # rename column ndvi to ndvi.interpolated
+    # time first, like the original pd.merge against a date_range
+    m1 = m1[['time'] + [c for c in m1.columns if c != 'time']]
     m1 = m1.rename(columns={'ndvi': 'ndvi.interpolated'})
 
-    # now let's add two more columns with the original sentinel2 and landsat values
-    # First S2
-    temp = pd.DataFrame({"time": date_range})
-    # Populate it with NDVI values where we have them and NaN where we don't
-    temp = pd.merge(temp, s2, on="time", how="left")
-    # add it as a column to m1
-    m1['ndvi.sentinel2'] = temp['ndvi.sentinel2']
+    # now let's add two more columns with the original sentinel2 and landsat values,
+    # scattered straight into their slot in the grid
+    group_keys = pd.Index(keys[starts])
+    first_day = days[starts]
+    lengths = dense_ends - dense_starts
+    for (obs, col) in [(s2, 'ndvi.sentinel2'), (l8, 'ndvi.landsat')]:
+        values = np.full(len(rep), np.nan)
+        g = group_keys.get_indexer(obs[sort_col].to_numpy())
+        found = g >= 0
+        g = np.where(found, g, 0)
+        pos = (obs['time'].to_numpy() - times[0]) // np.timedelta64(1, 'D') - first_day[g]
+        inside = found & (pos >= 0) & (pos < lengths[g])
+        values[dense_starts[g[inside]] + pos[inside]] = obs[col].to_numpy(dtype=float)[inside]
+        m1[col] = values
+    return m1
+
+# savgol_()
+# smooth a single point/location. kept for backwards compatibility; savgol_batch() does the work
+def savgol_(m,s2,l8,window_length=20,polyorder=2):
+    sort_col = 'point'
+    if m.columns[0] != 'point':
+        sort_col = 'location'
+    return savgol_batch(m,s2,l8,sort_col,window_length,polyorder)
+
+# savgol_partition()
+# runs in a worker process. The partition arrives as a dict of column name -> numpy array
+# (cheap to pickle, unlike a DataFrame) and the result goes back the same way.
+# options are the keyword arguments for savgol()
+def savgol_partition(columns,options):
+    df = savgol(pd.DataFrame(columns),**options)
+    return {c: df[c].to_numpy() for c in df.columns}
 
-    # and now Landsat
-    temp = pd.DataFrame({"time": date_range})
-    temp = pd.merge(temp, l8, on="time", how="left")
-    m1['ndvi.landsat'] = temp['ndvi.landsat']
+# savgol_parallel()
+# splits the points/locations of df_ into contiguous partitions of roughly equal row count,
+# smooths them in a process pool and stitches the results back together in location order,
+# so the output is the same as savgol(df_) no matter how many workers are used
+def savgol_parallel(df_,window_length=20,polyorder=2,workers=2,same_day='landsat',outlier_zscore=1.5,outlier_delta=0.08):
+    options = dict(window_length=window_length,polyorder=polyorder,same_day=same_day,outlier_zscore=outlier_zscore,outlier_delta=outlier_delta)
+    sort_col = 'point'
+    if df_.columns[0] != 'point':
+        sort_col = 'location'
+    df_ = df_.sort_values(by=[sort_col, 'time'], kind='stable')
+    (starts, ends) = group_bounds(df_[sort_col].to_numpy())
+    # a few partitions per worker so that one slow partition doesn't hold everyone up
+    n_parts = min(len(starts), workers * 4)
+    if n_parts <= 1:
+        return savgol(df_,**options)
+    # cut at location boundaries closest to equal row counts
+    targets = np.arange(1, n_parts) * (len(df_) / n_parts)
+    idx = np.searchsorted(starts, targets)
+    cuts = np.unique(starts[idx[idx < len(starts)]])
+    bounds = np.concatenate([[0], cuts[cuts > 0], [len(df_)]])
+    # numpy arrays lose pandas dtypes (categorical location ids of compact frames, strings, nullable
+    # integers): categoricals travel as their codes and all of them are restored on the way back
+    dtypes = {c: df_[c].dtype for c in df_.columns if not isinstance(df_[c].dtype, np.dtype)}
+    partitions = []
+    for (a, b) in zip(bounds[:-1], bounds[1:]):
+        part = df_.iloc[a:b]
+        partitions.append({c: part[c].cat.codes.to_numpy() if isinstance(part[c].dtype, pd.CategoricalDtype) else part[c].to_numpy() for c in part.columns})
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        # map() yields in submission order, which keeps the output deterministic
+        results = list(pool.map(savgol_partition, partitions, [options] * len(partitions)))
+    columns = {}
+    for c in results[0]:
+        values = np.concatenate([r[c] for r in results])
+        if isinstance(dtypes.get(c), pd.CategoricalDtype):
+            values = pd.Categorical.from_codes(values, dtype=dtypes[c])
+        elif c in dtypes:
+            values = pd.array(values, dtype=dtypes[c])
+        columns[c] = values
+    return pd.DataFrame(columns)
 
-    return m1
+# usable_cpus()
+# the number of CPUs this process may run on (its affinity mask where the platform has one)
+def usable_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
 # savgol()
 # df_ is a dataframe with columns time, ndvi.sentinel2, ndvi.landsat, qa.sentinel2, qa.landsat
 # (basically the output from the server if you ask for sentinel2 and landsat data)
 # Returns a dataframe with columns time, ndvi, ndvi.sentinel2, ndvi.landsat
 # where ndvi is the smoothed savgol ndvi
-def savgol(df_,window_length=20,polyorder=2):
+# set workers > 1 to spread the locations over that many processes (at most one per usable CPU: with a
+# single CPU the pool only adds pickling and process start-up, so the work is done in this process)
+# same_day decides the ndvi of days seen by both sentinel2 and landsat (see prepare())
+# outlier_zscore and outlier_delta are the thresholds of the outlier test (see outlier_mask())
+def savgol(df_,window_length=20,polyorder=2,workers=None,same_day='landsat',outlier_zscore=1.5,outlier_delta=0.08):
+    if workers is not None:
+        workers = min(workers, usable_cpus())
+    if workers is not None and workers > 1:
+        return savgol_parallel(df_,window_length,polyorder,workers,same_day,outlier_zscore,outlier_delta)
     # take the raw data that has columns for both sentinel2 and landsat
     # and convert it into a sparse dataframe with columns time, ndvi (merging the two ndvi columns)
-    (m,s2,l8) = prepare(df_)
-    
+    (m,s2,l8) = prepare(df_,same_day)
+
     # is this points or polygons?
     sort_col = 'point'
     if m.columns[0] != 'point':
         sort_col = 'location'
 
-    # process each point or location separately
-    for p in m[sort_col].unique():
-        m1 = m[m[sort_col]==p]
-        s21 = s2[s2[sort_col]==p]
-        l81 = l8[l8[sort_col]==p]
-        m2 = savgol_(m1,s21,l81,window_length,polyorder)
-        if p==0:
-            m3 = m2
+    # all points or locations are processed together
+    return savgol_batch(m,s2,l8,sort_col,window_length,polyorder,outlier_zscore,outlier_delta)
+
+# raw_observations()
+# turns observation rows of a savgol() output back into raw server rows (with the given columns),
+# so that prepare() sees the same observations it saw the first time
+def raw_observations(rows,columns):
+    raw = {}
+    for c in columns:
+        if c in ['qa.sentinel2', 'qa.landsat']:
+            raw[c] = rows['ndvi.' + c[3:]].notna().astype(int).to_numpy()
         else:
-            m3 = pd.concat([m3, m2])
-    m3.reset_index(drop=True)
-    return m3
-    
\ No newline at end of file
+            raw[c] = rows[c].to_numpy()
+    return pd.DataFrame(raw)
+
+# savgol_update()
+# incremental version of savgol(): previous is the savgol() output for the data so far (the full output,
+# i.e. get_data(debug=True), since the ndvi.sentinel2 and ndvi.landsat columns are needed) and df_ holds
+# new raw rows (same columns as the input of savgol()) for days after the last day of previous.
+# window_length, polyorder, same_day and the outlier thresholds must be the ones previous was made with.
+# Returns the same frame savgol() would return for all the data together, but only recomputes the tail
+# of each location that received new observations:
+# - outlier flags only change for the last 3 old observations (the rolling window is 7 observations)
+# - the interpolated series only changes after the last observation that survives that test
+# - the filter only changes window_length days before that
+# The tail is recomputed from a suffix of the old observations. The suffix has its own (wrong) outlier
+# flags for its first 3 observations and its own edge fit at its start, so it is only used from
+# window_length days after its first trusted observation. When the suffix is too short for the two to
+# meet, the location is retried with a longer suffix, up to its whole history.
+def savgol_update(previous,df_,window_length=20,polyorder=2,same_day='landsat',outlier_zscore=1.5,outlier_delta=0.08):
+    sort_col = 'point'
+    if df_.columns[0] != 'point':
+        sort_col = 'location'
+    if 'ndvi.sentinel2' not in previous.columns or 'ndvi.landsat' not in previous.columns:
+        raise ValueError("previous must be the full savgol output (get_data(debug=True))")
+    previous = previous.reset_index(drop=True)
+    df_ = df_.sort_values(by=[sort_col, 'time'], kind='stable')
+    wl = np.timedelta64(window_length, 'D')
+
+    prev_keys = previous[sort_col].to_numpy()
+    prev_times = previous['time'].to_numpy()
+    (starts, ends) = group_bounds(prev_keys)
+    groups = pd.Index(prev_keys[starts])
+    first = prev_times[starts]
+    last = prev_times[ends - 1]
+    g = groups.get_indexer(df_[sort_col].to_numpy())
+    if ((g >= 0) & (df_['time'].to_numpy() <= last[np.where(g >= 0, g, 0)])).any():
+        raise ValueError("df_ may only hold days after the last day in previous")
+
+    # rows of previous that were observations
+    obs = (previous['ndvi.sentinel2'].notna() | previous['ndvi.landsat'].notna()).to_numpy()
+
+    # cut[g]: rows of location g before cut come from previous, rows from cut on from the recomputed tail
+    cut = np.full(len(groups), np.datetime64('2262-01-01'), dtype=prev_times.dtype)
+    tails = []
+    new_valid = (df_['qa.sentinel2'] == 1) | (df_['qa.landsat'] == 1)
+    pending = pd.unique(df_.loc[new_valid, sort_col])
+    lookback = 8 * wl
+    while len(pending) > 0:
+        pg = groups.get_indexer(pending)
+        since = np.full(len(groups), np.datetime64('2262-01-01'), dtype=prev_times.dtype)
+        since[pg[pg >= 0]] = last[pg[pg >= 0]] - lookback
+        rows = obs & np.isin(prev_keys, pending) & (prev_times >= np.repeat(since, ends - starts))
+        (m,s2,l8) = prepare(pd.concat([raw_observations(previous[rows],df_.columns), df_[df_[sort_col].isin(pending)]], ignore_index=True),same_day)
+        keys = m[sort_col].to_numpy()
+        times = m['time'].to_numpy()
+        (ms, me) = group_bounds(keys)
+        mg = groups.get_indexer(keys[ms])
+        # the whole history of these locations is in the suffix, so its result is the full result
+        complete = (mg < 0) | (first[np.where(mg >= 0, mg, 0)] >= since[np.where(mg >= 0, mg, 0)])
+        # K, A: first and last old observation whose outlier flag is trusted and that survives
+        lengths = me - ms
+        group_last = np.repeat(np.where(mg >= 0, last[np.where(mg >= 0, mg, 0)], np.datetime64('NaT')), lengths)
+        old = times <= group_last
+        n_old = np.add.reduceat(old.astype(np.int64), ms)
+        rel = np.arange(len(m)) - np.repeat(ms, lengths)
+        trusted = old & ~outlier_mask(m, sort_col, zscore=outlier_zscore, delta=outlier_delta) & (rel >= 3) & (rel <= np.repeat(n_old, lengths) - 4)
+        idx = np.arange(len(m))
+        k = np.minimum.reduceat(np.where(trusted, idx, len(m) - 1), ms)
+        a = np.maximum.reduceat(np.where(trusted, idx, 0), ms)
+        split = (np.add.reduceat(trusted.astype(np.int64), ms) > 0) & (times[k] + wl <= times[a] - wl)
+        done = complete | split
+        if done.any():
+            done_keys = keys[ms[done]]
+            keep = np.isin(keys, done_keys)
+            tail = savgol_batch(m[keep], s2[s2[sort_col].isin(done_keys)], l8[l8[sort_col].isin(done_keys)], sort_col, window_length, polyorder, outlier_zscore, outlier_delta)
+            tail_cut = np.where(complete, np.datetime64('1677-09-22'), times[a] - wl)[done]
+            tail_g = pd.Index(done_keys).get_indexer(tail[sort_col].to_numpy())
+            tails.append(tail[tail['time'].to_numpy() >= tail_cut[tail_g]])
+            cut[mg[done & (mg >= 0)]] = tail_cut[mg[done] >= 0]
+        pending = keys[ms[~done]]
+        lookback = lookback * 4
+
+    # splice the tails in: every location keeps its place in previous (new ones go where savgol() would
+    # put them) and is its head rows followed by its tail rows. Only the tails and the list of
+    # per-location segments are sorted, never the whole output
+    columns = list(previous.columns)
+    tail = pd.concat(tails, ignore_index=True)[columns].sort_values(by=sort_col, kind='stable') if len(tails) > 0 else previous.iloc[:0]
+    tail_keys = tail[sort_col].to_numpy()
+    (ts, te) = group_bounds(tail_keys)
+    tg = groups.get_indexer(tail_keys[ts])
+    head_len = np.zeros(len(groups), dtype=np.int64)
+    if len(previous) > 0:
+        head_len = np.add.reduceat((prev_times < np.repeat(cut, ends - starts)).astype(np.int64), starts)
+    # segments sort by (2 * location + 1, 0 head / 1 tail); a new location goes before the one it precedes
+    slot = np.where(tg >= 0, 2 * tg + 1, 2 * np.searchsorted(groups.to_numpy(), tail_keys[ts]))
+    seg_start = np.concatenate([starts, ts + len(previous)])
+    seg_len = np.concatenate([head_len, te - ts])
+    order = np.lexsort((np.concatenate([np.zeros(len(groups), dtype=np.int64), np.ones(len(ts), dtype=np.int64)]), np.concatenate([2 * np.arange(len(groups)) + 1, slot])))
+    (seg_start, seg_len) = (seg_start[order], seg_len[order])
+    idx = np.repeat(seg_start - (np.cumsum(seg_len) - seg_len), seg_len) + np.arange(seg_len.sum())
+    return pd.concat([previous, tail], ignore_index=True).take(idx).reset_index(drop=True)
@@ -0,0 +1,226 @@
+from datetime import datetime, timedelta
+import json
+import os
+import tempfile
+import uuid
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+pa = LazyModule('pyarrow')
+ds = LazyModule('pyarrow.dataset')
+pq = LazyModule('pyarrow.parquet')
+
+ROW_GROUP_SIZE = 65536 # rows are sorted by location, so a read of a few locations skips most row groups
+
+# IncrementalStore
+# keeps the NDVI history of a fixed set of locations in a local parquet store and refreshes it
+# incrementally: refresh() records the last date stored for every location and only asks the server for
+# the days after that, so a daily refresh downloads one day, not 12 years.
+#
+#     store = IncrementalStore(connection, "fields", points=points, location_ids=ids)
+#     store.refresh()          # first call downloads the full history, later calls only the new days
+#     df = store.read(start="2024-01-01")
+#
+# Observations can reach the server days late (a scene is processed after newer ones). With lookback_days
+# set, every refresh also asks again for the last lookback_days days already stored; the answer replaces
+# the stored rows of those days (one row per location and day), so late observations are filled in.
+#
+# Locations are keyed by location_ids (or by their position in points/polygons when there are none);
+# that key is the location_id column of the stored data.
+#
+# Layout: data/<YYYY-MM>/*.parquet, one directory per calendar month of observations. Each refresh adds
+# one file per month it has rows for (a daily refresh: one file), with the rows sorted by location and
+# time, so a read of a few locations only decodes the matching row groups. compact() merges the files of
+# a month into one; refresh() runs it for the months that have more than max_files files and for earlier
+# months that have more than one, so the store holds about one file per month plus at most max_files for
+# the current one, however many locations and refreshes there are.
+# The list of live files is part of state.json, which is replaced atomically after every append or
+# compaction: a crash leaves either the old or the new list, and files that aren't on it are leftovers
+# that compact() deletes.
+class IncrementalStore:
+    def __init__(self,connection,path,*,points=None,polygons=None,location_ids=None,sources=None,aggregation="median",start_date="2013-01-01",max_files=8,lookback_days=0):
+        if sources == ['ndvi.savgol']:
+            raise ValueError("IncrementalStore keeps raw data; store ['ndvi.sentinel2','ndvi.landsat'] and smooth with savgol()")
+        if points is None and polygons is None:
+            raise ValueError("You must set either polygons or points")
+        if points is not None and polygons is not None:
+            raise ValueError("You must set either polygons or points but not both")
+        self.connection = connection
+        self.path = os.path.expanduser(path)
+        self.points = connection.validate_point_input(points) if points is not None else None
+        self.polygons = connection.validate_polygon_input(polygons) if polygons is not None else None
+        space = self.points if points is not None else self.polygons
+        if location_ids is None:
+            location_ids = [str(i) for i in range(len(space))]
+        elif len(location_ids) != len(space):
+            raise ValueError("location_ids must be a list of the same length as space")
+        self.location_ids = location_ids
+        self.sources = sources
+        self.aggregation = aggregation
+        self.start_date = pd.Timestamp(start_date)
+        self.max_files = max_files
+        if lookback_days < 0:
+            raise ValueError("lookback_days can't be negative")
+        self.lookback_days = lookback_days
+        self.data_path = os.path.join(self.path,"data")
+        self.state_path = os.path.join(self.path,"state.json")
+        self.state = {'sources': sources, 'aggregation': aggregation, 'last_date': {}, 'files': []}
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+            if 'files' not in self.state:
+                raise ValueError("{} uses the old one-partition-per-location layout; refresh into a new directory".format(self.path))
+            # a store holds one kind of data; appending other sources or aggregations to it would mix them up
+            if self.state['sources'] != sources or self.state['aggregation'] != aggregation:
+                raise ValueError("{} holds sources={} aggregation={}".format(self.path,self.state['sources'],self.state['aggregation']))
+        os.makedirs(self.data_path,exist_ok=True)
+
+    # last_dates()
+    # location id -> last date in the store (None if nothing is stored yet)
+    def last_dates(self):
+        return {l: self.state['last_date'].get(l) for l in self.location_ids}
+
+    # missing_windows()
+    # groups the locations by the first day they are missing (or, with lookback_days, the first day to fetch
+    # again), so that each group is one request. returns a list of (start date, [location positions])
+    def missing_windows(self,end_date):
+        groups = {}
+        for (i,l) in enumerate(self.location_ids):
+            last = self.state['last_date'].get(l)
+            start = self.start_date if last is None else max(self.start_date,pd.Timestamp(last) + timedelta(days=1 - self.lookback_days))
+            if start <= end_date:
+                groups.setdefault(start,[]).append(i)
+        return sorted(groups.items())
+
+    # refresh()
+    # downloads the days each location is missing up to end_date (default today) and adds them to the store,
+    # along with the last lookback_days stored days, which replace what is stored for them.
+    # returns the number of new rows (rows for a location and day the store didn't have)
+    def refresh(self,end_date=None):
+        end_date = pd.Timestamp(datetime.now().date() if end_date is None else end_date)
+        windows = self.missing_windows(end_date)
+        # submit every window first so that the server works on them in parallel
+        queries = []
+        for (start,positions) in windows:
+            if isinstance(self.points,np.ndarray):
+                space = self.points[positions]
+            else:
+                space = [(self.points if self.points is not None else self.polygons)[i] for i in positions]
+            args = {'points': space} if self.points is not None else {'polygons': space}
+            query_id = self.connection.request_ndvi(location_ids=[self.location_ids[i] for i in positions],aggregation=self.aggregation,sources=self.sources,start_date=start.to_pydatetime(),end_date=end_date.to_pydatetime(),**args)
+            queries.append((query_id,start,positions))
+        added = 0
+        for (query_id,start,positions) in queries:
+            df = self.connection.get_data(query_id)
+            if df is None:
+                continue
+            added += self.append(df,[self.location_ids[i] for i in positions],start,end_date)
+        self.compact()
+        return added
+
+    # append()
+    # merges the result of one window request into the store. ids are the location ids of the request in order.
+    # rows for days after a location's last date are added; rows for days already stored (the lookback, or a
+    # window that starts before some locations' last date) replace the stored row of that location and day,
+    # so the months they fall in are rewritten. returns the number of new rows
+    def append(self,df,ids,start,end_date):
+        index_col = 'point' if 'point' in df.columns else 'location'
+        df = df.copy()
+        df['location_id'] = pd.Series(ids,dtype=object).to_numpy()[df[index_col].to_numpy()]
+        if len(df) == 0:
+            return 0
+        df = df.sort_values(by=['location_id','time'],kind='stable').reset_index(drop=True)
+        last = df['location_id'].map(lambda l: pd.Timestamp(self.state['last_date'].get(l,'1900-01-01')))
+        stored = (df['time'] <= last).to_numpy()
+        months = df['time'].dt.strftime("%Y-%m")
+        by_month = {}
+        for f in self.state['files']:
+            by_month.setdefault(f.split("/")[0],[]).append(f)
+        files = []
+        replaced = []
+        added = 0
+        for (month,rows) in df.groupby(months,sort=True):
+            name = "part-{}-{}-{}.parquet".format(start.strftime("%Y%m%d"),end_date.strftime("%Y%m%d"),uuid.uuid4().hex[:8])
+            if stored[rows.index].any() and month in by_month:
+                old = ds.dataset([os.path.join(self.data_path,f) for f in by_month[month]],format='parquet').to_table().to_pandas()
+                merged = pd.concat([old,rows],ignore_index=True).drop_duplicates(subset=['location_id','time'],keep='last')
+                merged = merged.sort_values(by=['location_id','time'],kind='stable')
+                files.append(self.write_file(month,name,pa.Table.from_pandas(merged,preserve_index=False)))
+                replaced += by_month[month]
+                added += len(merged) - len(old)
+            else:
+                files.append(self.write_file(month,name,pa.Table.from_pandas(rows,preserve_index=False)))
+                added += len(rows)
+        self.state['files'] = [f for f in self.state['files'] if f not in replaced] + files
+        for (l,t) in df.groupby('location_id')['time'].max().items():
+            if l not in self.state['last_date'] or t > pd.Timestamp(self.state['last_date'][l]):
+                self.state['last_date'][l] = t.strftime("%Y-%m-%d")
+        self.save_state()
+        return added
+
+    # write_file()
+    # writes table as data/<month>/<name> and returns that path relative to data/
+    def write_file(self,month,name,table):
+        os.makedirs(os.path.join(self.data_path,month),exist_ok=True)
+        pq.write_table(table,os.path.join(self.data_path,month,name),row_group_size=ROW_GROUP_SIZE)
+        return month + "/" + name
+
+    # compact()
+    # merges the files of every month that has more than max_files of them (or more than one, for months
+    # before the latest one, which get no new days) into one file sorted by location and time, and deletes
+    # files that aren't part of the store (left behind by an append or compaction that crashed).
+    # with everything=True every month is merged into one file. returns the number of files removed
+    def compact(self,everything=False):
+        by_month = {}
+        for f in self.state['files']:
+            by_month.setdefault(f.split("/")[0],[]).append(f)
+        latest = max(by_month) if len(by_month) > 0 else None
+        replaced = []
+        for (month,files) in sorted(by_month.items()):
+            limit = 1 if everything or month != latest else self.max_files
+            if len(files) <= limit:
+                continue
+            table = ds.dataset([os.path.join(self.data_path,f) for f in files],format='parquet').to_table()
+            table = table.sort_by([('location_id','ascending'),('time','ascending')])
+            merged = self.write_file(month,"compacted-{}.parquet".format(uuid.uuid4().hex[:8]),table)
+            self.state['files'] = [f for f in self.state['files'] if f not in files] + [merged]
+            self.save_state()
+            replaced += files
+        removed = 0
+        live = set(self.state['files'])
+        for (directory,subdirs,names) in os.walk(self.data_path):
+            for name in names:
+                relative = os.path.relpath(os.path.join(directory,name),self.data_path).replace(os.sep,"/")
+                if relative not in live:
+                    os.remove(os.path.join(directory,name))
+                    removed += 1
+        return removed
+
+    def save_state(self):
+        (fd,tmp) = tempfile.mkstemp(dir=self.path,suffix=".part")
+        with os.fdopen(fd,"w") as f:
+            json.dump(self.state,f)
+        os.replace(tmp,self.state_path)
+
+    # read()
+    # the stored data, optionally for some location ids and/or a date range
+    def read(self,locations=None,start=None,end=None):
+        if len(self.state['files']) == 0:
+            return pd.DataFrame()
+        dataset = ds.dataset([os.path.join(self.data_path,f) for f in self.state['files']],format='parquet')
+        filters = []
+        if locations is not None:
+            filters.append(ds.field('location_id').isin([str(l) for l in locations]))
+        if start is not None:
+            filters.append(ds.field('time') >= pd.Timestamp(start))
+        if end is not None:
+            filters.append(ds.field('time') <= pd.Timestamp(end))
+        expression = None
+        for f in filters:
+            expression = f if expression is None else expression & f
+        df = dataset.to_table(filter=expression).to_pandas()
+        if len(df) == 0:
+            return df
+        return df.sort_values(by=['location_id','time'],kind='stable').reset_index(drop=True)
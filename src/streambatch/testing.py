@@ -0,0 +1,214 @@
+import argparse
+import gzip
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from .lazy import LazyModule
+
+np = LazyModule('numpy')
+pd = LazyModule('pandas')
+
+# Local stand-in for the Streambatch API, for tests, load tests and end-to-end benchmarks without network.
+#
+#     with StandInServer(queue_time=(1, 5), failure_rate=0.01) as server:
+#         connection = StreambatchConnection('any key', quiet=True)
+#         server.configure(connection)
+#         data = connection.get_data(connection.request_ndvi(points=points))
+#
+# POST /async takes a request body (plain or gzipped json) and returns a query id. Each query waits in
+# a simulated queue for queue_time seconds (drawn uniformly from the range) and then Succeeds, or
+# Fails with probability failure_rate; the first running_polls status checks of a query report Running
+# regardless. GET /check reports the status. The result parquet (one row per
+# location and day of the requested window, one column per requested variable) is written to the
+# result directory when the query first reports Succeeded; the connection reads it from there, so the
+# directory stands in for the S3 bucket.
+#
+# latency is added to every HTTP response, and error_rate is the fraction of responses that are a 503
+# instead (the client retries those). With api_key set, requests with another X-API-Key get a 403.
+# The server can also be run on its own:
+#
+#     python -m streambatch.testing --port 8080 --queue-time 1 5
+
+# make_result()
+# synthetic result for an ndvi request, shaped like the server's output
+def make_result(ndvi_request,seed=0):
+    rng = np.random.default_rng(seed)
+    days = pd.date_range(ndvi_request['time']['start'],ndvi_request['time']['end'],freq='D')
+    n = len(ndvi_request['space'])
+    rows = n * len(days)
+    is_points = n > 0 and not isinstance(ndvi_request['space'][0],dict)
+    loc = np.repeat(np.arange(n),len(days))
+    columns = {'point' if is_points else 'location': loc, 'time': np.tile(days.to_numpy(),n)}
+    if 'location_id' in ndvi_request:
+        columns['location_id'] = np.asarray(ndvi_request['location_id'],dtype=object)[loc]
+    base = 0.5 + 0.3 * np.sin(np.tile(np.arange(len(days)),n) / 58.0 + loc)
+    for variable in ndvi_request['variable']:
+        columns[variable] = np.round(base + rng.normal(0,0.05,rows),3)
+        if variable in ('ndvi.sentinel2','ndvi.landsat'):
+            columns['qa.' + variable.split('.')[1]] = (rng.random(rows) < 0.2).astype(np.int64)
+    return pd.DataFrame(columns)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self,*args):
+        pass
+
+    def reply(self,code,body):
+        server = self.server.standin
+        if server.latency > 0:
+            time.sleep(server.latency)
+        if code == 200 and server.draw() < server.error_rate:
+            code = 503
+            body = {'error': 'injected failure'}
+            server.count('errors')
+        data = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header('Content-Type','application/json')
+        self.send_header('Content-Length',str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server.standin
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if urlparse(self.path).path != '/async':
+            return self.reply(404,{'error': 'not found'})
+        if server.api_key is not None and self.headers.get('X-API-Key') != server.api_key:
+            return self.reply(403,{'error': 'bad api key'})
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        query_id = server.submit(json.loads(body))
+        self.reply(200,{'id': query_id, 'access_url': 's3://streambatch-data/{}.parquet'.format(query_id)})
+
+    def do_GET(self):
+        server = self.server.standin
+        url = urlparse(self.path)
+        query_id = parse_qs(url.query).get('query_id',[None])[0]
+        if url.path != '/check' or query_id not in server.queries:
+            return self.reply(404,{'error': 'unknown query'})
+        self.reply(200,{'status': server.status(query_id)})
+
+class StandInServer:
+    def __init__(self,directory=None,host='127.0.0.1',port=0,latency=0.0,queue_time=(0.5,2.0),failure_rate=0.0,error_rate=0.0,api_key=None,seed=0,running_polls=0):
+        self.tempdir = None
+        if directory is None:
+            self.tempdir = tempfile.TemporaryDirectory()
+            directory = self.tempdir.name
+        self.directory = directory
+        self.latency = latency
+        self.queue_time = queue_time
+        self.failure_rate = failure_rate
+        self.error_rate = error_rate
+        self.api_key = api_key
+        self.running_polls = running_polls
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.stats = {'submitted': 0, 'polls': 0, 'succeeded': 0, 'failed': 0, 'errors': 0, 'result_bytes': 0}
+        self.httpd = ThreadingHTTPServer((host,port),StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.standin = self
+        self.thread = None
+
+    @property
+    def url(self):
+        (host,port) = self.httpd.server_address[:2]
+        return 'http://{}:{}'.format(host,port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever,daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.tempdir is not None:
+            self.tempdir.cleanup()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self,exc_type,exc,tb):
+        self.stop()
+
+    # configure()
+    # points a connection at this server
+    def configure(self,connection):
+        connection.REQUEST_URL = self.url + '/async'
+        connection.STATUS_URL = self.url + '/check'
+        connection.READ_URL = self.directory
+        return connection
+
+    def draw(self):
+        with self.lock:
+            return self.random.random()
+
+    def count(self,key,n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def submit(self,ndvi_request):
+        with self.lock:
+            self.stats['submitted'] += 1
+            # real query ids are uuids too, and they can't collide with the ids of earlier runs in the same process
+            query_id = str(uuid.uuid4())
+            self.queries[query_id] = {
+                'request': ndvi_request,
+                'seed': self.stats['submitted'],
+                'ready': time.monotonic() + self.random.uniform(*self.queue_time),
+                'fails': self.random.random() < self.failure_rate,
+                'status': 'Running',
+                'polls': 0,
+                'lock': threading.Lock(),
+            }
+        return query_id
+
+    # status()
+    # the status of a query. The result is written by the first check that finds the query done
+    def status(self,query_id):
+        query = self.queries[query_id]
+        self.count('polls')
+        with query['lock']:
+            query['polls'] += 1
+            if query['status'] == 'Running' and query['polls'] > self.running_polls and time.monotonic() >= query['ready']:
+                if query['fails']:
+                    query['status'] = 'Failed'
+                    self.count('failed')
+                else:
+                    path = os.path.join(self.directory,'{}.parquet'.format(query_id))
+                    make_result(query['request'],seed=query['seed']).to_parquet(path)
+                    query['status'] = 'Succeeded'
+                    self.count('succeeded')
+                    self.count('result_bytes',os.path.getsize(path))
+            return query['status']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m streambatch.testing',description="Local stand-in for the Streambatch API")
+    parser.add_argument('--host',default='127.0.0.1')
+    parser.add_argument('--port',type=int,default=8080)
+    parser.add_argument('--directory',help="where results are written (default: a temporary directory)")
+    parser.add_argument('--latency',type=float,default=0.0,help="seconds added to every response")
+    parser.add_argument('--queue-time',type=float,nargs=2,default=(0.5,2.0),metavar=('MIN','MAX'))
+    parser.add_argument('--failure-rate',type=float,default=0.0,help="fraction of queries that fail")
+    parser.add_argument('--error-rate',type=float,default=0.0,help="fraction of responses that are a 503")
+    args = parser.parse_args(argv)
+    server = StandInServer(args.directory,args.host,args.port,args.latency,tuple(args.queue_time),args.failure_rate,args.error_rate)
+    print('serving on {} (REQUEST_URL {}/async, STATUS_URL {}/check, READ_URL {})'.format(server.url,server.url,server.url,server.directory))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+
+if __name__ == '__main__':
+    main()
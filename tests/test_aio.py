@@ -0,0 +1,144 @@
+import asyncio
+import tempfile
+import threading
+import unittest
+
+import pandas as pd
+
+from streambatch.aio import AsyncStreambatchConnection
+from streambatch.module1 import StreambatchConnection
+from streambatch.testing import StandInServer
+
+
+# one day, so that every point has one row in the stand-in's result
+DAY = {'start_date': '2020-01-01', 'end_date': '2020-01-01'}
+
+
+class TestAsyncStreambatchConnection(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        # every query reports Running once before it Succeeds
+        self.server = StandInServer(queue_time=(0, 0), api_key='good_key', running_polls=1).start()
+
+    def tearDown(self):
+        self.server.stop()
+        self.directory.cleanup()
+
+    def connection(self, api_key='good_key'):
+        connection = self.server.configure(AsyncStreambatchConnection(api_key, quiet=True))
+        connection.poll_initial = 0.01
+        return connection
+
+    def test_many_queries_concurrently(self):
+        async def run():
+            async with self.connection() as connection:
+                query_ids = await asyncio.gather(*[connection.request_ndvi(points=[[0, 0]] * (i + 1), **DAY) for i in range(20)])
+                frames = await asyncio.gather(*[connection.get_data(q) for q in query_ids])
+            return (query_ids, frames)
+        (query_ids, frames) = asyncio.run(run())
+        self.assertEqual(len(set(query_ids)), 20)
+        self.assertEqual(sorted(len(f) for f in frames), list(range(1, 21)))
+
+    def test_sharded_request(self):
+        async def run():
+            async with self.connection() as connection:
+                query_id = await connection.request_ndvi(points=[[0, 0]] * 5, shard_size=2, **DAY)
+                return (query_id, await connection.get_data(query_id))
+        (query_id, df) = asyncio.run(run())
+        self.assertEqual(query_id.count('+'), 2)
+        self.assertEqual(sorted(df['point']), [0, 1, 2, 3, 4])
+
+    def test_get_data_pushdown(self):
+        async def run():
+            async with self.connection() as connection:
+                query_id = await connection.request_ndvi(points=[[0, 0]] * 5, shard_size=2, **DAY)
+                return await connection.get_data(query_id, columns=['point'], locations=[1, 4])
+        df = asyncio.run(run())
+        self.assertEqual(list(df.columns), ['point'])
+        self.assertEqual(sorted(df['point']), [1, 4])
+
+    def test_get_data_arrow(self):
+        async def run():
+            async with self.connection() as connection:
+                query_id = await connection.request_ndvi(points=[[0, 0]] * 5, shard_size=2, **DAY)
+                return await connection.get_data(query_id, result_format='arrow')
+        table = asyncio.run(run())
+        self.assertEqual(sorted(table.column('point').to_pylist()), [0, 1, 2, 3, 4])
+
+    def test_same_arguments_and_events_as_sync(self):
+        seen = []
+        async def run():
+            connection = self.connection()
+            connection.events.add(lambda event, fields: seen.append(event))
+            async with connection:
+                query_id = await connection.request_ndvi(points=[[0, 0]] * 3, **DAY)
+                self.assertTrue(await connection.wait(query_id))
+                return await connection.get_data(query_id)
+        df = asyncio.run(run())
+        self.assertEqual(len(df), 3)
+        self.assertIn('query.poll', seen)
+        self.assertIn('query.wait', seen)
+        connection = AsyncStreambatchConnection('good_key', quiet=True, cache_dir=self.directory.name + '/cache', shard_size=2)
+        self.assertIsNone(connection.session)
+        self.assertIsNotNone(connection.cache)
+
+    def test_reads_run_on_the_connections_executor(self):
+        threads = set()
+        async def run():
+            connection = AsyncStreambatchConnection('good_key', quiet=True, pool_size=2)
+            connection.READ_URL = self.directory.name
+            connection.wait = lambda query_id: asyncio.sleep(0, True)
+            pd.DataFrame({'point': range(3), 'ndvi': 0.5}).to_parquet(self.directory.name + '/pool.parquet')
+            # build_filters() runs on the executor; asyncio's default executor names its threads asyncio_N
+            connection.build_filters = lambda *args: threads.add(threading.current_thread().name)
+            async with connection:
+                frames = await asyncio.gather(*[connection.get_data('pool', locations=[0]) for i in range(8)])
+                self.assertEqual(connection.executor._max_workers, 2)
+            self.assertIsNone(connection.executor)
+            return frames
+        self.assertEqual([len(df) for df in asyncio.run(run())], [3] * 8)
+        self.assertTrue(threads)
+        self.assertTrue(all(name.startswith('ThreadPoolExecutor') for name in threads))
+        self.assertLessEqual(len(threads), 2)
+
+    def test_blocking_methods_are_not_inherited(self):
+        connection = AsyncStreambatchConnection('good_key', quiet=True)
+        self.assertNotIsInstance(connection, StreambatchConnection)
+        for name in ['iter_data', 'save_data', 'fetch_many', 'new_session', 'fetch_data']:
+            self.assertFalse(hasattr(connection, name), name)
+
+    def test_validation_is_shared(self):
+        async def run():
+            async with self.connection() as connection:
+                await connection.request_ndvi(points=[[0, 0]], aggregation="invalid")
+        with self.assertRaises(ValueError):
+            asyncio.run(run())
+
+    def test_bad_api_key(self):
+        async def run():
+            async with self.connection('bad_key') as connection:
+                await connection.request_ndvi(points=[[0, 0]], **DAY)
+        with self.assertRaises(ValueError):
+            asyncio.run(run())
+
+    def test_wait_all(self):
+        async def run():
+            async with self.connection() as connection:
+                query_ids = [await connection.request_ndvi(points=[[0, 0]], **DAY) for i in range(5)]
+                done = [q async for q in connection.as_completed(query_ids[:2])]
+                return (query_ids, done, await connection.wait_all(query_ids))
+        (query_ids, done, statuses) = asyncio.run(run())
+        self.assertEqual(sorted(done), sorted(query_ids[:2]))
+        self.assertEqual(statuses, {q: 'Succeeded' for q in query_ids})
+
+    def test_query_done(self):
+        async def run():
+            async with self.connection() as connection:
+                query_id = await connection.request_ndvi(points=[[0, 0]], **DAY)
+                return [await connection.query_done(query_id), await connection.query_done(query_id)]
+        self.assertEqual(asyncio.run(run()), [False, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
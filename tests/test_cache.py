@@ -0,0 +1,161 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import pandas as pd
+
+from streambatch import encoding
+from streambatch.cache import RequestCache, ResultCache
+from streambatch.module1 import StreambatchConnection
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.TemporaryDirectory()
+        self.directory = tempfile.TemporaryDirectory()
+        for q in ['q1', 'q2', 'q3']:
+            pd.DataFrame({'point': range(1000), 'ndvi': 0.5}).to_parquet(os.path.join(self.source.name, q + '.parquet'))
+
+    def tearDown(self):
+        self.source.cleanup()
+        self.directory.cleanup()
+
+    def url(self, query_id):
+        return os.path.join(self.source.name, query_id + '.parquet')
+
+    def test_hit_and_miss(self):
+        cache = ResultCache(self.directory.name)
+        self.assertEqual(cache.read(self.url('q1')).num_rows, 1000)
+        self.assertEqual(cache.read(self.url('q1')).num_rows, 1000)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['files']), (1, 1, 1))
+
+    def test_lru_eviction(self):
+        size = os.path.getsize(self.url('q1'))
+        cache = ResultCache(self.directory.name, max_bytes=2 * size)
+        cache.fetch(self.url('q1'))
+        cache.fetch(self.url('q2'))
+        os.utime(cache.path('q1.parquet'), (0, 0))
+        os.utime(cache.path('q2.parquet'), (1, 1))
+        cache.fetch(self.url('q3'))
+        self.assertEqual(sorted(os.listdir(self.directory.name)), ['q2.parquet', 'q3.parquet'])
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_connection_reads_through_cache(self):
+        connection = StreambatchConnection("your_api_key", cache_dir=self.directory.name)
+        connection.READ_URL = self.source.name
+        self.assertEqual(len(connection.read_parquet(self.url('q1'))), 1000)
+        os.remove(self.url('q1'))
+        self.assertEqual(len(connection.read_parquet(self.url('q1'))), 1000)
+        self.assertEqual(connection.cache.stats()['hits'], 1)
+
+    def test_selective_reads_skip_the_cache(self):
+        connection = StreambatchConnection("your_api_key", cache_dir=self.directory.name)
+        connection.READ_URL = self.source.name
+        self.assertEqual(len(connection.read_parquet(self.url('q1'), filters=[('point', '<', 10)])), 10)
+        self.assertEqual(connection.read_table(self.url('q1'), columns=['ndvi']).num_rows, 1000)
+        self.assertEqual(connection.build_filters(self.url('q1'), locations=[1, 2]), [('point', 'in', [1, 2])])
+        self.assertEqual(connection.cache.stats()['files'], 0)
+        # a whole read fills the cache, and later selective reads are served from it
+        connection.read_table(self.url('q1'))
+        os.remove(self.url('q1'))
+        self.assertEqual(len(connection.read_parquet(self.url('q1'), filters=[('point', '<', 10)])), 10)
+        self.assertEqual(connection.read_schema(self.url('q1')), ['point', 'ndvi'])
+
+
+class TestRequestCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'requests.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def connection(self):
+        connection = StreambatchConnection("your_api_key", request_cache_path=self.path)
+        connection.make_request = MagicMock(side_effect=[("q{}".format(i), "url") for i in range(10)])
+        return connection
+
+    def request(self, connection, **kwargs):
+        args = dict(points=[[0, 0], [1, 1]], start_date="2020-01-01", end_date="2020-12-31")
+        args.update(kwargs)
+        return connection.request_ndvi(**args)
+
+    def test_identical_request_is_not_resubmitted(self):
+        connection = self.connection()
+        self.assertEqual(self.request(connection), "q0")
+        self.assertEqual(self.request(connection), "q0")
+        self.assertEqual(connection.make_request.call_count, 1)
+        self.assertEqual(connection.request_cache.stats()['hits'], 1)
+
+    def test_different_requests_are_submitted(self):
+        connection = self.connection()
+        self.assertEqual(self.request(connection), "q0")
+        self.assertEqual(self.request(connection, aggregation="mean"), "q1")
+        self.assertEqual(self.request(connection, sources=["ndvi.sentinel2", "ndvi.landsat"]), "q2")
+        # same server request as the last one, but with savgol post-processing
+        self.assertEqual(self.request(connection, sources=["ndvi.savgol"]), "q3")
+
+    def test_cache_is_persisted(self):
+        self.request(self.connection())
+        connection = self.connection()
+        self.assertEqual(self.request(connection), "q0")
+        self.assertEqual(connection.make_request.call_count, 0)
+
+    def test_key_does_not_depend_on_orjson(self):
+        cache = RequestCache(self.path)
+        request = {'variable': ['ndvi.sentinel2'], 'space': np.array([[1e-7, 45.0], [0.1, 2.5]]), 'location_id': ['café', 'b'],
+                   'time': {'start': '2020-01-01', 'end': '2020-12-31'}, 'aggregation': 'median'}
+        as_lists = dict(request, space=request['space'].tolist())
+        key = cache.key(request, 'savgol')
+        with patch.object(encoding, 'orjson', None):
+            self.assertEqual(cache.key(request, 'savgol'), key)
+        self.assertEqual(cache.key(as_lists, 'savgol'), key)
+        body = json.dumps({'request': as_lists, 'postprocess': 'savgol'}, sort_keys=True, separators=(',', ':'))
+        self.assertEqual(key, hashlib.sha256(body.encode()).hexdigest())
+
+    def test_open_ended_requests_expire_sooner(self):
+        cache = RequestCache(self.path, ttl=3600, open_ended_ttl=-1)
+        closed = {'time': {'start': '2020-01-01', 'end': '2020-12-31'}}
+        open_ended = {'time': {'start': '2020-01-01', 'end': '9999-12-31'}}
+        cache.put(closed, "q1")
+        cache.put(open_ended, "q2")
+        self.assertEqual(cache.get(closed)['query_id'], "q1")
+        self.assertIsNone(cache.get(open_ended))
+
+    def test_processes_sharing_the_file_keep_each_others_entries(self):
+        (first, second) = (RequestCache(self.path), RequestCache(self.path))
+        requests = [{'time': {'start': '2020-01-01', 'end': '2020-12-{}'.format(day)}} for day in range(10, 20)]
+        for (i, request) in enumerate(requests):
+            (first if i % 2 == 0 else second).put(request, "q{}".format(i))
+        for cache in [first, second, RequestCache(self.path)]:
+            self.assertEqual([cache.get(r)['query_id'] for r in requests], ["q{}".format(i) for i in range(10)])
+        second.forget("q0")
+        self.assertIsNone(first.get(requests[0]))
+
+    def test_json_file_is_imported(self):
+        request = {'time': {'start': '2020-01-01', 'end': '2020-12-31'}}
+        key = RequestCache(os.path.join(self.directory.name, 'other.db')).key(request)
+        with open(self.path, 'w') as f:
+            json.dump({key: {'query_id': 'q1', 'created': 0, 'expires': time.time() + 60, 'shards': [['s1', 0]]}}, f)
+        cache = RequestCache(self.path)
+        self.assertEqual(cache.get(request), {'query_id': 'q1', 'created': 0, 'expires': cache.get(request)['expires'], 'shards': [['s1', 0]]})
+        self.assertEqual(RequestCache(self.path).stats()['entries'], 1)
+
+    def test_failed_query_is_forgotten(self):
+        connection = self.connection()
+        self.request(connection)
+        connection.status = MagicMock(return_value='{"status":"Failed"}')
+        self.assertIsNone(connection.get_data("q0"))
+        self.assertEqual(self.request(connection), "q1")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from streambatch.chunked import location_chunks, location_counts, read_locations
+from streambatch.module1 import StreambatchConnection, savgol_qids
+
+from .test_savgol import make_raw
+
+
+class TestChunks(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_location_chunks(self):
+        counts = np.array([3, 0, 4, 10, 2, 2, 2, 0])
+        self.assertEqual(location_chunks(counts, 5), [(0, 3), (3, 4), (4, 6), (6, 7)])
+        self.assertEqual(location_chunks(counts, 100), [(0, 7)])
+        self.assertEqual(location_chunks(np.zeros(3, dtype=np.int64), 5), [])
+
+    def test_read_locations_of_unordered_file(self):
+        path = os.path.join(self.directory.name, 'r.parquet')
+        df = pd.DataFrame({'point': [2, 0, 1, 0, 2, 1, 0], 'ndvi': np.arange(7.0)})
+        df.to_parquet(path, row_group_size=2)
+        pf = pq.ParquetFile(path)
+        self.assertEqual(location_counts(pf, 'point').tolist(), [3, 2, 2])
+        self.assertEqual(read_locations(pf, 'point', 1, 3).column('ndvi').to_pylist(), [0.0, 2.0, 4.0, 5.0])
+
+
+class TestSaveData(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        make_raw(12).to_parquet(os.path.join(self.directory.name, 'chunked-q1.parquet'), row_group_size=500)
+        self.connection = StreambatchConnection("your_api_key", quiet=True)
+        self.connection.READ_URL = self.directory.name
+        self.connection.status = MagicMock(return_value='{"status":"Succeeded"}')
+        self.output = os.path.join(self.directory.name, 'out')
+
+    def tearDown(self):
+        self.directory.cleanup()
+        if 'chunked-q1' in savgol_qids:
+            savgol_qids.remove('chunked-q1')
+
+    def test_savgol_in_chunks_matches_get_data(self):
+        savgol_qids.append('chunked-q1')
+        expected = self.connection.get_data('chunked-q1')
+        dataset = self.connection.save_data('chunked-q1', self.output, chunk_rows=700)
+        self.assertEqual(len(os.listdir(self.output)), 4)
+        pd.testing.assert_frame_equal(dataset.to_table().to_pandas(), expected, check_exact=False, rtol=1e-12)
+
+    def test_copy(self):
+        dataset = self.connection.save_data('chunked-q1', self.output, chunk_rows=1000)
+        self.assertEqual(dataset.count_rows(), 12 * 200)
+        self.assertEqual(len(os.listdir(self.output)), 3)
+        with self.assertRaises(ValueError):
+            self.connection.save_data('chunked-q1', self.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from streambatch import cli
+from streambatch.module1 import StreambatchConnection, deduped_qids
+
+
+class TestCli(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_cli(self, *argv):
+        out = io.StringIO()
+        err = io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            code = cli.main(['--api-key', 'key'] + list(argv))
+        return (code, out.getvalue(), err.getvalue())
+
+    def test_import_leaves_heavy_modules_alone(self):
+        code = "import sys, streambatch.cli; print([m for m in ('numpy', 'pandas', 'pyarrow', 'scipy', 's3fs') if m in sys.modules])"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '[]')
+
+    def test_package_import_is_lazy(self):
+        code = "import sys, streambatch; print([m for m in ('requests', 'asyncio', 'numpy', 'pandas') if m in sys.modules], streambatch.StreambatchConnection.__name__)"
+        output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.strip(), '[] StreambatchConnection')
+
+    def test_submit_prints_query_id(self):
+        path = os.path.join(self.directory.name, 'points.json')
+        with open(path, 'w') as f:
+            json.dump([[0.1, 1.0], [0.2, 2.0]], f)
+        with patch.object(StreambatchConnection, 'make_request', return_value=('q1', 'url')) as make_request:
+            (code, out, err) = self.run_cli('submit', '--points', path, '--start', '2020-01-01', '--end', '2020-12-31')
+        self.assertEqual((code, out), (0, 'q1\n'))
+        self.assertEqual(make_request.call_args.args[0]['space'], [[0.1, 1.0], [0.2, 2.0]])
+
+    def test_submit_leaves_heavy_modules_alone(self):
+        path = os.path.join(self.directory.name, 'points.json')
+        with open(path, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': [{'type': 'Feature', 'geometry': {'type': 'Point', 'coordinates': [0.1, 1.0]}}]}, f)
+        code = ("import sys\n"
+                "from unittest.mock import patch\n"
+                "from streambatch import cli\n"
+                "with patch.object(cli.StreambatchConnection, 'make_request', return_value=('q1', 'url')):\n"
+                "    cli.main(['--api-key', 'key', 'submit', '--points', sys.argv[1]])\n"
+                "print([m for m in ('numpy', 'pandas', 'pyarrow', 'scipy') if m in sys.modules])")
+        output = subprocess.run([sys.executable, '-c', code, path], capture_output=True, text=True, check=True).stdout
+        self.assertEqual(output.split(), ['q1', '[]'])
+
+    def test_status_with_journal_leaves_heavy_modules_alone(self):
+        path = os.path.join(self.directory.name, 'journal.db')
+        connection = StreambatchConnection('key', quiet=True, journal_path=path)
+        connection.make_request = MagicMock(return_value=('cli-deduped', 'url'))
+        connection.request_ndvi(points=[[0.1, 1.0], [0.1, 1.0]], dedupe='exact')
+        connection.journal.close()
+        code = ("import sys\n"
+                "from unittest.mock import patch\n"
+                "from streambatch import cli\n"
+                "with patch.object(cli.StreambatchConnection, 'status', return_value='{\"status\":\"Running\"}'):\n"
+                "    cli.main(['--api-key', 'key', '--journal', sys.argv[1], 'status', 'cli-deduped'])\n"
+                "print([m for m in ('numpy', 'pandas', 'pyarrow', 'scipy') if m in sys.modules])")
+        try:
+            output = subprocess.run([sys.executable, '-c', code, path], capture_output=True, text=True, check=True).stdout
+        finally:
+            deduped_qids.pop('cli-deduped', None)
+        self.assertEqual(output.split('\n')[:2], ['cli-deduped Running', '[]'])
+
+    def test_submit_bad_input(self):
+        path = os.path.join(self.directory.name, 'points.json')
+        with open(path, 'w') as f:
+            json.dump([[500, 1.0]], f)
+        (code, out, err) = self.run_cli('submit', '--points', path)
+        self.assertEqual(code, 2)
+        self.assertTrue(err.startswith('error: '))
+
+    def test_status_and_wait(self):
+        with patch.object(StreambatchConnection, 'status', MagicMock(side_effect=['{"status":"Running"}', '{"status":"Failed"}'])):
+            self.assertEqual(self.run_cli('status', 'q1', 'q2')[:2], (1, 'q1 Running\nq2 Failed\n'))
+        with patch.object(StreambatchConnection, 'status', MagicMock(return_value='{"status":"Succeeded"}')):
+            self.assertEqual(self.run_cli('wait', 'q1')[:2], (0, 'q1 Succeeded\n'))
+
+    def test_fetch_writes_file(self):
+        pd.DataFrame({'point': range(5), 'ndvi': 0.5}).to_parquet(os.path.join(self.directory.name, 'q1.parquet'))
+        output = os.path.join(self.directory.name, 'out.parquet')
+        connection = StreambatchConnection('key', quiet=True)
+        connection.READ_URL = self.directory.name
+        connection.status = MagicMock(return_value='{"status":"Succeeded"}')
+        with patch.object(cli, 'connect', return_value=connection):
+            (code, out, err) = self.run_cli('fetch', 'q1', output, '--columns', 'ndvi')
+        self.assertEqual(code, 0)
+        self.assertEqual(pq.read_table(output).column_names, ['ndvi'])
+
+    def test_resume_exit_status(self):
+        connection = StreambatchConnection('key', quiet=True, journal_path=os.path.join(self.directory.name, 'journal.db'))
+        output_dir = os.path.join(self.directory.name, 'out')
+        cases = [({'q1': 'out/q1'}, 0, 'q1 out/q1\n'), ({'q1': 'out/q1', 'q2': 'Failed'}, 1, 'q1 out/q1\nq2 Failed\n'),
+                 ({'q1': 'out/q1', 'q2': OSError('disk full')}, 1, 'q1 out/q1\nq2 error: OSError: disk full\n')]
+        for (results, expected, printed) in cases:
+            connection.resume = MagicMock(return_value=results)
+            with patch.object(cli, 'connect', return_value=connection):
+                (code, out, err) = self.run_cli('resume', output_dir)
+            self.assertEqual((code, out), (expected, printed))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+
+from streambatch.cache import RequestCache
+from streambatch.dedupe import PointGroups, pixel_keys, utm
+from streambatch.module1 import StreambatchConnection, deduped_qids
+
+
+class TestPointGroups(unittest.TestCase):
+
+    def test_utm(self):
+        (zone, easting, northing) = utm(np.array([[3.0, 0.0], [151.2093, -33.8688]]))
+        self.assertEqual(zone.tolist(), [31, 56])
+        np.testing.assert_allclose(easting, [500000, 334368.6], atol=0.1)
+        np.testing.assert_allclose(northing, [0, 6250948.3], atol=0.1)
+
+    def test_pixels(self):
+        # one degree of longitude on the equator is ~111 km; start in the middle of the pixel east of the central meridian
+        metre = 1 / (111319.49 * 0.9996)
+        lat = 5e-5
+        points = np.array([[3 + 5 * metre, lat], [3 + 2 * metre, lat], [3 + 8 * metre, lat], [3 + 12 * metre, lat], [3 - 2 * metre, lat]])
+        keys = pixel_keys(points)
+        self.assertTrue((keys[0] == keys[1]).all() and (keys[0] == keys[2]).all())
+        self.assertFalse((keys[0] == keys[3]).all() or (keys[0] == keys[4]).all())
+
+    def test_groups_keep_first_appearance_order(self):
+        points = np.array([[5.0, 5.0], [1.0, 1.0], [5.0, 5.0], [0.0, 0.0], [1.0, 1.0]])
+        groups = PointGroups.build(points, 'exact')
+        self.assertEqual(groups.first.tolist(), [0, 1, 3])
+        self.assertEqual(groups.inverse.tolist(), [0, 1, 0, 2, 1])
+        self.assertEqual((groups.points, groups.unique), (5, 3))
+        with self.assertRaises(ValueError):
+            PointGroups.build(points, 'nearest')
+
+
+class TestDedupeRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.connection = StreambatchConnection("your_api_key", quiet=True)
+        self.connection.READ_URL = self.directory.name
+        self.connection.status = MagicMock(return_value='{"status":"Succeeded"}')
+        self.connection.make_request = MagicMock(side_effect=self.serve)
+        self.points = [[0, 0], [1, 1], [0, 0], [1, 1], [2, 2]]
+        self.ids = ['a', 'b', 'c', 'd', 'e']
+
+    def tearDown(self):
+        self.directory.cleanup()
+        for query_id in [q for q in deduped_qids if q.startswith('dedupe-')]:
+            del deduped_qids[query_id]
+
+    # writes a result with two days per point and the point's longitude as ndvi
+    def serve(self, request):
+        query_id = 'dedupe-q{}'.format(self.connection.make_request.call_count)
+        space = np.asarray(request['space'], dtype=np.float64)
+        days = pd.to_datetime(['2020-01-01', '2020-01-02'])
+        pd.DataFrame({'point': np.repeat(np.arange(len(space)), 2), 'time': np.tile(days, len(space)),
+                      'ndvi': np.repeat(space[:, 0], 2)}).to_parquet(os.path.join(self.directory.name, query_id + '.parquet'))
+        return (query_id, 'url')
+
+    def request(self, **kwargs):
+        return self.connection.request_ndvi(points=self.points, location_ids=self.ids, dedupe='exact', **kwargs)
+
+    def test_only_unique_points_are_sent(self):
+        self.request()
+        request = self.connection.make_request.call_args.args[0]
+        self.assertEqual(np.asarray(request['space']).tolist(), [[0, 0], [1, 1], [2, 2]])
+        self.assertNotIn('location_id', request)
+
+    def test_fan_out(self):
+        df = self.connection.get_data(self.request())
+        self.assertEqual(list(df.columns), ['point', 'location_id', 'time', 'ndvi'])
+        self.assertEqual(df['point'].tolist(), [0, 0, 1, 1, 2, 2, 3, 3, 4, 4])
+        self.assertEqual(df['location_id'].tolist(), ['a', 'a', 'b', 'b', 'c', 'c', 'd', 'd', 'e', 'e'])
+        self.assertEqual(df['ndvi'].tolist(), [0, 0, 1, 1, 0, 0, 1, 1, 2, 2])
+        self.assertTrue((df.groupby('point')['time'].diff().dropna() > pd.Timedelta(0)).all())
+
+    def test_selection(self):
+        query_id = self.request()
+        df = self.connection.get_data(query_id, locations=['c', 'e'], columns=['location_id', 'ndvi'], result_format='compact')
+        self.assertEqual(list(df.columns), ['location_id', 'ndvi'])
+        self.assertEqual(df['location_id'].astype(str).tolist(), ['c', 'c', 'e', 'e'])
+        table = self.connection.get_data(query_id, locations=[1], result_format='arrow')
+        self.assertEqual(table.column('point').to_pylist(), [1, 1])
+
+    def test_iter_data(self):
+        batches = list(self.connection.iter_data(self.request(), batch_size=3))
+        self.assertEqual(sum(len(b) for b in batches), 10)
+
+    def test_same_unique_points_with_different_groups(self):
+        self.connection.request_cache = RequestCache(os.path.join(self.directory.name, 'requests.db'))
+        first = self.connection.request_ndvi(points=[[10, 10], [10, 10], [20, 20]], dedupe='exact')
+        second = self.connection.request_ndvi(points=[[10, 10], [20, 20], [20, 20]], dedupe='exact')
+        self.assertNotEqual(first, second)
+        self.assertEqual(self.connection.get_data(first)['ndvi'].tolist(), [10, 10, 10, 10, 20, 20])
+        self.assertEqual(self.connection.get_data(second)['ndvi'].tolist(), [10, 10, 20, 20, 20, 20])
+        self.assertEqual(self.connection.request_ndvi(points=[[10, 10], [10, 10], [20, 20]], dedupe='exact'), first)
+        with self.assertRaises(ValueError):
+            self.connection.request_ndvi(points=[[10, 10], [20, 20], [20, 20]], dedupe='exact', query_id=first)
+
+    def test_pixel_needs_the_sentinel2_grid(self):
+        for sources in [None, ['ndvi.landsat'], ['ndvi.sentinel2', 'ndvi.modis'], ['ndvi.savgol']]:
+            with self.assertRaises(ValueError):
+                self.connection.request_ndvi(points=self.points, sources=sources, dedupe='pixel')
+        self.connection.make_request.assert_not_called()
+        self.connection.request_ndvi(points=self.points, sources=['ndvi.sentinel2'], dedupe='pixel')
+        self.assertEqual(len(self.connection.make_request.call_args.args[0]['space']), 3)
+
+    def test_dedupe_needs_points(self):
+        with self.assertRaises(ValueError):
+            self.connection.request_ndvi(polygons=[{'type': 'Polygon', 'coordinates': [[[0, 0], [1, 0], [1, 1], [0, 0]]]}], dedupe='pixel')
+
+
+if __name__ == '__main__':
+    unittest.main()
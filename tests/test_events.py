@@ -0,0 +1,99 @@
+import contextlib
+import io
+import logging
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import pandas as pd
+
+from streambatch.events import Instruments, LoggingInstrumentation, MetricsInstrumentation
+from streambatch.module1 import StreambatchConnection
+
+
+class TestInstruments(unittest.TestCase):
+
+    def test_timed_adds_seconds_and_block_fields(self):
+        seen = []
+        events = Instruments([lambda event, fields: seen.append((event, fields))])
+        with events.timed('fetch.read', url='u') as fields:
+            fields['rows'] = 3
+        self.assertEqual(seen[0][0], 'fetch.read')
+        self.assertEqual(seen[0][1]['rows'], 3)
+        self.assertGreaterEqual(seen[0][1]['seconds'], 0)
+
+    def test_metrics_sums_numeric_fields(self):
+        metrics = MetricsInstrumentation()
+        events = Instruments([metrics])
+        events.emit('fetch.read', url='a', rows=2, bytes=10, seconds=0.5)
+        events.emit('fetch.read', url='b', rows=3, bytes=20, seconds=0.25)
+        self.assertEqual(metrics.summary(), {'fetch.read': {'count': 2, 'rows': 5, 'bytes': 30, 'seconds': 0.75}})
+        metrics.reset()
+        self.assertEqual(metrics.summary(), {})
+
+    def test_logging(self):
+        logger = logging.getLogger('streambatch.test')
+        with self.assertLogs(logger, level='INFO') as logs:
+            Instruments([LoggingInstrumentation(logger)]).emit('request.cached', query_id='q1')
+        self.assertEqual(logs.output, ['INFO:streambatch.test:request.cached query_id=q1'])
+        self.assertEqual(logs.records[0].fields, {'query_id': 'q1'})
+
+
+class TestConnectionEvents(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        pd.DataFrame({'point': range(10), 'ndvi': 0.5}).to_parquet(os.path.join(self.directory.name, 'q1.parquet'))
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def connection(self, **kwargs):
+        connection = StreambatchConnection("your_api_key", **kwargs)
+        connection.READ_URL = self.directory.name
+        connection.make_request = MagicMock(return_value=("q1", "url"))
+        connection.status = MagicMock(side_effect=['{"status":"Running"}', '{"status":"Succeeded"}'])
+        connection.poll_delays = MagicMock(return_value=iter([0] * 10))
+        return connection
+
+    def run_query(self, connection):
+        query_id = connection.request_ndvi(points=[[0, 0], [1, 1]], start_date="2020-01-01", end_date="2020-12-31")
+        return connection.get_data(query_id)
+
+    def test_quiet_prints_nothing(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            df = self.run_query(self.connection(quiet=True))
+        self.assertEqual(len(df), 10)
+        self.assertEqual(out.getvalue(), "")
+
+    def test_default_output_is_unchanged(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            self.run_query(self.connection())
+        self.assertEqual(out.getvalue(), "Query ID: q1\nNumber of points: 2\nStart date: 2020-01-01\nEnd date: 2020-12-31\nAggregation: median\n.\n")
+
+    def test_handlers_see_every_phase(self):
+        metrics = MetricsInstrumentation()
+        seen = []
+        connection = self.connection(quiet=True, instrumentation=[metrics, lambda event, fields: seen.append(event)])
+        self.run_query(connection)
+        self.assertEqual(seen, ['request.build', 'request.done', 'query.poll', 'query.poll', 'query.wait', 'fetch.read', 'fetch.done'])
+        summary = metrics.summary()
+        self.assertEqual(summary['request.build']['locations'], 2)
+        self.assertEqual(summary['query.wait']['polls'], 2)
+        self.assertEqual(summary['fetch.read']['rows'], 10)
+        self.assertEqual(summary['fetch.done']['rows'], 10)
+
+    def test_failed_query(self):
+        seen = []
+        connection = self.connection(quiet=True, instrumentation=lambda event, fields: seen.append((event, fields)))
+        connection.status = MagicMock(return_value='{"status":"Failed"}')
+        self.assertIsNone(connection.get_data("q1"))
+        self.assertEqual(seen[-2], ('query.failed', {'query_id': 'q1', 'error': {'status': 'Failed'}}))
+        self.assertEqual(seen[-1][1]['rows'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
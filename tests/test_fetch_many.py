@@ -0,0 +1,107 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+
+from streambatch.dedupe import PointGroups
+from streambatch.events import MetricsInstrumentation
+from streambatch.module1 import StreambatchConnection, deduped_qids, savgol_qids
+
+from .test_savgol import make_raw
+
+
+class TestFetchMany(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for i in range(6):
+            pd.DataFrame({'point': np.arange(3), 'ndvi': np.full(3, float(i))}).to_parquet(os.path.join(self.directory.name, 'many-q{}.parquet'.format(i)))
+        make_raw(4).to_parquet(os.path.join(self.directory.name, 'many-savgol.parquet'))
+        self.metrics = MetricsInstrumentation()
+        self.connection = StreambatchConnection("your_api_key", quiet=True, poll_initial=0.01, poll_max=0.01, instrumentation=self.metrics)
+        self.connection.READ_URL = self.directory.name
+        self.statuses = {}
+        self.connection.status = MagicMock(side_effect=lambda query_id: '{{"status":"{}"}}'.format(self.statuses.get(query_id, 'Succeeded')))
+
+    def tearDown(self):
+        self.directory.cleanup()
+        if 'many-savgol' in savgol_qids:
+            savgol_qids.remove('many-savgol')
+        deduped_qids.pop('many-q5', None)
+
+    def test_results_match_get_data(self):
+        savgol_qids.append('many-savgol')
+        deduped_qids['many-q5'] = PointGroups.build(np.array([[0.0, 0.0], [1.0, 1.0], [0.0, 0.0], [2.0, 2.0]]), 'exact', ['a', 'b', 'c', 'd'])
+        self.statuses['many-q1'] = 'Failed'
+        query_ids = ['many-q0', 'many-q1', 'many-savgol', 'many-q5']
+        results = dict(self.connection.fetch_many(query_ids))
+        self.assertEqual(set(results), set(query_ids))
+        self.assertIsNone(results['many-q1'])
+        for query_id in ['many-q0', 'many-savgol', 'many-q5']:
+            pd.testing.assert_frame_equal(results[query_id], self.connection.get_data(query_id))
+        self.assertEqual(results['many-q5']['location_id'].tolist(), ['a', 'b', 'c', 'd'])
+        summary = self.metrics.summary()
+        self.assertEqual(summary['fetch.stage']['count'], 6)
+
+    def test_completion_order(self):
+        # many-q0 runs for two more status rounds than the others
+        polls = {'many-q0': 0}
+        def status(query_id):
+            if query_id == 'many-q0':
+                polls[query_id] += 1
+                return '{"status":"Succeeded"}' if polls[query_id] > 2 else '{"status":"Running"}'
+            return '{"status":"Succeeded"}'
+        self.connection.status = MagicMock(side_effect=status)
+        order = [query_id for (query_id, result) in self.connection.fetch_many(['many-q0', 'many-q1', 'many-q2'], result_format='arrow')]
+        self.assertEqual(order[-1], 'many-q0')
+
+    def test_stages_overlap(self):
+        active = {'download': 0, 'process': 0}
+        overlapped = []
+        lock = threading.Lock()
+        def slow(stage, fn):
+            def run(*args, **kwargs):
+                with lock:
+                    active[stage] += 1
+                    overlapped.append(active['download'] > 0 and active['process'] > 0)
+                time.sleep(0.05)
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    with lock:
+                        active[stage] -= 1
+            return run
+        self.connection.read_finished = slow('download', self.connection.read_finished)
+        self.connection.format_frame = slow('process', self.connection.format_frame)
+        savgol_qids.append('many-savgol')
+        results = list(self.connection.fetch_many(['many-savgol', 'many-q0', 'many-q1', 'many-q2'], download_workers=1, process_workers=1))
+        self.assertEqual(len(results), 4)
+        self.assertTrue(any(overlapped))
+
+    def test_backpressure(self):
+        downloads = []
+        read_finished = self.connection.read_finished
+        self.connection.read_finished = lambda query_id, *args, **kwargs: downloads.append(query_id) or read_finished(query_id, *args, **kwargs)
+        results = self.connection.fetch_many(['many-q{}'.format(i) for i in range(5)], max_pending=2)
+        next(results)
+        time.sleep(0.3)
+        # the one handed out freed its slot, two more are held for the caller
+        self.assertEqual(len(downloads), 3)
+        self.assertEqual(len(list(results)), 4)
+        self.assertEqual(len(downloads), 5)
+
+    def test_errors_are_raised(self):
+        self.connection.read_finished = MagicMock(side_effect=OSError('read failed'))
+        with self.assertRaises(OSError):
+            list(self.connection.fetch_many(['many-q0', 'many-q1']))
+        with self.assertRaises(ValueError):
+            list(self.connection.fetch_many(['many-q0'], result_format='csv'))
+
+
+if __name__ == '__main__':
+    unittest.main()
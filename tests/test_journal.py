@@ -0,0 +1,192 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+import pandas as pd
+
+from streambatch.dedupe import PointGroups
+from streambatch.journal import SCHEMA, JobJournal, output_name
+from streambatch.module1 import StreambatchConnection, deduped_qids, savgol_qids, sharded_qids
+
+from .test_savgol import make_raw
+
+
+class TestJobJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = JobJournal(os.path.join(self.directory.name, 'journal.db'))
+
+    def tearDown(self):
+        self.journal.close()
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        request = {'variable': ['ndvi.sentinel2'], 'space': [[0, 0], [1, 1]], 'location_id': ['a', 'b'], 'time': {}}
+        groups = PointGroups.build(np.array([[0.0, 0.0], [1.0, 1.0], [0.0, 0.0]]), 'exact', ['a', 'b', 'c'])
+        self.journal.record('q1', request, 'savgol', [('s1', 0), ('s2', 1)], groups)
+        self.journal.record('q2', {'space': [[2, 2]]})
+        self.journal.record('q1', {'space': []})
+        self.journal.update('q2', status='Failed')
+        self.journal.update('q1', output='/out/q1')
+        self.journal.update('q1', status='Succeeded')
+        (first, second) = self.journal.entries()
+        self.assertEqual(first['request'], {'variable': ['ndvi.sentinel2'], 'time': {}})
+        self.assertEqual((first['locations'], first['postprocess'], first['status'], first['output']), (3, 'savgol', 'Succeeded', '/out/q1'))
+        self.assertEqual(first['shards'], [('s1', 0), ('s2', 1)])
+        self.assertEqual(first['groups'].inverse.tolist(), [0, 1, 0])
+        self.assertEqual(first['groups'].location_ids, ['a', 'b', 'c'])
+        self.assertIsNone(second['groups'])
+        self.assertEqual([(e['deduped'], e['groups']) for e in self.journal.entries(load_groups=False)], [(True, None), (False, None)])
+        self.assertEqual(self.journal.groups('q1').digest(), groups.digest())
+        self.assertIsNone(self.journal.groups('q2'))
+        self.assertEqual([e['query_id'] for e in self.journal.entries(status='Failed')], ['q2'])
+        self.assertEqual(self.journal.summary(), {'Succeeded': 1, 'Failed': 1})
+
+    def test_older_journal_is_upgraded(self):
+        self.journal.close()
+        path = os.path.join(self.directory.name, 'old.db')
+        db = sqlite3.connect(path)
+        db.execute(SCHEMA.replace(',\n    error TEXT,\n    name TEXT', ''))
+        db.execute("INSERT INTO queries VALUES ('a+b', 0, 0, '{}', 2, NULL, NULL, NULL, NULL, NULL, 'Succeeded', NULL)")
+        db.commit()
+        db.close()
+        self.journal = JobJournal(path)
+        (entry,) = self.journal.entries()
+        self.assertEqual(entry['name'], output_name('a+b'))
+        self.assertTrue(entry['name'].startswith('sharded-'))
+        self.assertEqual(output_name('q1'), 'q1')
+
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal_path = os.path.join(self.directory.name, 'journal.db')
+        self.output = os.path.join(self.directory.name, 'out')
+        self.statuses = {}
+
+    def tearDown(self):
+        for query_id in list(self.statuses) + [q for q in sharded_qids if q.startswith('journal-')]:
+            if query_id in savgol_qids:
+                savgol_qids.remove(query_id)
+            deduped_qids.pop(query_id, None)
+            sharded_qids.pop(query_id, None)
+        self.directory.cleanup()
+
+    def connect(self):
+        connection = StreambatchConnection("your_api_key", quiet=True, journal_path=self.journal_path)
+        connection.READ_URL = self.directory.name
+        status = lambda query_id: connection.sharded_status(query_id) if query_id in sharded_qids else '{{"status":"{}"}}'.format(self.statuses[query_id])
+        connection.status = MagicMock(side_effect=status)
+        connection.make_request = MagicMock(side_effect=self.serve)
+        return connection
+
+    # a savgol result for a 3 point request, a plain one (the points' longitude as ndvi) otherwise
+    def serve(self, request):
+        query_id = 'journal-q{}'.format(len(self.statuses) + 1)
+        self.statuses[query_id] = 'Running'
+        path = os.path.join(self.directory.name, query_id + '.parquet')
+        if 'ndvi.landsat' in request['variable']:
+            make_raw(len(request['space'])).to_parquet(path)
+        else:
+            space = np.asarray(request['space'], dtype=np.float64)
+            pd.DataFrame({'point': np.arange(len(space)), 'ndvi': space[:, 0]}).to_parquet(path)
+        return (query_id, 'url')
+
+    def test_restart_resumes_without_resubmitting(self):
+        connection = self.connect()
+        savgol = connection.request_ndvi(points=[[0, 0], [1, 1], [2, 2]], sources=['ndvi.savgol'])
+        deduped = connection.request_ndvi(points=[[0, 0], [1, 1], [0, 0]], location_ids=['a', 'b', 'c'], dedupe='exact')
+        failed = connection.request_ndvi(points=[[3, 3]])
+        self.statuses[savgol] = 'Succeeded'
+        expected = connection.get_data(savgol)
+        connection.journal.close()
+        # the process dies: everything kept in memory is gone
+        savgol_qids.remove(savgol)
+        del deduped_qids[deduped]
+        self.statuses.update({deduped: 'Succeeded', failed: 'Failed'})
+
+        connection = self.connect()
+        self.assertIn(savgol, savgol_qids)
+        # the dedupe groups are read from the journal when the result is
+        self.assertNotIn(deduped, deduped_qids)
+        self.assertEqual(connection.point_groups(deduped).location_ids, ['a', 'b', 'c'])
+        results = connection.resume(self.output)
+        connection.make_request.assert_not_called()
+        self.assertEqual(results, {failed: 'Failed', savgol: os.path.join(self.output, savgol), deduped: os.path.join(self.output, deduped)})
+        pd.testing.assert_frame_equal(pd.read_parquet(results[savgol]), expected, check_exact=False, rtol=1e-12)
+        df = pd.read_parquet(results[deduped]).sort_values('point')
+        self.assertEqual(df['location_id'].tolist(), ['a', 'b', 'c'])
+        self.assertEqual(df['ndvi'].tolist(), [0, 1, 0])
+        self.assertEqual(connection.journal.summary(), {'Succeeded': 2, 'Failed': 1})
+        # a second run has nothing left to fetch
+        self.assertEqual(connection.resume(self.output), {failed: 'Failed'})
+
+    def test_interrupted_save_is_redone(self):
+        connection = self.connect()
+        query_id = connection.request_ndvi(points=[[0, 0], [1, 1]])
+        self.statuses[query_id] = 'Succeeded'
+        path = os.path.join(self.output, query_id)
+        os.makedirs(path + '.partial')
+        with open(os.path.join(path + '.partial', 'part-00000.parquet'), 'w') as f:
+            f.write('truncated')
+        connection.resume(self.output)
+        self.assertFalse(os.path.exists(path + '.partial'))
+        self.assertEqual(os.listdir(path), ['part-00000.parquet'])
+        self.assertEqual(connection.journal.entries()[0]['output'], os.path.abspath(path))
+
+    def test_saved_but_not_journaled_counts_as_done(self):
+        connection = self.connect()
+        (first, second) = [connection.request_ndvi(points=[[0, 0], [1, 1]]) for _ in range(2)]
+        self.statuses.update({first: 'Succeeded', second: 'Succeeded'})
+        # a crash between moving the output into place and journaling it
+        journal = connection.journal
+        connection.journal = None
+        connection.save_data(first, os.path.join(self.output, first))
+        connection.journal = journal
+        results = connection.resume(self.output)
+        self.assertEqual(results, {first: os.path.join(self.output, first), second: os.path.join(self.output, second)})
+        self.assertEqual([e['output'] is not None for e in connection.journal.entries()], [True, True])
+
+    def test_one_failing_fetch_does_not_stop_the_others(self):
+        connection = self.connect()
+        (first, second) = [connection.request_ndvi(points=[[0, 0], [1, 1]]) for _ in range(2)]
+        self.statuses.update({first: 'Succeeded', second: 'Succeeded'})
+        os.rename(os.path.join(self.directory.name, first + '.parquet'), os.path.join(self.directory.name, 'moved'))
+        results = connection.resume(self.output)
+        self.assertIsInstance(results[first], Exception)
+        self.assertEqual(results[second], os.path.join(self.output, second))
+        entry = connection.journal.entries()[0]
+        self.assertIsNone(entry['output'])
+        self.assertTrue(entry['error'])
+        # the next run retries it
+        os.rename(os.path.join(self.directory.name, 'moved'), os.path.join(self.directory.name, first + '.parquet'))
+        self.assertEqual(connection.resume(self.output), {first: os.path.join(self.output, first)})
+        self.assertIsNone(connection.journal.entries()[0]['error'])
+
+    def test_many_shards_fit_in_a_file_name(self):
+        connection = self.connect()
+        connection.shard_size = 1
+        points = [[float(i), float(i)] for i in range(30)]
+        query_id = connection.request_ndvi(points=points)
+        self.assertGreater(len(query_id), 255)
+        self.statuses.update({qid: 'Succeeded' for qid in self.statuses})
+        results = connection.resume(self.output)
+        path = results[query_id]
+        self.assertEqual(os.path.dirname(path), self.output)
+        self.assertTrue(os.path.basename(path).startswith('sharded-'))
+        self.assertEqual(connection.journal.entries()[0]['name'], os.path.basename(path))
+        self.assertEqual(sorted(pd.read_parquet(path)['ndvi'].tolist()), list(range(30)))
+        self.assertEqual(connection.resume(self.output), {})
+
+    def test_resume_needs_a_journal(self):
+        with self.assertRaises(ValueError):
+            StreambatchConnection("your_api_key", quiet=True).resume(self.output)
+
+
+if __name__ == '__main__':
+    unittest.main()
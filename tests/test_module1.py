@@ -1,14 +1,29 @@
+import json
+import os
+import tempfile
 import unittest
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from datetime import datetime
 
 
-from streambatch.module1 import StreambatchConnection
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from streambatch.cache import RequestCache
+from streambatch.module1 import ShardSubmitError, StreambatchConnection, deduped_qids, savgol_qids, sharded_qids
 
 class TestStreambatchConnection(unittest.TestCase):
     
     def setUp(self):
         self.connection = StreambatchConnection("your_api_key")
+        # the query registries are module globals: whatever a test registers is dropped after it
+        for registry in (sharded_qids, deduped_qids):
+            patcher = patch.dict(registry)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        savgol_before = list(savgol_qids)
+        self.addCleanup(savgol_qids.__setitem__, slice(None), savgol_before)
 
     # Polygon validation
     
@@ -94,12 +109,32 @@ class TestStreambatchConnection(unittest.TestCase):
         result = self.connection.validate_point_input(points)
         self.assertEqual(result, points)
     
-    # Not implemented yet
-    # def test_validate_point_input_valid_geojson(self):
-    #     points = [{"type": "Point", "coordinates": [0, 0]}, {"type": "Point", "coordinates": [1, 1]}]
-    #     expected_result = [[0, 0], [1, 1]]  # Converted to regular coordinates
-    #     result = self.connection.validate_point_input(points)
-    #     self.assertEqual(result, expected_result)
+    def test_validate_point_input_valid_geojson(self):
+        points = [{"type": "Point", "coordinates": [0, 0]}, {"type": "Point", "coordinates": [1, 1]}]
+        expected_result = [[0, 0], [1, 1]]  # Converted to regular coordinates
+        result = self.connection.validate_point_input(points)
+        self.assertEqual(result, expected_result)
+
+    def test_validate_point_input_feature_collection(self):
+        points = {"type": "FeatureCollection", "features": [{"type": "Feature", "geometry": {"type": "Point", "coordinates": [0, 0]}, "properties": {}}]}
+        self.assertEqual(self.connection.validate_point_input(points), [[0, 0]])
+
+    def test_validate_point_input_array_and_tables(self):
+        array = np.array([[0.5, 1.5], [-120.25, 45.0]])
+        for points in [array, pd.DataFrame({'lat': array[:, 1], 'lon': array[:, 0]}), pa.table({'longitude': array[:, 0], 'latitude': array[:, 1]})]:
+            np.testing.assert_array_equal(self.connection.validate_point_input(points), array)
+
+    def test_validate_point_input_bad_values(self):
+        for points in [np.zeros((3, 3)), np.array([[0, 0], [np.nan, 0]]), np.array([[0, 0], [181, 0]]), [[0, 0], [0, -91]]]:
+            with self.assertRaises(ValueError):
+                self.connection.validate_point_input(points)
+
+    def test_array_request_body(self):
+        self.connection.session.request = MagicMock(return_value=self.response(200, '{"id":"1","access_url":"2"}'))
+        self.connection.request_ndvi(points=np.array([[0.5, 1.5], [2.0, 3.0]]), start_date="2020-01-01", end_date="2020-12-31")
+        body = json.loads(self.connection.session.request.call_args.kwargs['data'])
+        self.assertEqual(body['space'], [[0.5, 1.5], [2.0, 3.0]])
+        self.assertEqual(self.connection.session.request.call_args.kwargs['headers']['Content-Type'], 'application/json')
     
     def test_validate_point_input_invalid_type(self):
         with self.assertRaises(ValueError):
@@ -221,6 +256,234 @@ class TestStreambatchConnection(unittest.TestCase):
         self.connection.status = MagicMock(return_value='{"status":"Running"}')
         self.assertFalse(self.connection.query_done("1"))
     
+    # sharding
+
+    def test_request_ndvi_shards(self):
+        points = [[i, i] for i in range(5)]
+        self.connection.make_request = MagicMock(side_effect=lambda r: ("q{}".format(r['space'][0][0]), "url"))
+        query_id = self.connection.request_ndvi(points=points, location_ids=[str(i) for i in range(5)], shard_size=2)
+        self.assertEqual(query_id, "q0+q2+q4")
+        self.assertEqual(sharded_qids[query_id], [("q0", 0), ("q2", 2), ("q4", 4)])
+        requests = sorted([c.args[0] for c in self.connection.make_request.call_args_list], key=lambda r: r['space'][0][0])
+        self.assertEqual([r['space'] for r in requests], [points[0:2], points[2:4], points[4:5]])
+        self.assertEqual([r['location_id'] for r in requests], [["0", "1"], ["2", "3"], ["4"]])
+
+    def test_request_ndvi_no_shards_when_small(self):
+        self.connection.make_request = MagicMock(return_value=("1", "2"))
+        self.assertEqual(self.connection.request_ndvi(points=[[0, 0], [1, 1]], shard_size=2), "1")
+
+    def test_get_data_shards(self):
+        sharded_qids["s1+s2"] = [("s1", 0), ("s2", 3)]
+        self.connection.send = MagicMock(return_value=MagicMock(text='{"status":"Succeeded"}'))
+        self.connection.read_parquet = MagicMock(side_effect=lambda url, **kwargs: pd.DataFrame({'point': [0, 1, 2] if 's1' in url else [0, 1], 'ndvi': 0.5}))
+        df = self.connection.get_data("s1+s2")
+        self.assertEqual(sorted(df['point']), [0, 1, 2, 3, 4])
+
+    def test_sharded_status(self):
+        sharded_qids["s1+s2"] = [("s1", 0), ("s2", 3)]
+        self.connection.send = MagicMock(side_effect=lambda method, url: MagicMock(text='{"status":"Running"}' if 's2' in url else '{"status":"Succeeded"}'))
+        self.assertFalse(self.connection.query_done("s1+s2"))
+        # a failed shard doesn't end the composite while the other shards are still running
+        self.connection.send = MagicMock(side_effect=lambda method, url: MagicMock(text='{"status":"Failed"}' if 's2' in url else '{"status":"Running"}'))
+        self.assertFalse(self.connection.query_done("s1+s2"))
+        self.connection.send = MagicMock(side_effect=lambda method, url: MagicMock(text='{"status":"Failed"}' if 's2' in url else '{"status":"Succeeded"}'))
+        self.assertEqual(json.loads(self.connection.status("s1+s2")), {'status': 'Failed', 'failed_shards': ['s2']})
+
+    def test_shard_submit_failure_keeps_submitted_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.connection.request_cache = RequestCache(os.path.join(directory, 'requests.db'))
+            points = [[i, i] for i in range(5)]
+            def make_request(request):
+                if request['space'][0][0] == 2:
+                    raise ValueError('server error')
+                return ("q{}".format(request['space'][0][0]), "url")
+            self.connection.make_request = MagicMock(side_effect=make_request)
+            with self.assertRaises(ShardSubmitError) as raised:
+                self.connection.request_ndvi(points=points, shard_size=2)
+            self.assertEqual(raised.exception.submitted, [("q0", 0), ("q4", 4)])
+            self.assertEqual([offset for (offset, e) in raised.exception.errors], [2])
+            # sending the request again only submits the missing shard
+            self.connection.make_request = MagicMock(return_value=("q2", "url"))
+            self.assertEqual(self.connection.request_ndvi(points=points, shard_size=2), "q0+q2+q4")
+            self.assertEqual(self.connection.make_request.call_count, 1)
+
+    def test_partial_query(self):
+        sharded_qids["s1+s2+s3"] = [("s1", 0), ("s2", 3), ("s3", 5)]
+        self.connection.send = MagicMock(side_effect=lambda method, url: MagicMock(text='{"status":"Failed"}' if 's2' in url else '{"status":"Succeeded"}'))
+        self.connection.read_parquet = MagicMock(side_effect=lambda url, **kwargs: pd.DataFrame({'point': [0, 1, 2] if 's1' in url else [0], 'ndvi': 0.5}))
+        self.assertIsNone(self.connection.get_data("s1+s2+s3"))
+        (partial, failed) = self.connection.partial_query("s1+s2+s3")
+        self.assertEqual(failed, [("s2", 3)])
+        self.assertEqual(sorted(self.connection.get_data(partial)['point']), [0, 1, 2, 5])
+
+    # streaming
+
+    def write_result(self, directory, query_id, n):
+        pd.DataFrame({'point': [i // 10 for i in range(n)], 'ndvi': 0.5}).to_parquet(os.path.join(directory, query_id + '.parquet'), row_group_size=100)
+
+    def test_iter_data(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_result(directory, "1", 1000)
+            self.connection.READ_URL = directory
+            self.connection.status = MagicMock(return_value='{"status":"Succeeded"}')
+            batches = list(self.connection.iter_data("1", batch_size=100))
+            self.assertEqual(len(batches), 10)
+            self.assertTrue(all(len(b) == 100 for b in batches))
+            self.assertEqual(list(pd.concat(batches)['point']), [i // 10 for i in range(1000)])
+
+    def test_iter_data_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_result(directory, "s1", 20)
+            self.write_result(directory, "s2", 10)
+            sharded_qids["s1+s2"] = [("s1", 0), ("s2", 2)]
+            self.connection.READ_URL = directory
+            self.connection.send = MagicMock(return_value=MagicMock(text='{"status":"Succeeded"}'))
+            batches = list(self.connection.iter_data("s1+s2", as_arrow=True))
+            self.assertEqual(sorted(set(sum([b.column('point').to_pylist() for b in batches], []))), [0, 1, 2])
+
+    def test_iter_data_failed(self):
+        self.connection.status = MagicMock(return_value='{"status":"Failed"}')
+        self.assertEqual(list(self.connection.iter_data("1")), [])
+
+    # pushdown
+
+    def write_daily(self, directory, query_id, n, col='point'):
+        df = pd.DataFrame({col: [i for i in range(n) for d in range(10)], 'time': list(pd.date_range('2023-01-01', periods=10)) * n, 'ndvi': 0.5})
+        df.to_parquet(os.path.join(directory, query_id + '.parquet'), row_group_size=10)
+
+    def test_registries_are_restored(self):
+        self.assertNotIn("s1+s2", sharded_qids)
+        self.assertNotIn("s1+s2+s3", sharded_qids)
+        self.assertFalse([q for q in sharded_qids if q.startswith("q0+")])
+
+    def test_get_data_pushdown(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_daily(directory, "1", 5)
+            self.connection.READ_URL = directory
+            self.connection.status = MagicMock(return_value='{"status":"Succeeded"}')
+            df = self.connection.get_data("1", columns=['point', 'ndvi'], locations=[1, 3], start="2023-01-03", end="2023-01-05")
+            self.assertEqual(list(df.columns), ['point', 'ndvi'])
+            self.assertEqual(list(df['point']), [1, 1, 1, 3, 3, 3])
+
+    def test_get_data_pushdown_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_daily(directory, "s1", 3)
+            self.write_daily(directory, "s2", 3)
+            sharded_qids["s1+s2"] = [("s1", 0), ("s2", 3)]
+            self.connection.READ_URL = directory
+            self.connection.send = MagicMock(return_value=MagicMock(text='{"status":"Succeeded"}'))
+            self.connection.read_parquet = MagicMock(wraps=self.connection.read_parquet)
+            df = self.connection.get_data("s1+s2", locations=[4])
+            self.assertEqual(set(df['point']), {4})
+            self.assertEqual(self.connection.read_parquet.call_count, 1)
+
+    def test_build_filters_location_ids(self):
+        self.connection.read_schema = MagicMock(return_value=['location_id', 'time', 'ndvi'])
+        self.assertEqual(self.connection.build_filters("url", locations=["a"]), [('location_id', 'in', ["a"])])
+        with self.assertRaises(ValueError):
+            self.connection.build_filters("url", locations=[1])
+
+    # result formats
+
+    def test_get_data_arrow_and_compact(self):
+        with tempfile.TemporaryDirectory() as directory:
+            df = pd.DataFrame({'point': [0, 0, 1], 'location_id': ['a', 'a', 'b'], 'time': pd.date_range('2023-01-01', periods=3), 'ndvi': [0.1, 0.2, 0.3]})
+            df.to_parquet(os.path.join(directory, '1.parquet'))
+            self.connection.READ_URL = directory
+            self.connection.status = MagicMock(return_value='{"status":"Succeeded"}')
+            table = self.connection.get_data("1", result_format='arrow')
+            self.assertEqual(table.num_rows, 3)
+            compact = self.connection.get_data("1", result_format='compact')
+            self.assertEqual(str(compact['ndvi'].dtype), 'float32')
+            self.assertEqual(str(compact['point'].dtype), 'int8')
+            self.assertEqual(str(compact['location_id'].dtype), 'category')
+            self.assertEqual(list(compact['location_id']), ['a', 'a', 'b'])
+
+    def test_get_data_invalid_result_format(self):
+        with self.assertRaises(ValueError):
+            self.connection.get_data("1", result_format='excel')
+
+    # polling many queries
+
+    def statuses(self, sequences):
+        # status() mock: each query id walks through its own list of statuses
+        sequences = {q: list(v) for q, v in sequences.items()}
+        def status(query_id):
+            states = sequences[query_id]
+            return '{{"status":"{}"}}'.format(states.pop(0) if len(states) > 1 else states[0])
+        return status
+
+    def test_poll_delays_back_off(self):
+        connection = StreambatchConnection("your_api_key", poll_initial=1, poll_factor=2, poll_max=5)
+        delays = connection.poll_delays()
+        self.assertEqual([next(delays) for i in range(5)], [1, 2, 4, 5, 5])
+
+    def test_as_completed(self):
+        connection = StreambatchConnection("your_api_key", poll_initial=0.001)
+        connection.status = self.statuses({"a": ["Running", "Running", "Succeeded"], "b": ["Failed"], "c": ["Running", "Succeeded"]})
+        self.assertEqual(list(connection.as_completed(["a", "b", "c"])), ["b", "c", "a"])
+
+    def test_wait_all(self):
+        connection = StreambatchConnection("your_api_key", poll_initial=0.001)
+        connection.status = self.statuses({"a": ["Running", "Succeeded"], "b": ["Failed"]})
+        self.assertEqual(connection.wait_all(["a", "b"]), {"a": "Succeeded", "b": "Failed"})
+
+    def test_wait_all_timeout(self):
+        connection = StreambatchConnection("your_api_key", poll_initial=0.01)
+        connection.status = self.statuses({"a": ["Running"]})
+        with self.assertRaises(TimeoutError):
+            connection.wait_all(["a"], timeout=0.05)
+
+    # http session and retries
+
+    def response(self, status_code, text='{}', headers=None):
+        response = MagicMock()
+        response.status_code = status_code
+        response.text = text
+        response.content = text.encode()
+        response.headers = headers or {}
+        return response
+
+    def test_make_request_retries_transient_errors(self):
+        connection = StreambatchConnection("your_api_key", backoff_factor=0)
+        connection.session.request = MagicMock(side_effect=[self.response(503), self.response(429), self.response(200, '{"id":"1","access_url":"2"}')])
+        self.assertEqual(connection.make_request({}), ("1", "2"))
+        self.assertEqual(connection.session.request.call_count, 3)
+        self.assertEqual(connection.connection_stats()['retries'], 2)
+
+    def test_make_request_does_not_retry_client_errors(self):
+        connection = StreambatchConnection("your_api_key", backoff_factor=0)
+        connection.session.request = MagicMock(return_value=self.response(403, '{"error":"bad key"}'))
+        with self.assertRaises(ValueError):
+            connection.make_request({})
+        self.assertEqual(connection.session.request.call_count, 1)
+
+    def test_make_request_gives_up_after_max_retries(self):
+        connection = StreambatchConnection("your_api_key", max_retries=2, backoff_factor=0)
+        connection.session.request = MagicMock(return_value=self.response(503, '{"error":"oops"}'))
+        with self.assertRaises(ValueError):
+            connection.make_request({})
+        self.assertEqual(connection.session.request.call_count, 3)
+        self.assertEqual(connection.connection_stats()['failures'], 1)
+
+    def test_post_is_not_retried_when_the_server_may_have_accepted_it(self):
+        for status_code in [500, 502, 504]:
+            connection = StreambatchConnection("your_api_key", backoff_factor=0)
+            connection.session.request = MagicMock(return_value=self.response(status_code, '{"error":"oops"}'))
+            with self.assertRaises(ValueError):
+                connection.make_request({})
+            self.assertEqual(connection.session.request.call_count, 1)
+            # a GET has no side effects and is retried
+            self.assertEqual(connection.send('GET', 'url').status_code, status_code)
+            self.assertEqual(connection.session.request.call_count, 1 + 4)
+
+    def test_backoff_delay(self):
+        connection = StreambatchConnection("your_api_key", backoff_factor=1, backoff_max=5)
+        self.assertTrue(0.5 <= connection.backoff_delay(0) <= 1)
+        self.assertTrue(2 <= connection.backoff_delay(2) <= 4)
+        self.assertTrue(2.5 <= connection.backoff_delay(10) <= 5)
+        self.assertEqual(connection.backoff_delay(0, retry_after="3"), 3)
+
     # misc tests (old)
     def test_add(self):
         x = StreambatchConnection("api_key")
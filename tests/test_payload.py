@@ -0,0 +1,83 @@
+import gzip
+import json
+import unittest
+from unittest.mock import MagicMock
+
+import numpy as np
+
+from streambatch.module1 import StreambatchConnection
+from streambatch.payload import encode_request, is_simple, quantize_space, simplify_ring
+
+
+class TestPayload(unittest.TestCase):
+
+    def test_simplify_ring_drops_repeats_and_straight_runs(self):
+        ring = [[0, 0], [1, 0], [1, 0], [2, 0], [2, 1], [2, 2], [0, 2], [0, 1], [0, 0]]
+        self.assertEqual(simplify_ring(ring, 6), [[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]])
+
+    def test_simplify_ring_keeps_spikes(self):
+        ring = [[0, 0], [3, 0], [2, 0], [2, 2], [0, 0]]
+        self.assertEqual(simplify_ring(ring, 6), ring)
+
+    def test_simplify_ring_keeps_rings_that_would_collapse(self):
+        ring = [[0, 0], [1e-9, 0], [0, 1e-9], [0, 0]]
+        self.assertEqual(simplify_ring(ring, 6), ring)
+
+    def test_quantize_space(self):
+        polygon = {'type': 'Polygon', 'coordinates': [[[-94.4545917478666, 41.9792090154671], [-94.4545448033213, 41.9757220431519],
+                                                       [-94.4450066084548, 41.9757090969481], [-94.4545917478666, 41.9792090154671]]]}
+        self.assertEqual(quantize_space([polygon], 4)[0]['coordinates'], [[[-94.4546, 41.9792], [-94.4545, 41.9757], [-94.445, 41.9757], [-94.4546, 41.9792]]])
+        self.assertEqual(quantize_space([[3.940705123, 49.345238987]], 3), [[3.941, 49.345]])
+        np.testing.assert_array_equal(quantize_space(np.array([[0.123456789, 1.0]]), 2), [[0.12, 1.0]])
+
+    def test_quantize_mixed_geometries(self):
+        square = [[[0.12344, 0.0], [1.0, 0.0], [1.0, 1.0], [0.5, 1.0], [0.0, 1.0], [0.12344, 0.0]]]
+        space = [{'type': 'Point', 'coordinates': [1.12, 2.5]},
+                 {'type': 'MultiPoint', 'coordinates': [[1.126, 2.5], [3, 4.444]]},
+                 {'type': 'LineString', 'coordinates': [[0.004, 0], [1, 1], [2, 2], [3, 3.006]]},
+                 {'type': 'MultiPolygon', 'coordinates': [square]},
+                 {'type': 'GeometryCollection', 'geometries': [{'type': 'Point', 'coordinates': [0.555, 0]}, {'type': 'Polygon', 'coordinates': square}]}]
+        rounded = [[[0.12, 0.0], [1.0, 0.0], [1.0, 1.0], [0.0, 1.0], [0.12, 0.0]]]
+        self.assertEqual(quantize_space(space, 2), [
+            {'type': 'Point', 'coordinates': [1.12, 2.5]},
+            {'type': 'MultiPoint', 'coordinates': [[1.13, 2.5], [3.0, 4.44]]},
+            {'type': 'LineString', 'coordinates': [[0.0, 0.0], [1.0, 1.0], [2.0, 2.0], [3.0, 3.01]]},
+            {'type': 'MultiPolygon', 'coordinates': [rounded]},
+            {'type': 'GeometryCollection', 'geometries': [{'type': 'Point', 'coordinates': [0.56, 0.0]}, {'type': 'Polygon', 'coordinates': rounded}]}])
+
+    def test_rounding_that_makes_a_polygon_cross_itself_is_not_applied(self):
+        ring = [[0, 0], [5, 0.00151], [10, 0], [10, 0.003], [7, 0.0019], [3, 0.00149], [0, 0.003], [0, 0]]
+        polygon = {'type': 'Polygon', 'coordinates': [ring]}
+        self.assertEqual(quantize_space([polygon], 3)[0]['coordinates'], [ring])
+        self.assertEqual(quantize_space([polygon], 4)[0]['coordinates'], [[[0, 0], [5, 0.0015], [10, 0], [10, 0.003], [7, 0.0019], [3, 0.0015], [0, 0.003], [0, 0]]])
+        # a hole that rounding would push onto its shell
+        shell = [[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]]
+        hole = [[0.2, 0.0004], [0.4, 0.0004], [0.3, 0.2], [0.2, 0.0004]]
+        self.assertEqual(quantize_space([{'type': 'Polygon', 'coordinates': [shell, hole]}], 3)[0]['coordinates'], [shell, hole])
+
+    def test_is_simple(self):
+        self.assertTrue(is_simple([[(0, 0), (2, 0), (2, 2), (0, 2)]]))
+        self.assertFalse(is_simple([[(0, 0), (2, 2), (2, 0), (0, 2)]]))
+        self.assertFalse(is_simple([[(0, 0), (3, 0), (2, 0), (2, 2)]]))
+        self.assertFalse(is_simple([[(0, 0), (4, 0), (4, 4), (0, 4)], [(1, 1), (5, 2), (2, 3)]]))
+
+    def test_encode_request_report(self):
+        request = {'space': [[0.123456789, 1.123456789]] * 1000}
+        (body, encoding, report) = encode_request(request, 2, True)
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(body))['space'][0], [0.12, 1.12])
+        self.assertTrue(report['raw'] > report['json'] > report['sent'] == len(body))
+
+    def test_connection_sends_compressed_body(self):
+        connection = StreambatchConnection("your_api_key", coordinate_precision=5, compress_requests=True)
+        response = MagicMock(status_code=200, text='{"id":"1","access_url":"2"}', content=b'{"id":"1","access_url":"2"}')
+        connection.session.request = MagicMock(return_value=response)
+        connection.request_ndvi(points=[[0.1234567, 1.0]], start_date="2020-01-01", end_date="2020-12-31")
+        kwargs = connection.session.request.call_args.kwargs
+        self.assertEqual(kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(json.loads(gzip.decompress(kwargs['data']))['space'], [[0.12346, 1.0]])
+        self.assertGreater(connection.connection_stats()['payload_raw_bytes'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
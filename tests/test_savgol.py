@@ -0,0 +1,181 @@
+import unittest
+
+import numpy as np
+import pandas as pd
+from scipy.signal import savgol_filter
+
+from streambatch.compact import compact_frame
+from streambatch.savgol import find_outliers, outlier_mask, prepare, remove_outliers, savgol, savgol_parallel, savgol_update
+
+
+# synthetic server output for n locations: daily rows, a few valid sentinel2/landsat observations
+# and some cloud spikes so that the outlier removal has something to do
+def make_raw(n, days=200, col='point', seed=0):
+    rng = np.random.default_rng(seed)
+    t = pd.date_range('2022-01-01', periods=days, freq='D')
+    frames = []
+    for p in range(n):
+        base = 0.5 + 0.3 * np.sin(np.arange(days) / 30 + p)
+        s2 = np.round(base + rng.normal(0, 0.05, days), 3)
+        s2[rng.random(days) < 0.03] -= 0.4
+        l8 = np.round(base + rng.normal(0, 0.05, days), 3)
+        frames.append(pd.DataFrame({
+            col: p,
+            'time': t,
+            'ndvi.sentinel2': s2,
+            'qa.sentinel2': (rng.random(days) < 0.2).astype(int),
+            'ndvi.landsat': l8,
+            'qa.landsat': (rng.random(days) < 0.1).astype(int),
+        }))
+    return pd.concat(frames, ignore_index=True)
+
+
+# straightforward per-location version of the pipeline to check the batched engine against
+def reference(df, col):
+    (m, s2, l8) = prepare(df)
+    out = []
+    for p in m[col].unique():
+        m1 = remove_outliers(m[m[col] == p])
+        date_range = pd.date_range(m1['time'].min(), m1['time'].max(), freq='D')
+        d = pd.merge(pd.DataFrame({'time': date_range}), m1, on='time', how='left')
+        d['ndvi'] = d['ndvi'].interpolate()
+        d = d.ffill()
+        d[col] = d[col].astype(int)
+        d['ndvi.savgol'] = savgol_filter(d['ndvi'], 20, 2)
+        d = d.rename(columns={'ndvi': 'ndvi.interpolated'})
+        d['ndvi.sentinel2'] = pd.merge(pd.DataFrame({'time': date_range}), s2[s2[col] == p], on='time', how='left')['ndvi.sentinel2']
+        d['ndvi.landsat'] = pd.merge(pd.DataFrame({'time': date_range}), l8[l8[col] == p], on='time', how='left')['ndvi.landsat']
+        out.append(d)
+    return pd.concat(out, ignore_index=True)
+
+
+class TestSavgol(unittest.TestCase):
+
+    def assertFramesClose(self, a, b):
+        self.assertEqual(list(a.columns), list(b.columns))
+        self.assertEqual(a.shape, b.shape)
+        for c in a.columns:
+            if a[c].dtype.kind == 'f':
+                np.testing.assert_allclose(a[c].to_numpy(), b[c].to_numpy(), rtol=1e-12, atol=1e-12)
+            else:
+                np.testing.assert_array_equal(a[c].to_numpy(), b[c].to_numpy())
+
+    def test_savgol_matches_per_location_points(self):
+        df = make_raw(5)
+        self.assertFramesClose(savgol(df), reference(df, 'point'))
+
+    def test_savgol_matches_per_location_polygons(self):
+        df = make_raw(3, col='location', seed=1)
+        self.assertFramesClose(savgol(df), reference(df, 'location'))
+
+    def test_savgol_columns(self):
+        result = savgol(make_raw(2))
+        for c in ['time', 'point', 'ndvi.interpolated', 'ndvi.savgol', 'ndvi.sentinel2', 'ndvi.landsat']:
+            self.assertIn(c, result.columns)
+        self.assertTrue(result.index.equals(pd.RangeIndex(len(result))))
+
+    def test_savgol_rows_are_daily_per_location(self):
+        result = savgol(make_raw(3))
+        for p, g in result.groupby('point'):
+            self.assertTrue((g['time'].diff().dropna() == pd.Timedelta(days=1)).all())
+
+    def test_savgol_locations_not_starting_at_zero(self):
+        df = make_raw(2)
+        df['point'] = df['point'] + 7
+        result = savgol(df)
+        self.assertEqual(sorted(result['point'].unique()), [7, 8])
+
+    def test_savgol_workers_same_result(self):
+        df = make_raw(9, days=120)
+        self.assertFramesClose(savgol_parallel(df, workers=2), savgol(df))
+        self.assertFramesClose(savgol(df, workers=2), savgol(df))
+
+    def test_savgol_workers_keep_dtypes(self):
+        df = make_raw(9, days=120)
+        df['location_id'] = ['f{}'.format(p) for p in df['point']]
+        df['count'] = pd.array(df['point'], dtype='Int64')
+        for frame in [df, compact_frame(df)]:
+            pd.testing.assert_frame_equal(savgol_parallel(frame, workers=2), savgol(frame), check_exact=False, rtol=1e-9)
+        self.assertIsInstance(savgol_parallel(compact_frame(df), workers=2)['location_id'].dtype, pd.CategoricalDtype)
+
+    def test_savgol_compact_input(self):
+        df = make_raw(3)
+        full = savgol(df)
+        compact = savgol(compact_frame(df))
+        self.assertEqual(str(compact['point'].dtype), 'int8')
+        np.testing.assert_allclose(compact['ndvi.savgol'], full['ndvi.savgol'], atol=1e-6)
+
+    def test_savgol_too_few_days(self):
+        with self.assertRaises(ValueError):
+            savgol(make_raw(1, days=10))
+
+    def test_prepare_same_day_rule(self):
+        df = pd.DataFrame({'point': 0, 'time': pd.date_range('2022-01-01', periods=3),
+                           'ndvi.sentinel2': [0.2, 0.3, 0.4], 'qa.sentinel2': [1, 1, 0],
+                           'ndvi.landsat': [0.6, 0.5, 0.7], 'qa.landsat': [1, 0, 1]})
+        self.assertEqual(list(prepare(df)[0]['ndvi']), [0.6, 0.3, 0.7])
+        self.assertEqual(list(prepare(df, 'sentinel2')[0]['ndvi']), [0.2, 0.3, 0.7])
+        np.testing.assert_allclose(prepare(df, 'mean')[0]['ndvi'], [0.4, 0.3, 0.7])
+        self.assertEqual(list(prepare(df, np.maximum)[0]['ndvi']), [0.6, 0.3, 0.7])
+        with self.assertRaises(ValueError):
+            prepare(df, 'best')
+
+    def test_prepare_unsorted_input(self):
+        df = make_raw(3)
+        (m, s2, l8) = prepare(df.sample(frac=1, random_state=0))
+        self.assertFramesClose(m, prepare(df)[0])
+
+    def test_outlier_mask_grouped_matches_per_location(self):
+        m = prepare(make_raw(6))[0]
+        columns = list(m.columns)
+        mask = outlier_mask(m, by='point')
+        self.assertEqual(list(m.columns), columns)
+        self.assertTrue(mask.any())
+        for p in range(6):
+            single = m[m['point'] == p]
+            np.testing.assert_array_equal(mask[single.index], find_outliers(single.copy())['outlier'].to_numpy())
+
+    def test_outlier_mask_thresholds(self):
+        m = pd.DataFrame({'point': [0] * 7 + [1] * 7, 'ndvi': [0.5, 0.5, 0.5, 0.1, 0.5, 0.5, 0.5] * 2})
+        np.testing.assert_array_equal(np.flatnonzero(outlier_mask(m, by='point')), [3, 10])
+        self.assertFalse(outlier_mask(m, by='point', delta=0.5).any())
+        self.assertFalse(outlier_mask(m, by='point', zscore=3).any())
+        self.assertEqual(len(remove_outliers(m, by='point')), 12)
+
+    def update(self, df, split, col='point'):
+        previous = savgol(df[df['time'] < split])
+        new = df[df['time'] >= split]
+        # days after the last observation of previous
+        new = new[new['time'] > new[col].map(previous.groupby(col)['time'].max())]
+        return savgol_update(previous, new)
+
+    def test_savgol_update_matches_full(self):
+        df = make_raw(6, days=400)
+        for split in ['2022-06-01', '2023-01-20', '2023-02-03']:
+            self.assertFramesClose(self.update(df, split), savgol(df))
+
+    def test_savgol_update_polygons_and_new_location(self):
+        df = make_raw(3, days=300, col='location', seed=2)
+        previous = savgol(df[(df['time'] < '2022-09-01') & (df['location'] < 2)])
+        new = df[(df['time'] > '2022-09-10') | (df['location'] == 2)]
+        self.assertFramesClose(savgol_update(previous, new), savgol(pd.concat([df[(df['time'] < '2022-09-01') & (df['location'] < 2)], new])))
+
+    def test_savgol_update_keeps_location_order(self):
+        df = make_raw(4, days=300, seed=3)
+        old = df[(df['time'] < '2022-09-01') & (df['point'] != 1)]
+        # point 1 is new and goes between 0 and 2; point 3 gets no new rows
+        new = df[((df['time'] > '2022-09-10') & (df['point'] != 3)) | (df['point'] == 1)]
+        updated = savgol_update(savgol(old), new)
+        self.assertFramesClose(updated, savgol(pd.concat([old, new])))
+        self.assertTrue(updated['point'].is_monotonic_increasing)
+        # nothing new at all
+        self.assertFramesClose(savgol_update(savgol(old), new.iloc[:0]), savgol(old))
+
+    def test_savgol_update_rejects_old_days(self):
+        df = make_raw(2)
+        with self.assertRaises(ValueError):
+            savgol_update(savgol(df), df)
+
+
+if __name__ == '__main__':
+    unittest.main()
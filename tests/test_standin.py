@@ -0,0 +1,39 @@
+import unittest
+
+from benchmarks.load import run_load
+from streambatch.module1 import StreambatchConnection
+from streambatch.testing import StandInServer
+
+
+class TestStandInServer(unittest.TestCase):
+
+    def connection(self, server):
+        connection = StreambatchConnection('key', quiet=True, poll_initial=0.01, backoff_factor=0.001, max_retries=10)
+        return server.configure(connection)
+
+    def test_full_cycle(self):
+        with StandInServer(queue_time=(0, 0.05)) as server:
+            connection = self.connection(server)
+            query_id = connection.request_ndvi(points=[[0, 0], [1, 1]], location_ids=['a', 'b'], start_date='2020-01-01', end_date='2020-01-10',
+                                               sources=['ndvi.sentinel2', 'ndvi.landsat'])
+            df = connection.get_data(query_id)
+        self.assertEqual(len(df), 20)
+        self.assertEqual(list(df.columns), ['point', 'time', 'location_id', 'ndvi.sentinel2', 'qa.sentinel2', 'ndvi.landsat', 'qa.landsat'])
+        self.assertEqual(server.stats['succeeded'], 1)
+
+    def test_injected_failures(self):
+        with StandInServer(queue_time=(0, 0), failure_rate=1.0, error_rate=0.3) as server:
+            connection = self.connection(server)
+            query_ids = [connection.request_ndvi(points=[[0, 0]], start_date='2020-01-01', end_date='2020-01-10') for i in range(5)]
+            self.assertEqual(set(connection.wait_all(query_ids).values()), {'Failed'})
+        self.assertGreater(connection.connection_stats()['retries'], 0)
+
+    def test_load_report(self):
+        report = run_load(queries=20, points=2, submit_workers=4, read_workers=2, poll_initial=0.01, server_options={'queue_time': (0, 0.1)})
+        self.assertEqual((report['submitted'], report['succeeded'], report['errors']), (20, 20, []))
+        self.assertGreater(report['server']['result_bytes'], 0)
+        self.assertLessEqual(report['latency']['p50'], report['latency']['max'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,133 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime
+
+import pandas as pd
+
+from streambatch.sync import IncrementalStore
+
+
+# answers every request with one row per location and day of the requested window
+class FakeConnection:
+    def __init__(self):
+        self.requests = {}
+        self.ndvi = 0.5
+
+    def validate_polygon_input(self, polygons):
+        return polygons
+
+    def validate_point_input(self, points):
+        return points
+
+    def request_ndvi(self, *, points=None, polygons=None, location_ids=None, aggregation="median", sources=None, start_date=None, end_date=None):
+        query_id = "q{}".format(len(self.requests))
+        self.requests[query_id] = (len(points), start_date, end_date)
+        return query_id
+
+    def get_data(self, query_id):
+        (n, start, end) = self.requests[query_id]
+        days = pd.date_range(start, end)
+        return pd.DataFrame({'point': [p for p in range(n) for d in days], 'time': list(days) * n, 'ndvi': self.ndvi})
+
+
+class TestIncrementalStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.connection = FakeConnection()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def store(self, **kwargs):
+        return IncrementalStore(self.connection, self.directory.name, points=[[0, 0], [1, 1]], location_ids=['a', 'b'], start_date="2024-01-01", **kwargs)
+
+    def test_refresh_fetches_only_new_days(self):
+        store = self.store()
+        self.assertEqual(store.refresh(end_date="2024-01-10"), 20)
+        self.assertEqual(store.last_dates(), {'a': '2024-01-10', 'b': '2024-01-10'})
+        # a new store object on the same directory picks up the state
+        store = self.store()
+        self.assertEqual(store.refresh(end_date="2024-01-12"), 4)
+        self.assertEqual(self.connection.requests['q1'][1], datetime(2024, 1, 11))
+        self.assertEqual(store.refresh(end_date="2024-01-12"), 0)
+        self.assertEqual(len(self.connection.requests), 2)
+        df = store.read()
+        self.assertEqual(len(df), 24)
+        self.assertEqual(df.groupby('location_id')['time'].nunique().to_dict(), {'a': 12, 'b': 12})
+
+    def test_lookback_replaces_recent_days(self):
+        store = self.store(lookback_days=3)
+        self.assertEqual(store.refresh(end_date="2024-01-10"), 20)
+        # observations that arrived late: the days asked for again have other values now
+        self.connection.ndvi = 0.7
+        self.assertEqual(store.refresh(end_date="2024-01-12"), 4)
+        self.assertEqual(self.connection.requests['q1'][1], datetime(2024, 1, 8))
+        self.assertEqual(store.last_dates(), {'a': '2024-01-12', 'b': '2024-01-12'})
+        df = store.read()
+        self.assertEqual(len(df), 24)
+        self.assertFalse(df.duplicated(['location_id', 'time']).any())
+        self.assertEqual(df.groupby(df['time'] >= '2024-01-08')['ndvi'].unique().map(list).to_dict(), {False: [0.5], True: [0.7]})
+        # nothing new: the lookback is fetched again, but adds no rows
+        self.assertEqual(store.refresh(end_date="2024-01-12"), 0)
+        self.assertEqual(len(self.connection.requests), 3)
+        self.assertEqual(len(store.read()), 24)
+
+    def test_lookback_across_months(self):
+        store = self.store(lookback_days=5)
+        store.refresh(end_date="2024-02-02")
+        self.connection.ndvi = 0.7
+        self.assertEqual(store.refresh(end_date="2024-02-03"), 2)
+        df = store.read()
+        self.assertEqual(len(df), 2 * 34)
+        self.assertEqual(sorted(df.loc[df['ndvi'] == 0.7, 'time'].unique()), list(pd.date_range("2024-01-29", "2024-02-03")))
+        self.assertEqual(sorted({f.split('/')[0] for f in store.state['files']}), ['2024-01', '2024-02'])
+
+    def test_new_location_gets_full_history(self):
+        self.store().refresh(end_date="2024-01-10")
+        store = IncrementalStore(self.connection, self.directory.name, points=[[0, 0], [1, 1], [2, 2]], location_ids=['a', 'b', 'c'], start_date="2024-01-01")
+        self.assertEqual(store.refresh(end_date="2024-01-11"), 2 + 11)
+        self.assertEqual(len(self.connection.requests), 3)
+        self.assertEqual(len(store.read(locations=['c'])), 11)
+        self.assertEqual(len(store.read(start="2024-01-11")), 3)
+
+    def files(self):
+        return sorted(os.path.relpath(os.path.join(d, n), self.directory.name) for (d, _, names) in os.walk(os.path.join(self.directory.name, 'data')) for n in names)
+
+    def test_daily_refreshes_keep_few_files(self):
+        store = self.store(max_files=3)
+        store.refresh(end_date="2024-01-10")
+        for day in pd.date_range("2024-01-11", "2024-02-05"):
+            store.refresh(end_date=day)
+        # january is merged into one file, february holds at most max_files
+        files = self.files()
+        self.assertEqual(len([f for f in files if '2024-01' in f]), 1)
+        self.assertLessEqual(len([f for f in files if '2024-02' in f]), 3)
+        self.assertEqual(sorted(store.state['files']), [os.path.relpath(f, 'data') for f in files])
+        df = store.read()
+        self.assertEqual(len(df), 2 * 36)
+        self.assertEqual(df['location_id'].tolist(), ['a'] * 36 + ['b'] * 36)
+        self.assertTrue((df.groupby('location_id')['time'].diff().dropna() == pd.Timedelta(days=1)).all())
+        self.assertEqual(len(store.read(locations=['b'], start="2024-02-01")), 5)
+        store.compact(everything=True)
+        self.assertEqual(len(self.files()), 2)
+        pd.testing.assert_frame_equal(store.read(), df)
+
+    def test_files_outside_the_state_are_ignored_and_removed(self):
+        store = self.store()
+        store.refresh(end_date="2024-01-10")
+        # an append that crashed after writing its file but before saving the state
+        pd.DataFrame({'location_id': ['a'], 'time': [pd.Timestamp("2024-01-11")], 'ndvi': [0.5]}).to_parquet(os.path.join(self.directory.name, 'data', '2024-01', 'part-stray.parquet'))
+        self.assertEqual(len(store.read()), 20)
+        self.assertEqual(store.compact(), 1)
+        self.assertEqual(len(self.files()), 1)
+
+    def test_store_keeps_one_kind_of_data(self):
+        self.store().refresh(end_date="2024-01-10")
+        with self.assertRaises(ValueError):
+            self.store(aggregation="mean")
+
+
+if __name__ == '__main__':
+    unittest.main()